@@ -0,0 +1,141 @@
+"""Overhead benchmarks of ai_ghostfunctions, run offline against `FakeAI`.
+
+Run with `nox -s benchmarks`. Results are saved under `.benchmarks/`; compare a
+run against the previous one with `nox -s benchmarks -- --benchmark-compare`.
+"""
+
+import asyncio
+import subprocess  # nosec
+import sys
+from typing import Any
+from typing import Dict
+from typing import List
+
+import pytest
+
+from ai_ghostfunctions import ghostfunction
+from ai_ghostfunctions.aggregators import majority_vote
+from ai_ghostfunctions.cache import InMemoryCache
+from ai_ghostfunctions.ghostfunctions import _default_prompt_creation
+from ai_ghostfunctions.testing import FakeAI
+from ai_ghostfunctions.testing import cycle_response
+from ai_ghostfunctions.testing import dict_response
+from ai_ghostfunctions.testing import list_response
+
+
+def _define(**options: Any) -> Any:
+    @ghostfunction(**options)
+    def generate_n_random_words(n: int, startswith: str) -> List[str]:  # type: ignore[empty-body]
+        """Return a list of `n` random words that start with `startswith`."""
+        pass
+
+    return generate_n_random_words
+
+
+def test_decoration(benchmark: Any) -> None:
+    fake = FakeAI("['a']")
+    benchmark(_define, ai_callable=fake)
+
+
+def test_prompt_building(benchmark: Any) -> None:
+    function = _define(ai_callable=FakeAI("['a']")).function
+    benchmark(_default_prompt_creation, function, n=5, startswith="goo")
+
+
+def test_call_overhead(benchmark: Any) -> None:
+    words = _define(ai_callable=FakeAI("['goofy', 'google']"))
+    assert benchmark(words, n=2, startswith="goo") == ["goofy", "google"]
+
+
+def test_cache_hit(benchmark: Any) -> None:
+    words = _define(ai_callable=FakeAI("['goofy']"), cache=InMemoryCache())
+    words(n=1, startswith="goo")
+    assert benchmark(words, n=1, startswith="goo") == ["goofy"]
+
+
+@pytest.mark.parametrize("size", [100, 10_000])
+def test_parse_large_list(benchmark: Any, size: int) -> None:
+    @ghostfunction(ai_callable=FakeAI(list_response(size)))
+    def numbers(count: int) -> List[int]:  # type: ignore[empty-body]
+        """Return `count` numbers."""
+        pass
+
+    assert len(benchmark(numbers, size)) == size
+
+
+@pytest.mark.parametrize("size", [100, 10_000])
+def test_parse_large_dict(benchmark: Any, size: int) -> None:
+    @ghostfunction(ai_callable=FakeAI(dict_response(size)))
+    def table(count: int) -> Dict[str, List[Any]]:  # type: ignore[empty-body]
+        """Return a table of `count` rows."""
+        pass
+
+    assert len(benchmark(table, size)) == size
+
+
+def test_n_choices_aggregation(benchmark: Any) -> None:
+    fake = FakeAI(cycle_response("['a']", "['a']", "['b']"))
+    words = _define(ai_callable=fake, n=5, aggregation_function=lambda x: max(x))
+    benchmark(words, n=1, startswith="a")
+
+
+def test_n_choices_early_exit(benchmark: Any) -> None:
+    fake = FakeAI(cycle_response("['a']", "['a']", "['b']"), latency=0.005)
+    words = _define(ai_callable=fake, n=5, aggregation_function=majority_vote)
+    benchmark.pedantic(words, kwargs={"n": 1, "startswith": "a"}, rounds=20)
+
+
+def test_map_throughput(benchmark: Any) -> None:
+    words = _define(ai_callable=FakeAI("['a']", latency=0.01, jitter=0.01))
+    items = [{"n": 1, "startswith": str(i)} for i in range(200)]
+
+    def run() -> List[Any]:
+        return list(words.map(items, max_concurrency=32))
+
+    results = benchmark.pedantic(run, rounds=3)
+    assert results == [["a"]] * 200
+
+
+def test_packed_map_throughput(benchmark: Any) -> None:
+    fake = FakeAI(lambda kwargs, index: repr([["a"]] * 10), latency=0.01)
+    words = _define(ai_callable=fake)
+    items = [{"n": 1, "startswith": str(i)} for i in range(200)]
+
+    def run() -> List[Any]:
+        return list(words.map(items, max_concurrency=8, pack_size=10))
+
+    results = benchmark.pedantic(run, rounds=3)
+    assert results == [["a"]] * 200
+
+
+def test_amap_throughput(benchmark: Any) -> None:
+    fake = FakeAI("['a']", latency=0.01, jitter=0.01)
+    words = _define(ai_callable=fake.acall, async_=True)
+    items = [{"n": 1, "startswith": str(i)} for i in range(1000)]
+
+    async def collect() -> List[Any]:
+        return [r async for r in words.amap(items, max_concurrency=256)]
+
+    results = benchmark.pedantic(lambda: asyncio.run(collect()), rounds=3)
+    assert results == [["a"]] * 1000
+
+
+def _cumulative_import_time_us(module: str) -> int:
+    """Return the cumulative import time of `module` in a fresh interpreter."""
+    stderr = subprocess.run(  # nosec
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    last_line = stderr.strip().splitlines()[-1]
+    _, cumulative, name = last_line.split("|")
+    assert name.strip() == module
+    return int(cumulative)
+
+
+def test_import_time_is_a_fraction_of_importing_openai() -> None:
+    """Guard the import time against regressions; timings are too noisy for tests/."""
+    assert _cumulative_import_time_us("ai_ghostfunctions") < 0.5 * (
+        _cumulative_import_time_us("openai")
+    )
@@ -171,7 +171,7 @@ def mypy(session: Session) -> None:
 def tests(session: Session) -> None:
     """Run the test suite."""
     session.install(".")
-    session.install("coverage[toml]", "pytest", "pygments")
+    session.install("coverage[toml]", "pytest", "pygments", "numpy")
     try:
         session.run("coverage", "run", "--parallel", "-m", "pytest", *session.posargs)
     finally:
@@ -179,6 +179,28 @@ def tests(session: Session) -> None:
             session.notify("coverage", posargs=[])
 
 
+@session(python=python_version_default, reuse_venv=True)
+def benchmarks(session: Session) -> None:
+    """Run the offline benchmarks, saving the results for comparison across commits.
+
+    Pass pytest-benchmark options after `--`, e.g.
+    `nox -s benchmarks -- --benchmark-compare` to compare with the last saved run.
+    """
+    session.install(".")
+    session.install("pytest", "pytest-benchmark")
+    session.run(
+        "pytest",
+        "benchmarks",
+        "-o",
+        "python_files=bench_*.py",
+        "-p",
+        "no:cacheprovider",
+        "--benchmark-autosave",
+        "--benchmark-columns=min,median,mean,max,rounds",
+        *session.posargs,
+    )
+
+
 @session(python=python_version_default, reuse_venv=True)
 def coverage(session: Session) -> None:
     """Produce the coverage report."""
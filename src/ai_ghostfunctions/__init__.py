@@ -1,8 +1,58 @@
 """AI Ghostfunctions."""
 
+from . import aggregators
+from . import backends
+from . import batching
+from . import bulk
+from . import cache
+from . import cassette
+from . import clients
+from . import hedging
+from . import instrumentation
 from . import keywords
+from . import mapreduce
+from . import offload
+from . import ratelimit
+from . import routing
+from . import schema
+from . import semantic_cache
+from . import singleflight
+from . import streaming
+from . import templates
+from . import testing
+from . import tokens
 from . import types
+from . import validators
+from .ghostfunctions import AsyncGhostFunction
+from .ghostfunctions import GhostFunction
 from .ghostfunctions import ghostfunction
 
 
-__all__ = ["keywords", "types", "ghostfunction"]
+__all__ = [
+    "aggregators",
+    "backends",
+    "batching",
+    "bulk",
+    "cache",
+    "cassette",
+    "clients",
+    "hedging",
+    "instrumentation",
+    "keywords",
+    "mapreduce",
+    "offload",
+    "ratelimit",
+    "routing",
+    "schema",
+    "semantic_cache",
+    "singleflight",
+    "streaming",
+    "templates",
+    "tokens",
+    "testing",
+    "types",
+    "validators",
+    "ghostfunction",
+    "GhostFunction",
+    "AsyncGhostFunction",
+]
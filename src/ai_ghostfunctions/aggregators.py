@@ -0,0 +1,254 @@
+"""Aggregation functions that can decide before all `n` choices have arrived.
+
+Passing one of these as the `aggregation_function` of a ghostfunction called with
+`n` > 1 makes the ghostfunction collect choices one at a time, either from `n`
+concurrent single-choice requests or from one streamed `n`-choice request, and
+stop (cancelling the outstanding work) as soon as the result is decided.
+
+They remain plain callables on a list of parsed choices, so they can also be used
+wherever an ordinary aggregation function is expected.
+"""
+
+import abc
+from collections import Counter
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Literal
+from typing import NoReturn
+from typing import Optional
+from typing import Tuple
+
+from .validators import Validator
+
+
+Strategy = Literal["concurrent", "stream"]
+
+
+class IncrementalAggregator(abc.ABC):
+    """Base class for aggregators that can finish early.
+
+    Args:
+        strategy: How the choices are produced. `"concurrent"` sends `n` requests
+            with `n=1` at once; `"stream"` sends a single streamed request with `n`
+            choices and stops the stream once the result is decided.
+    """
+
+    def __init__(self, strategy: Strategy = "concurrent") -> None:
+        """Create the aggregator."""
+        if strategy not in ("concurrent", "stream"):
+            raise ValueError(f"Unknown strategy {strategy!r}.")
+        self.strategy = strategy
+
+    @abc.abstractmethod
+    def decide(self, values: List[Any], remaining: int) -> Tuple[bool, Any]:
+        """Decide whether the choices seen so far determine the result.
+
+        Args:
+            values: The valid choices received so far, in arrival order.
+            remaining: How many choices are still outstanding.
+
+        Returns:
+            A tuple `(done, result)`. `result` is only meaningful when `done` is True.
+
+        # noqa: DAR202
+        """
+
+    def __call__(self, values: List[Any]) -> Any:
+        """Aggregate a complete list of choices.
+
+        Args:
+            values: Every valid choice.
+
+        Returns:
+            The aggregated result.
+        """
+        done, result = self.decide(list(values), remaining=0)
+        return result
+
+
+def _key(value: Any) -> Any:
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+def _counts(values: List[Any]) -> List[Tuple[Any, int]]:
+    """Return `(value, votes)` pairs, most votes first, ties broken by arrival."""
+    counter = Counter(_key(v) for v in values)
+    first: Dict[Any, Any] = {}
+    for v in values:
+        first.setdefault(_key(v), v)
+    return [(first[k], c) for k, c in counter.most_common()]
+
+
+class FirstValid(IncrementalAggregator):
+    """Return the first choice that parses and passes validation."""
+
+    def decide(self, values: List[Any], remaining: int) -> Tuple[bool, Any]:
+        """Finish as soon as one valid choice has arrived.
+
+        Args:
+            values: The valid choices received so far.
+            remaining: How many choices are still outstanding.
+
+        Returns:
+            `(True, first value)` once a value exists, otherwise `(False, None)`.
+
+        Raises:
+            ValueError: If no choices remain and none were valid.
+        """
+        if values:
+            return True, values[0]
+        if remaining == 0:
+            raise ValueError("None of the choices were valid.")
+        return False, None
+
+
+class MajorityVote(IncrementalAggregator):
+    """Return the most common choice, stopping once no other choice can catch up."""
+
+    def decide(self, values: List[Any], remaining: int) -> Tuple[bool, Any]:
+        """Finish once the leader's margin exceeds the number of outstanding choices.
+
+        Args:
+            values: The valid choices received so far.
+            remaining: How many choices are still outstanding.
+
+        Returns:
+            `(True, leader)` once the vote is decided, otherwise `(False, None)`.
+
+        Raises:
+            ValueError: If no choices remain and none were valid.
+        """
+        counts = _counts(values)
+        if not counts:
+            if remaining == 0:
+                raise ValueError("None of the choices were valid.")
+            return False, None
+        leader, votes = counts[0]
+        runner_up = counts[1][1] if len(counts) > 1 else 0
+        if votes - runner_up > remaining or remaining == 0:
+            return True, leader
+        return False, None
+
+
+class Quorum(IncrementalAggregator):
+    """Return the first choice that `k` choices agree on.
+
+    Args:
+        k: The number of agreeing choices required.
+        strategy: See `IncrementalAggregator`.
+    """
+
+    def __init__(self, k: int, strategy: Strategy = "concurrent") -> None:
+        """Create the aggregator."""
+        super().__init__(strategy)
+        if k < 1:
+            raise ValueError("k must be at least 1.")
+        self.k = k
+
+    def decide(self, values: List[Any], remaining: int) -> Tuple[bool, Any]:
+        """Finish once some value has `k` votes.
+
+        Args:
+            values: The valid choices received so far.
+            remaining: How many choices are still outstanding.
+
+        Returns:
+            `(True, value)` once a value reaches the quorum, otherwise `(False, None)`.
+
+        Raises:
+            ValueError: If a quorum can no longer be reached.
+        """
+        counts = _counts(values)
+        if counts and counts[0][1] >= self.k:
+            return True, counts[0][0]
+        if (counts[0][1] if counts else 0) + remaining < self.k:
+            raise ValueError(f"The choices cannot reach a quorum of {self.k}.")
+        return False, None
+
+
+first_valid = FirstValid()
+majority_vote = MajorityVote()
+
+
+def quorum(k: int, strategy: Strategy = "concurrent") -> Quorum:
+    """Return an aggregator requiring `k` agreeing choices.
+
+    Args:
+        k: The number of agreeing choices required.
+        strategy: See `IncrementalAggregator`.
+
+    Returns:
+        The aggregator.
+    """
+    return Quorum(k, strategy)
+
+
+class Tally:
+    """Feed choices to an aggregator as they arrive, until it has decided.
+
+    Args:
+        n: The total number of choices.
+        validator: The validator of the ghostfunction's return type.
+        aggregator: The aggregator deciding the result.
+    """
+
+    def __init__(
+        self, n: int, validator: Validator, aggregator: IncrementalAggregator
+    ) -> None:
+        """Create an empty tally."""
+        self.validator = validator
+        self.aggregator = aggregator
+        self.remaining = n
+        self.values: List[Any] = []
+        self.accepted: List[str] = []
+        self.result: Any = None
+        self._error: Optional[Exception] = None
+
+    def add(self, outcome: Any) -> bool:
+        """Record one choice.
+
+        Args:
+            outcome: The completion text of the choice, or the exception raised
+                while producing it.
+
+        If the aggregator gives up without a single valid choice, the last request
+        or parse error is raised instead of the aggregator's ValueError.
+
+        Returns:
+            Whether the result is decided. It is then available as `result`.
+        """
+        self.remaining = max(self.remaining - 1, 0)
+        if isinstance(outcome, Exception):
+            self._error = outcome
+        else:
+            try:
+                self.values.append(self.validator.parse(outcome))
+            except Exception as e:
+                self._error = e
+            else:
+                self.accepted.append(outcome)
+        try:
+            done, result = self.aggregator.decide(self.values, self.remaining)
+        except ValueError as e:
+            self._raise(e if self.values else None)
+        if done:
+            self.result = self.validator.coerce(result)
+        return done
+
+    def finish(self) -> NoReturn:
+        """Signal that the choices ran out before the result was decided.
+
+        The last request or parse error is raised, or a ValueError if there was none.
+        """
+        self._raise(None)
+
+    def _raise(self, preferred: Optional[Exception]) -> NoReturn:
+        error = preferred or self._error
+        if error is None:
+            raise ValueError("No choices were received.")
+        raise error
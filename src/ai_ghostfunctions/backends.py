@@ -0,0 +1,406 @@
+"""Backends answering ghostfunction requests: the OpenAI API, or a local model.
+
+A backend takes requests shaped like the keyword arguments of the OpenAI chat
+completions API (`messages`, `model`, `n`, `stream`, ...) and answers them with
+`ChatCompletion`s, or with iterators of `ChatCompletionChunk`s for `stream=True`,
+synchronously (`complete`) or asynchronously (`acomplete`). Batch-capable backends
+also answer many requests at once (`complete_batch`), which `GhostFunction.map`
+uses to send a whole batch of argument sets in one go::
+
+    backend = LocalModelBackend(generate, max_batch_size=64)
+
+    @ghostfunction(backend=backend)
+    def sentiment(text: str) -> str:
+        '''Return "positive" or "negative".'''
+
+    labels = list(sentiment.map(texts))  # 64 prompts per call of `generate`
+
+- `OpenAIBackend` sends requests to the OpenAI API with the shared clients (see
+  `ai_ghostfunctions.clients`) and model fallback (see `ai_ghostfunctions.routing`),
+  like the default `ai_callable`.
+- `OpenAICompatibleBackend` sends them to a server implementing the same API, such
+  as vLLM, llama.cpp or Ollama running locally.
+- `LocalModelBackend` runs a model in-process: a function turning a batch of
+  prompts into completion texts, e.g. one forward pass of a Hugging Face pipeline.
+
+Subclass `Backend` to add another one.
+"""
+
+import abc
+import json
+import threading
+from contextvars import copy_context
+from functools import partial
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Mapping
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from .clients import get_async_client
+from .clients import get_client
+from .routing import get_router
+from .tokens import count_tokens
+from .tokens import get_tokenizer
+from .types import Message
+
+
+if TYPE_CHECKING:  # imported on first use to keep `import ai_ghostfunctions` fast
+    from openai.types.chat.chat_completion import ChatCompletion
+    from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+
+Generate = Callable[[List[List[Message]], Dict[str, Any]], Sequence[str]]
+
+
+def make_completion(
+    texts: Sequence[str], model: str, usage: Optional[Mapping[str, int]] = None
+) -> "ChatCompletion":
+    """Return a `ChatCompletion` with one choice per text.
+
+    Args:
+        texts: The completion texts.
+        model: The model reported in the completion.
+        usage: The token counts reported in the completion, if any.
+
+    Returns:
+        The completion.
+    """
+    from openai.types.chat.chat_completion import ChatCompletion
+
+    return ChatCompletion.model_construct(
+        id=f"{model}-completion",
+        object="chat.completion",
+        created=0,
+        model=model,
+        choices=[
+            {
+                "index": i,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": text},
+            }
+            for i, text in enumerate(texts)
+        ],
+        usage=dict(usage) if usage is not None else None,
+    )
+
+
+def make_chunks(
+    texts: Sequence[str], model: str, chunk_size: int = 16
+) -> Iterator["ChatCompletionChunk"]:
+    """Return the texts as a stream of `ChatCompletionChunk`s, one choice after another.
+
+    Args:
+        texts: The completion texts.
+        model: The model reported in the chunks.
+        chunk_size: Characters per chunk.
+
+    Yields:
+        The chunks.
+    """
+    from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+
+    for index, text in enumerate(texts):
+        pieces = [text[i : i + chunk_size] for i in range(0, len(text), chunk_size)]
+        pieces = pieces or [""]
+        for position, piece in enumerate(pieces):
+            last = position == len(pieces) - 1
+            yield ChatCompletionChunk.model_construct(
+                id=f"{model}-completion",
+                object="chat.completion.chunk",
+                created=0,
+                model=model,
+                choices=[
+                    {
+                        "index": index,
+                        "delta": {"content": piece},
+                        "finish_reason": "stop" if last else None,
+                    }
+                ],
+            )
+
+
+class Backend(abc.ABC):
+    """Base class of backends.
+
+    Subclasses implement `complete`; the other methods default to calling it, in a
+    worker thread for the async ones. Batch-capable subclasses set
+    `supports_batch` and override `complete_batch`.
+
+    Attributes:
+        supports_batch: Whether `complete_batch` answers a batch more efficiently
+            than one request at a time, so `map` should send batches.
+        supports_streaming: Whether `stream=True` responses arrive as they are
+            generated, rather than in one go at the end.
+        max_batch_size: The largest batch `map` sends at once.
+    """
+
+    supports_batch = False
+    supports_streaming = True
+    max_batch_size = 1
+
+    def __call__(self, **kwargs: Any) -> Any:
+        """Answer a request, so a backend can be used as an `ai_callable`.
+
+        Args:
+            kwargs: The keyword arguments of the request.
+
+        Returns:
+            The response of `complete`.
+        """
+        return self.complete(**kwargs)
+
+    @abc.abstractmethod
+    def complete(self, **kwargs: Any) -> Any:
+        """Answer a request.
+
+        Args:
+            kwargs: The keyword arguments of the request.
+
+        Returns:
+            A `ChatCompletion`, or an iterator of `ChatCompletionChunk`s if
+            `stream=True`.
+
+        # noqa: DAR202
+        """
+
+    async def acomplete(self, **kwargs: Any) -> Any:
+        """Answer a request without blocking the event loop.
+
+        Args:
+            kwargs: The keyword arguments of the request.
+
+        Returns:
+            The response of `complete`, run in the loop's default executor.
+        """
+        return await _in_thread(partial(self.complete, **kwargs))
+
+    def complete_batch(self, requests: Sequence[Dict[str, Any]]) -> List[Any]:
+        """Answer several requests.
+
+        Args:
+            requests: The keyword arguments of each request.
+
+        Returns:
+            The response to each request, in order.
+        """
+        return [self.complete(**request) for request in requests]
+
+    async def acomplete_batch(self, requests: Sequence[Dict[str, Any]]) -> List[Any]:
+        """Answer several requests without blocking the event loop.
+
+        Args:
+            requests: The keyword arguments of each request.
+
+        Returns:
+            The response to each request, in order.
+        """
+        responses: List[Any] = await _in_thread(partial(self.complete_batch, requests))
+        return responses
+
+
+async def _in_thread(function: Callable[[], Any]) -> Any:
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, copy_context().run, function)
+
+
+class OpenAIBackend(Backend):
+    """Send requests to the OpenAI API.
+
+    A `model` given as a list of names is tried in order (see
+    `ai_ghostfunctions.routing`).
+
+    Args:
+        api_key: The OpenAI API key. Defaults to the env var `OPENAI_API_KEY`.
+    """
+
+    def __init__(self, api_key: Optional[str] = None) -> None:
+        """Create the backend; clients are shared and created on first use."""
+        self.api_key = api_key
+
+    def complete(self, **kwargs: Any) -> Any:
+        """Send a request.
+
+        Args:
+            kwargs: The keyword arguments of `client.chat.completions.create`.
+
+        Returns:
+            The `ChatCompletion`, or a stream of chunks if `stream=True`.
+        """
+        create = get_client(self.api_key).chat.completions.create
+        return get_router().call(create, kwargs)
+
+    async def acomplete(self, **kwargs: Any) -> Any:
+        """Send a request with the async client.
+
+        Args:
+            kwargs: The keyword arguments of `client.chat.completions.create`.
+
+        Returns:
+            The `ChatCompletion`, or a stream of chunks if `stream=True`.
+        """
+        create = get_async_client(self.api_key).chat.completions.create
+        return await get_router().acall(create, kwargs)
+
+
+class OpenAICompatibleBackend(Backend):
+    """Send requests to a server implementing the OpenAI chat completions API.
+
+    Args:
+        base_url: The URL of the API, e.g. `"http://localhost:8000/v1"`.
+        model: The model used by requests that do not name one.
+        api_key: The key sent to the server. Servers that do not check keys accept
+            any value.
+    """
+
+    def __init__(
+        self, base_url: str, model: Optional[str] = None, api_key: str = "EMPTY"
+    ) -> None:
+        """Create the backend; clients are shared and created on first use."""
+        self.base_url = base_url
+        self.model = model
+        self.api_key = api_key
+
+    def _request(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        if self.model is None or "model" in kwargs:
+            return kwargs
+        return {"model": self.model, **kwargs}
+
+    def complete(self, **kwargs: Any) -> Any:
+        """Send a request.
+
+        Args:
+            kwargs: The keyword arguments of `client.chat.completions.create`.
+
+        Returns:
+            The `ChatCompletion`, or a stream of chunks if `stream=True`.
+        """
+        client = get_client(self.api_key, self.base_url)
+        return client.chat.completions.create(**self._request(kwargs))
+
+    async def acomplete(self, **kwargs: Any) -> Any:
+        """Send a request with the async client.
+
+        Args:
+            kwargs: The keyword arguments of `client.chat.completions.create`.
+
+        Returns:
+            The `ChatCompletion`, or a stream of chunks if `stream=True`.
+        """
+        client = get_async_client(self.api_key, self.base_url)
+        return await client.chat.completions.create(**self._request(kwargs))
+
+
+# request parameters that do not change how a model generates text
+_NOT_GENERATION_PARAMETERS = frozenset({"messages", "n", "stream", "model"})
+
+
+class LocalModelBackend(Backend):
+    """Run a model in-process, answering a batch of requests with one call.
+
+    Args:
+        generate: A function of a list of prompts (each a list of messages) and the
+            generation parameters of the requests (`temperature`, `max_tokens`, ...)
+            returning one completion text per prompt. A request for `n` choices
+            contributes its prompt `n` times. Calls are serialized, so `generate`
+            need not be thread-safe.
+        model: The model name reported in responses and used to count tokens.
+        max_batch_size: The maximum number of prompts passed to `generate` at once.
+        chunk_size: Characters per chunk of `stream=True` responses, which are
+            streamed once the whole text has been generated.
+
+    Raises:
+        ValueError: If `max_batch_size` is less than 1.
+    """
+
+    supports_batch = True
+    supports_streaming = False
+
+    def __init__(
+        self,
+        generate: Generate,
+        model: str = "local",
+        max_batch_size: int = 32,
+        chunk_size: int = 16,
+    ) -> None:
+        """Create the backend."""
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1.")
+        self.generate = generate
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+
+    def complete(self, **kwargs: Any) -> Any:
+        """Answer a request.
+
+        Args:
+            kwargs: The keyword arguments of the request.
+
+        Returns:
+            A `ChatCompletion`, or an iterator of `ChatCompletionChunk`s if
+            `stream=True`.
+        """
+        return self.complete_batch([kwargs])[0]
+
+    def complete_batch(self, requests: Sequence[Dict[str, Any]]) -> List[Any]:
+        """Answer requests with as few calls of `generate` as possible.
+
+        Requests with the same generation parameters are generated together, in
+        batches of up to `max_batch_size` prompts.
+
+        Args:
+            requests: The keyword arguments of each request.
+
+        Returns:
+            The response to each request, in order.
+        """
+        texts: List[List[str]] = [[] for _ in requests]
+        groups: Dict[str, Tuple[Dict[str, Any], List[int]]] = {}
+        for i, request in enumerate(requests):
+            params = {
+                k: v for k, v in request.items() if k not in _NOT_GENERATION_PARAMETERS
+            }
+            key = json.dumps(params, sort_keys=True, default=repr)
+            groups.setdefault(key, (params, []))[1].append(i)
+        for params, indices in groups.values():
+            owners = [i for i in indices for _ in range(requests[i].get("n") or 1)]
+            for start in range(0, len(owners), self.max_batch_size):
+                batch = owners[start : start + self.max_batch_size]
+                prompts = [list(requests[i]["messages"]) for i in batch]
+                generated = self._generate(prompts, params)
+                for i, text in zip(batch, generated):  # noqa: B905
+                    texts[i].append(text)
+        answered = zip(requests, texts)  # noqa: B905
+        return [self._respond(request, t) for request, t in answered]
+
+    def _generate(
+        self, prompts: List[List[Message]], params: Dict[str, Any]
+    ) -> List[str]:
+        with self._lock:
+            generated = list(self.generate(prompts, dict(params)))
+        if len(generated) != len(prompts):
+            raise ValueError(
+                f"generate returned {len(generated)} texts for {len(prompts)} prompts."
+            )
+        return generated
+
+    def _respond(self, request: Dict[str, Any], texts: List[str]) -> Any:
+        if request.get("stream"):
+            return make_chunks(texts, self.model, self.chunk_size)
+        tokenizer = get_tokenizer(self.model)
+        prompt_tokens = count_tokens(request["messages"], self.model)
+        completion_tokens = sum(tokenizer.count(text) for text in texts)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        return make_completion(texts, self.model, usage)
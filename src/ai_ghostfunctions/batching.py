@@ -0,0 +1,265 @@
+"""Micro-batching of concurrent ghostfunction calls for batch-capable backends.
+
+`GhostFunction.map` sends batches to a batch-capable backend (see
+`ai_ghostfunctions.backends`) on its own, but calls made one at a time, e.g. by
+the request handlers of a web server, each reach the backend alone. A
+`MicroBatcher` wraps the backend and collects the requests of concurrent calls:
+the first request of a batch waits up to `max_wait` seconds for others to join it,
+then the batch (of at most `max_batch_size` requests) is sent with one call of the
+backend's `complete_batch`, and each caller receives its own response::
+
+    backend = MicroBatcher(LocalModelBackend(generate, max_batch_size=32), max_wait=0.01)
+
+    @ghostfunction(backend=backend)
+    def sentiment(text: str) -> str:
+        '''Return "positive" or "negative".'''
+
+Batches are sent one at a time by a background thread, so a batch fills up with
+the requests arriving while the previous one runs. `stats` reports how full the
+batches are and how long requests wait to be sent, the two quantities to trade
+off when choosing `max_wait`.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import Deque
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+
+from .backends import Backend
+
+
+if TYPE_CHECKING:  # imported on first use to keep `import ai_ghostfunctions` fast
+    from concurrent.futures import Future
+
+
+@dataclass(frozen=True)
+class BatchStats:
+    """Counters describing the batches a `MicroBatcher` has sent."""
+
+    batches: int = 0
+    requests: int = 0
+    mean_fill: float = 0.0
+    mean_delay: float = 0.0
+    max_delay: float = 0.0
+
+
+class _Pending:
+    """A request waiting in the queue, and the future of its response."""
+
+    __slots__ = ("request", "future", "enqueued")
+
+    def __init__(self, request: Dict[str, Any], future: "Future[Any]") -> None:
+        self.request = request
+        self.future = future
+        self.enqueued = time.monotonic()
+
+
+class MicroBatcher(Backend):
+    """Send the requests of concurrent calls to a backend in batches.
+
+    Streamed requests are passed to the backend directly, as are the batches `map`
+    already makes.
+
+    Args:
+        backend: The backend answering the batches.
+        max_batch_size: The most requests sent at once. Defaults to the backend's
+            `max_batch_size`.
+        max_wait: Seconds the first request of a batch waits for others.
+
+    Raises:
+        ValueError: If `max_batch_size` is less than 1 or `max_wait` is negative.
+    """
+
+    supports_batch = True
+
+    def __init__(
+        self,
+        backend: Backend,
+        max_batch_size: Optional[int] = None,
+        max_wait: float = 0.005,
+    ) -> None:
+        """Create the batcher; its thread is started by the first request."""
+        self.backend = backend
+        self.max_batch_size = max_batch_size or backend.max_batch_size
+        if self.max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1.")
+        if max_wait < 0:
+            raise ValueError("max_wait must not be negative.")
+        self.max_wait = max_wait
+        self.supports_streaming = backend.supports_streaming
+        self._condition = threading.Condition()
+        self._queue: Deque[_Pending] = deque()
+        self._thread: Optional[threading.Thread] = None
+        self._pid = os.getpid()
+        self._closed = False
+        self._batches = 0
+        self._requests = 0
+        self._fill = 0.0
+        self._delay = 0.0
+        self._max_delay = 0.0
+
+    @property
+    def stats(self) -> BatchStats:
+        """Batch fill (the fraction of `max_batch_size` used) and queueing delays."""
+        with self._condition:
+            batches = self._batches or 1
+            return BatchStats(
+                batches=self._batches,
+                requests=self._requests,
+                mean_fill=self._fill / batches,
+                mean_delay=self._delay / (self._requests or 1),
+                max_delay=self._max_delay,
+            )
+
+    def submit(self, request: Dict[str, Any]) -> "Future[Any]":
+        """Queue a request for the next batch.
+
+        Args:
+            request: The keyword arguments of the request.
+
+        Returns:
+            The future of the response.
+        """
+        from concurrent.futures import Future
+
+        future: "Future[Any]" = Future()
+        with self._condition:
+            self._start()
+            self._queue.append(_Pending(request, future))
+            self._condition.notify()
+        return future
+
+    def _start(self) -> None:
+        if self._closed:
+            raise RuntimeError("The MicroBatcher is closed.")
+        if self._pid != os.getpid():
+            # forked: the queue and the thread belong to the parent process
+            self._queue.clear()
+            self._thread = None
+            self._pid = os.getpid()
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._dispatch, name="ghostfunction-batcher", daemon=True
+            )
+            self._thread.start()
+
+    def complete(self, **kwargs: Any) -> Any:
+        """Answer a request as part of a batch.
+
+        Args:
+            kwargs: The keyword arguments of the request.
+
+        Returns:
+            The backend's response to the request.
+        """
+        if kwargs.get("stream"):
+            return self.backend.complete(**kwargs)
+        return self.submit(kwargs).result()
+
+    async def acomplete(self, **kwargs: Any) -> Any:
+        """Answer a request as part of a batch, without blocking the event loop.
+
+        Args:
+            kwargs: The keyword arguments of the request.
+
+        Returns:
+            The backend's response to the request.
+        """
+        import asyncio
+
+        if kwargs.get("stream"):
+            return await self.backend.acomplete(**kwargs)
+        return await asyncio.wrap_future(self.submit(kwargs))
+
+    def complete_batch(self, requests: Sequence[Dict[str, Any]]) -> List[Any]:
+        """Send a batch to the backend directly.
+
+        Args:
+            requests: The keyword arguments of each request.
+
+        Returns:
+            The response to each request, in order.
+        """
+        return self.backend.complete_batch(requests)
+
+    async def acomplete_batch(self, requests: Sequence[Dict[str, Any]]) -> List[Any]:
+        """Send a batch to the backend directly, without blocking the event loop.
+
+        Args:
+            requests: The keyword arguments of each request.
+
+        Returns:
+            The response to each request, in order.
+        """
+        return await self.backend.acomplete_batch(requests)
+
+    def close(self) -> None:
+        """Send the queued requests, then stop the thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _dispatch(self) -> None:
+        batch = self._next_batch()
+        while batch:
+            self._send(batch)
+            batch = self._next_batch()
+
+    def _next_batch(self) -> List[_Pending]:
+        """Wait for a batch to fill up or for its deadline; empty once closed."""
+        with self._condition:
+            while not self._queue and not self._closed:
+                self._condition.wait()
+            if self._queue:
+                deadline = self._queue[0].enqueued + self.max_wait
+                while len(self._queue) < self.max_batch_size and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+            size = min(len(self._queue), self.max_batch_size)
+            batch = [self._queue.popleft() for _ in range(size)]
+            self._record(batch)
+            return batch
+
+    def _record(self, batch: List[_Pending]) -> None:
+        if not batch:
+            return
+        now = time.monotonic()
+        delays = [now - pending.enqueued for pending in batch]
+        self._batches += 1
+        self._requests += len(batch)
+        self._fill += len(batch) / self.max_batch_size
+        self._delay += sum(delays)
+        self._max_delay = max(self._max_delay, *delays)
+
+    def _send(self, batch: List[_Pending]) -> None:
+        batch = [p for p in batch if p.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            responses = self.backend.complete_batch([p.request for p in batch])
+        except Exception as e:
+            for pending in batch:
+                pending.future.set_exception(e)
+            return
+        if len(responses) != len(batch):
+            error = ValueError(
+                f"The backend answered {len(responses)} of {len(batch)} requests."
+            )
+            for pending in batch:
+                pending.future.set_exception(error)
+            return
+        for pending, response in zip(batch, responses):  # noqa: B905
+            pending.future.set_result(response)
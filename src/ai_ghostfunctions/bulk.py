@@ -0,0 +1,373 @@
+"""Offline bulk runs of a ghostfunction through the OpenAI Batch API.
+
+For jobs over many argument sets where latency does not matter, the Batch API
+answers requests within 24 hours at a lower price and outside the usual rate
+limits. A `BulkJob` renders the prompts of all argument sets with the
+ghostfunction's `prompt_function`, writes them to JSONL batch files of up to
+`batch_size` requests, submits them, polls until they are done, and yields the
+parsed results::
+
+    job = BulkJob(classify, "jobs/nightly-classify")
+    for index, label in job.run(records):
+        ...
+
+The directory is a checkpoint: it holds the batch files, the id of every submitted
+batch and the responses of every finished one. Running the job again with the same
+argument sets (e.g. after a crash) submits only the batches that were never
+submitted, waits for those in flight, and reads finished ones from disk.
+
+The service is reached through a `BatchClient`: `OpenAIBatchClient` by default, or
+`LocalBatchClient`, which answers batch files in-process with any `ai_callable`
+(e.g. `ai_ghostfunctions.testing.FakeAI` in tests).
+"""
+
+import itertools
+import json
+import os
+import threading
+import time
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Final
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Protocol
+from typing import Tuple
+from typing import Union
+
+from .clients import get_client
+from .ghostfunctions import GhostFunction
+from .ghostfunctions import _as_call_arguments
+from .ghostfunctions import _completion_contents
+from .tokens import DEFAULT_MODEL
+from .tokens import model_name
+
+
+if TYPE_CHECKING:  # imported on first use to keep `import ai_ghostfunctions` fast
+    import openai
+
+ENDPOINT: Final = "/v1/chat/completions"
+# statuses after which a batch does not change anymore
+FINISHED = frozenset({"completed", "failed", "expired", "cancelled"})
+
+
+class BulkJobError(RuntimeError):
+    """A batch failed, or one of its requests did."""
+
+
+class BatchClient(Protocol):
+    """Submits batch files to a batch service and fetches their results."""
+
+    def submit(self, path: str) -> str:  # noqa: DAR202
+        """Upload a JSONL batch file and start the batch.
+
+        Args:
+            path: The location of the file.
+        """
+
+    def status(self, batch_id: str) -> str:  # noqa: DAR202
+        """Return the status of a batch, e.g. `"in_progress"` or `"completed"`.
+
+        Args:
+            batch_id: The id returned by `submit`.
+        """
+
+    def results(self, batch_id: str) -> Iterable[str]:  # noqa: DAR202
+        """Return the JSONL lines of the responses of a finished batch.
+
+        Args:
+            batch_id: The id returned by `submit`.
+        """
+
+
+class OpenAIBatchClient:
+    """The OpenAI Batch API.
+
+    Args:
+        api_key: The OpenAI API key. Defaults to the env var `OPENAI_API_KEY`.
+    """
+
+    def __init__(self, api_key: Optional[str] = None) -> None:
+        """Create the client; the shared OpenAI client is used."""
+        self.api_key = api_key
+
+    def _client(self) -> "openai.OpenAI":
+        # these requests do not pass through the scheduler, so the client retries
+        return get_client(self.api_key).with_options(max_retries=2)
+
+    def submit(self, path: str) -> str:
+        """Upload a JSONL batch file and start the batch.
+
+        Args:
+            path: The location of the file.
+
+        Returns:
+            The id of the batch.
+        """
+        client = self._client()
+        with open(path, "rb") as file:
+            uploaded = client.files.create(file=file, purpose="batch")
+        batch = client.batches.create(
+            input_file_id=uploaded.id, endpoint=ENDPOINT, completion_window="24h"
+        )
+        return batch.id
+
+    def status(self, batch_id: str) -> str:
+        """Return the status of a batch.
+
+        Args:
+            batch_id: The id of the batch.
+
+        Returns:
+            The status, e.g. `"in_progress"` or `"completed"`.
+        """
+        return self._client().batches.retrieve(batch_id).status
+
+    def results(self, batch_id: str) -> Iterator[str]:
+        """Stream the response lines of a finished batch, failed requests included.
+
+        Args:
+            batch_id: The id of the batch.
+
+        Yields:
+            The lines of the batch's output file, then of its error file.
+        """
+        client = self._client()
+        batch = client.batches.retrieve(batch_id)
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                with client.files.with_streaming_response.content(file_id) as response:
+                    yield from response.iter_lines()
+
+
+class LocalBatchClient:
+    """A batch service answering batch files in-process, for tests and local models.
+
+    Args:
+        ai_callable: Answers the requests of the batch files.
+        pending_polls: How many times `status` reports a batch as in progress before
+            reporting it completed.
+    """
+
+    def __init__(self, ai_callable: Callable[..., Any], pending_polls: int = 0) -> None:
+        """Create the service."""
+        self.ai_callable = ai_callable
+        self.pending_polls = pending_polls
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._batches: Dict[str, List[str]] = {}
+        self._polls: Dict[str, int] = {}
+        self.submitted = 0
+
+    def submit(self, path: str) -> str:
+        """Answer every request of a batch file.
+
+        Args:
+            path: The location of the file.
+
+        Returns:
+            The id of the batch.
+        """
+        with open(path, encoding="utf-8") as file:
+            lines = [self._answer(json.loads(line)) for line in file if line.strip()]
+        with self._lock:
+            batch_id = f"local-batch-{next(self._ids)}"
+            self._batches[batch_id] = lines
+            self._polls[batch_id] = self.pending_polls
+            self.submitted += 1
+        return batch_id
+
+    def _answer(self, request: Dict[str, Any]) -> str:
+        line: Dict[str, Any] = {"custom_id": request["custom_id"]}
+        try:
+            completion = self.ai_callable(**request["body"])
+        except Exception as e:
+            line.update(response=None, error={"code": "error", "message": str(e)})
+        else:
+            body = completion.model_dump(mode="json", exclude_none=True, warnings=False)
+            line.update(response={"status_code": 200, "body": body}, error=None)
+        return json.dumps(line)
+
+    def status(self, batch_id: str) -> str:
+        """Return the status of a batch.
+
+        Args:
+            batch_id: The id of the batch.
+
+        Returns:
+            `"in_progress"` for the first `pending_polls` calls, then `"completed"`.
+        """
+        with self._lock:
+            if self._polls[batch_id] > 0:
+                self._polls[batch_id] -= 1
+                return "in_progress"
+        return "completed"
+
+    def results(self, batch_id: str) -> List[str]:
+        """Return the response lines of a batch.
+
+        Args:
+            batch_id: The id of the batch.
+
+        Returns:
+            One JSONL line per request.
+        """
+        return list(self._batches[batch_id])
+
+
+def _write_atomically(path: str, lines: Iterable[str]) -> None:
+    temporary = f"{path}.tmp"
+    with open(temporary, "w", encoding="utf-8") as file:
+        for line in lines:
+            file.write(line.rstrip("\n") + "\n")
+    os.replace(temporary, path)
+
+
+class BulkJob:
+    """Run a ghostfunction over many argument sets with a batch service.
+
+    Args:
+        ghostfunction: The (sync) ghostfunction whose prompts, request parameters
+            and parsing are used.
+        directory: Where the batch files and the checkpoint are kept. Created if
+            missing.
+        client: The batch service. Defaults to `OpenAIBatchClient()`.
+        batch_size: The maximum number of requests per batch file.
+        poll_interval: Seconds between two status checks of a batch in progress.
+        sleep: The function waiting between status checks.
+
+    Raises:
+        ValueError: If `batch_size` is less than 1.
+    """
+
+    def __init__(
+        self,
+        ghostfunction: GhostFunction,
+        directory: Union[str, "os.PathLike[str]"],
+        client: Optional[BatchClient] = None,
+        batch_size: int = 50_000,
+        poll_interval: float = 60.0,
+        sleep: Callable[[float], Any] = time.sleep,
+    ) -> None:
+        """Create the job, or reopen the job saved in `directory`."""
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1.")
+        self.ghostfunction = ghostfunction
+        self.directory = os.fspath(directory)
+        self.client: BatchClient = client or OpenAIBatchClient()
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.sleep = sleep
+        os.makedirs(self.directory, exist_ok=True)
+        self._state_path = os.path.join(self.directory, "state.json")
+        self.state: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(self._state_path):
+            with open(self._state_path, encoding="utf-8") as file:
+                self.state = json.load(file)["batches"]
+
+    def run(self, iterable_of_args: Iterable[Any]) -> Iterator[Tuple[int, Any]]:
+        """Submit the argument sets not answered yet and yield every result.
+
+        All batches are submitted before the first one is waited for, so the
+        service works on them concurrently. A batch that failed or was cancelled
+        raises `BulkJobError`; running the job again submits it anew. The requests
+        an expired batch did not answer are yielded as errors.
+
+        Args:
+            iterable_of_args: The argument sets, as in `GhostFunction.map`. Pass the
+                same ones, in the same order, when resuming a job.
+
+        Yields:
+            `(index, result)` for each argument set, batch after batch, where index
+            is its position in `iterable_of_args`. If a request failed or its
+            response did not parse, the exception is yielded in place of the
+            result.
+        """
+        batches = self._submit_all(iterable_of_args)
+        for batch in batches:
+            yield from self._results(batch)
+
+    def _submit_all(self, iterable_of_args: Iterable[Any]) -> List[str]:
+        names = []
+        items = iter(iterable_of_args)
+        start = 0
+        chunk = list(itertools.islice(items, self.batch_size))
+        while chunk:
+            name = f"batch-{start // self.batch_size:06d}"
+            names.append(name)
+            if "id" not in self.state.get(name, {}):
+                self._submit(name, start, chunk)
+            start += len(chunk)
+            chunk = list(itertools.islice(items, self.batch_size))
+        return names
+
+    def _path(self, name: str, suffix: str) -> str:
+        return os.path.join(self.directory, f"{name}{suffix}")
+
+    def _submit(self, name: str, start: int, chunk: List[Any]) -> None:
+        gf = self.ghostfunction
+        body = dict(gf.ai_kwargs)
+        body["model"] = model_name(body) or DEFAULT_MODEL
+        lines = []
+        for index, item in enumerate(chunk, start):
+            args, kwargs = _as_call_arguments(item)
+            request = {
+                "custom_id": str(index),
+                "method": "POST",
+                "url": ENDPOINT,
+                "body": {"messages": gf._prompt(*args, **kwargs), **body},
+            }
+            lines.append(json.dumps(request))
+        path = self._path(name, ".jsonl")
+        _write_atomically(path, lines)
+        batch_id = self.client.submit(path)
+        self.state[name] = {"id": batch_id, "start": start, "count": len(chunk)}
+        self._save()
+
+    def _save(self) -> None:
+        _write_atomically(self._state_path, [json.dumps({"batches": self.state})])
+
+    def _results(self, name: str) -> Iterator[Tuple[int, Any]]:
+        entry = self.state[name]
+        output = self._path(name, ".out.jsonl")
+        if entry.get("status") != "completed":
+            self._wait(name, entry)
+            _write_atomically(output, self.client.results(entry["id"]))
+            entry["status"] = "completed"
+            self._save()
+        responses: Dict[int, Dict[str, Any]] = {}
+        with open(output, encoding="utf-8") as file:
+            for line in file:
+                response = json.loads(line)
+                responses[int(response["custom_id"])] = response
+        for index in range(entry["start"], entry["start"] + entry["count"]):
+            yield index, self._parse(responses.get(index))
+
+    def _wait(self, name: str, entry: Dict[str, Any]) -> None:
+        status = self.client.status(entry["id"])
+        while status not in FINISHED:
+            self.sleep(self.poll_interval)
+            status = self.client.status(entry["id"])
+        if status in ("failed", "cancelled"):
+            # forget the batch, so running the job again submits it anew
+            del self.state[name]
+            self._save()
+            raise BulkJobError(f"Batch {entry['id']} ({name}) {status}.")
+
+    def _parse(self, response: Optional[Dict[str, Any]]) -> Any:
+        from openai.types.chat.chat_completion import ChatCompletion
+
+        if response is None:
+            return BulkJobError("The batch returned no response for this request.")
+        error = response.get("error")
+        if error or (response.get("response") or {}).get("status_code") != 200:
+            return BulkJobError(f"The request failed: {error!r}")
+        completion = ChatCompletion.model_construct(**response["response"]["body"])
+        try:
+            return self.ghostfunction._parse(_completion_contents(completion))
+        except Exception as e:
+            return e
@@ -0,0 +1,344 @@
+"""Response caches for ghostfunctions.
+
+A cache stores the raw completion text returned by the AI (one string per choice),
+keyed on the messages produced by the `prompt_function` and the keyword arguments
+passed to the `ai_callable`. Parsing into python data structures happens after the
+cache lookup, so a cached response is validated exactly like a fresh one.
+"""
+
+import abc
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+from typing import List
+from typing import Mapping
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Union
+
+from .types import Message
+
+
+@dataclass(frozen=True)
+class CacheStats:
+    """Counters describing how a cache has been used."""
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+
+def make_cache_key(messages: Sequence[Message], params: Mapping[str, Any]) -> str:
+    """Return a stable key for a prompt and the parameters sent with it.
+
+    Args:
+        messages: The messages produced by the `prompt_function`.
+        params: The extra keyword arguments sent to the `ai_callable` (model, n, ...).
+
+    Returns:
+        A hex digest identifying the request.
+    """
+    payload = json.dumps(
+        {"messages": list(messages), "params": dict(params)},
+        sort_keys=True,
+        default=repr,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class BaseCache(abc.ABC):
+    """Base class for ghostfunction response caches.
+
+    Subclasses implement `_lookup`, `_store` and report evictions with
+    `_record_eviction`; the hit/miss bookkeeping is handled here. Caches storing
+    responses under the key of their request subclass `KeyedCache` instead, and
+    caches matching the request itself (see `ai_ghostfunctions.semantic_cache`)
+    subclass this class.
+    """
+
+    def __init__(self) -> None:
+        """Initialize the statistics counters."""
+        self._stats_lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(
+        self, messages: Sequence[Message], params: Mapping[str, Any]
+    ) -> Optional[List[str]]:
+        """Return the cached completion texts for a request, if any.
+
+        Args:
+            messages: The messages produced by the `prompt_function`.
+            params: The extra keyword arguments sent to the `ai_callable`.
+
+        Returns:
+            The cached completion texts, or None on a cache miss.
+        """
+        value = self._lookup(messages, params)
+        with self._stats_lock:
+            if value is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+        return value
+
+    def set(
+        self,
+        messages: Sequence[Message],
+        params: Mapping[str, Any],
+        value: List[str],
+    ) -> None:
+        """Store the completion texts for a request.
+
+        Args:
+            messages: The messages produced by the `prompt_function`.
+            params: The extra keyword arguments sent to the `ai_callable`.
+            value: The completion texts, one per choice.
+        """
+        self._store(messages, params, value)
+
+    @property
+    def stats(self) -> CacheStats:
+        """Hit, miss and eviction counters for this cache."""
+        with self._stats_lock:
+            return CacheStats(
+                hits=self._hits, misses=self._misses, evictions=self._evictions
+            )
+
+    def _record_eviction(self, count: int = 1) -> None:
+        with self._stats_lock:
+            self._evictions += count
+
+    @abc.abstractmethod
+    def _lookup(
+        self, messages: Sequence[Message], params: Mapping[str, Any]
+    ) -> Optional[List[str]]:
+        """Return the completion texts answering a request, or None."""
+
+    @abc.abstractmethod
+    def _store(
+        self, messages: Sequence[Message], params: Mapping[str, Any], value: List[str]
+    ) -> None:
+        """Store the completion texts for a request."""
+
+
+class KeyedCache(BaseCache):
+    """Base class for caches storing responses under the key of their request.
+
+    Subclasses implement `_get` and `_set`, which receive the `make_cache_key` of
+    the request.
+    """
+
+    def _lookup(
+        self, messages: Sequence[Message], params: Mapping[str, Any]
+    ) -> Optional[List[str]]:
+        return self._get(make_cache_key(messages, params))
+
+    def _store(
+        self, messages: Sequence[Message], params: Mapping[str, Any], value: List[str]
+    ) -> None:
+        self._set(make_cache_key(messages, params), value)
+
+    @abc.abstractmethod
+    def _get(self, key: str) -> Optional[List[str]]:
+        """Return the value stored under `key`, or None."""
+
+    @abc.abstractmethod
+    def _set(self, key: str, value: List[str]) -> None:
+        """Store `value` under `key`."""
+
+
+class InMemoryCache(KeyedCache):
+    """A thread-safe in-memory LRU cache with an optional time-to-live.
+
+    Args:
+        maxsize: The maximum number of responses to keep.
+        ttl: Seconds after which a response expires. `None` means never.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None) -> None:
+        """Create the cache."""
+        super().__init__()
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1.")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data: "OrderedDict[str, Tuple[float, List[str]]]" = OrderedDict()
+
+    def _get(self, key: str) -> Optional[List[str]]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self._record_eviction()
+                return None
+            self._data.move_to_end(key)
+            return list(value)
+
+    def _set(self, key: str, value: List[str]) -> None:
+        expires_at = float("inf") if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._data[key] = (expires_at, list(value))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._record_eviction()
+
+    def __len__(self) -> int:
+        """Return the number of responses currently stored."""
+        with self._lock:
+            return len(self._data)
+
+    def clear(self) -> None:
+        """Remove every response from the cache."""
+        with self._lock:
+            self._data.clear()
+
+
+class SQLiteCache(KeyedCache):
+    """An on-disk cache backed by SQLite, shareable between threads and processes.
+
+    Every thread (and every process, including forked children) opens its own
+    connection; SQLite's file locking serializes concurrent writers.
+
+    Args:
+        path: Location of the database file.
+        ttl: Seconds after which a response expires. `None` means never.
+        maxsize: The maximum number of responses to keep. `None` means unbounded.
+        timeout: Seconds to wait on a locked database before raising.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, "os.PathLike[str]"],
+        ttl: Optional[float] = None,
+        maxsize: Optional[int] = None,
+        timeout: float = 30.0,
+    ) -> None:
+        """Create the cache, initializing the database file if needed."""
+        super().__init__()
+        self.path = os.fspath(path)
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " accessed_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed_at"
+                " ON responses (accessed_at)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn: Optional[sqlite3.Connection] = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _get(self, key: str) -> Optional[List[str]]:
+        now = time.time()
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if self.ttl is not None and created_at + self.ttl < now:
+                deleted = conn.execute(
+                    "DELETE FROM responses WHERE key = ?", (key,)
+                ).rowcount
+                self._record_eviction(deleted)
+                return None
+            conn.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+        result: List[str] = json.loads(value)
+        return result
+
+    def _set(self, key: str, value: List[str]) -> None:
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses"
+                " (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            if self.maxsize is not None:
+                deleted = conn.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    " SELECT key FROM responses ORDER BY accessed_at DESC"
+                    " LIMIT -1 OFFSET ?)",
+                    (self.maxsize,),
+                ).rowcount
+                self._record_eviction(deleted)
+
+    def __len__(self) -> int:
+        """Return the number of responses currently stored."""
+        with self._connection() as conn:
+            count: int = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return count
+
+    def clear(self) -> None:
+        """Remove every response from the cache."""
+        with self._connection() as conn:
+            conn.execute("DELETE FROM responses")
+
+
+class TieredCache(BaseCache):
+    """Consult several caches in turn, e.g. an exact cache before a semantic one.
+
+    A hit in a later tier is copied into the earlier ones, so the next identical
+    request is answered by the first tier. Responses are stored in every tier.
+
+    Args:
+        tiers: The caches, cheapest and strictest first.
+
+    Raises:
+        ValueError: If no tier is given.
+    """
+
+    def __init__(self, *tiers: BaseCache) -> None:
+        """Create the cache."""
+        super().__init__()
+        if not tiers:
+            raise ValueError("TieredCache needs at least one tier.")
+        self.tiers = tiers
+
+    def _lookup(
+        self, messages: Sequence[Message], params: Mapping[str, Any]
+    ) -> Optional[List[str]]:
+        for i, tier in enumerate(self.tiers):
+            value = tier.get(messages, params)
+            if value is not None:
+                for earlier in self.tiers[:i]:
+                    earlier.set(messages, params, value)
+                return value
+        return None
+
+    def _store(
+        self, messages: Sequence[Message], params: Mapping[str, Any], value: List[str]
+    ) -> None:
+        for tier in self.tiers:
+            tier.set(messages, params, value)
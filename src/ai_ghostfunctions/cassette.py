@@ -0,0 +1,326 @@
+"""Record and replay AI responses, for fast and deterministic tests.
+
+A `Cassette` is an `ai_callable` that answers requests from responses recorded on
+disk, keyed on the request (the rendered messages and every other keyword
+argument). Requests it has not seen are sent to a real `ai_callable` and recorded,
+depending on the mode:
+
+- `"strict"` only replays: an unrecorded request raises `CassetteMiss`. Use it in CI.
+- `"record_new"` replays recorded requests and records new ones.
+- `"refresh"` sends every request and records the response again.
+
+::
+
+    cassette = Cassette("tests/cassettes/summaries", mode="record_new")
+
+    @ghostfunction(ai_callable=cassette)
+    def summarize(text: str) -> str:
+        '''Return a one sentence summary of `text`.'''
+
+`cassette.acall` is the same cassette as a coroutine function, for async
+ghostfunctions.
+
+A cassette is two files. `<path>` holds one JSON record per line, appended and
+never rewritten, so cassettes diff well under version control. `<path>.idx` holds a
+fixed-size entry per record (the SHA-256 of the request, and the offset and length
+of its record) and is memory-mapped to build the lookup table, so opening a
+cassette of thousands of responses does not parse any of them. The index can be
+deleted: it is rebuilt from the records. When a request is recorded twice, the
+last recording wins.
+
+Several processes may record into the same cassette: each record and its index
+entry are appended under an advisory lock on the data file, and every cassette
+picks up the entries other processes append. File locks need POSIX; on Windows,
+record from one process at a time.
+"""
+
+import inspect
+import json
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+from .cache import make_cache_key
+
+
+if TYPE_CHECKING:  # imported on first use to keep `import ai_ghostfunctions` fast
+    from openai.types.chat.chat_completion import ChatCompletion
+    from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+
+MODES = ("strict", "record_new", "refresh")
+
+# sha256 of the request, offset and length of its record in the data file
+_ENTRY = struct.Struct("<32sQI")
+
+
+class CassetteMiss(LookupError):
+    """Raised by a strict cassette for a request that was never recorded."""
+
+
+def request_key(kwargs: Dict[str, Any]) -> str:
+    """Return the key a request is recorded under.
+
+    Args:
+        kwargs: The keyword arguments of the request.
+
+    Returns:
+        A hex digest of the messages and the other keyword arguments.
+    """
+    params = {k: v for k, v in kwargs.items() if k != "messages"}
+    return make_cache_key(kwargs.get("messages") or [], params)
+
+
+def _dump(response: Any) -> Any:
+    if hasattr(response, "model_dump"):
+        return response.model_dump(mode="json", exclude_none=True, warnings=False)
+    if isinstance(response, dict):
+        return response
+    raise TypeError(f"Cannot record a response of type {type(response).__name__}.")
+
+
+def _completion(data: Any) -> Union["ChatCompletion", Dict[str, Any]]:
+    from openai.types.chat.chat_completion import ChatCompletion
+
+    if data.get("object") != "chat.completion":
+        return dict(data)
+    return ChatCompletion.model_construct(**data)
+
+
+def _chunks(data: List[Any]) -> Iterator["ChatCompletionChunk"]:
+    from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+
+    for chunk in data:
+        yield ChatCompletionChunk.model_construct(**chunk)
+
+
+@contextmanager
+def _exclusive(file: Any) -> Iterator[None]:
+    """Hold an advisory lock on an open file, where the platform has them."""
+    try:
+        import fcntl
+    except ImportError:  # windows
+        yield
+        return
+    fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+class Cassette:
+    """An `ai_callable` replaying recorded responses and recording new ones.
+
+    Args:
+        path: The location of the data file; the index is kept next to it, with an
+            `.idx` suffix. Missing files (and directories) are created on the first
+            recording.
+        mode: One of `"strict"`, `"record_new"` or `"refresh"`.
+        ai_callable: The callable that answers requests to record; `acall` awaits
+            its result if it is awaitable. Defaults to the OpenAI client used by
+            ghostfunctions (the async client for `acall`). Streamed responses are
+            read to the end before they are recorded.
+
+    Raises:
+        ValueError: If `mode` is unknown.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, "os.PathLike[str]"],
+        mode: str = "strict",
+        ai_callable: Optional[Callable[..., Any]] = None,
+    ) -> None:
+        """Open the cassette."""
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {MODES}, not {mode!r}.")
+        self.path = os.fspath(path)
+        self.index_path = self.path + ".idx"
+        self.mode = mode
+        self._ai_callable = ai_callable
+        self._lock = threading.Lock()
+        self._entries: Dict[bytes, Tuple[int, int]] = {}
+        self._indexed = 0
+        self.hits = 0
+        self.recorded = 0
+        with self._lock:
+            if os.path.exists(self.path) and not os.path.exists(self.index_path):
+                self._rebuild_index()
+            self._load_index()
+
+    def __len__(self) -> int:
+        """Return the number of distinct requests recorded."""
+        with self._lock:
+            self._load_index()
+            return len(self._entries)
+
+    def __contains__(self, kwargs: object) -> bool:
+        """Return whether the request with these keyword arguments is recorded."""
+        if not isinstance(kwargs, dict):
+            return False
+        with self._lock:
+            return self._find(bytes.fromhex(request_key(kwargs))) is not None
+
+    def __call__(self, **kwargs: Any) -> Any:
+        """Answer a request from the cassette, or record the real response.
+
+        Args:
+            kwargs: The keyword arguments of the request.
+
+        Returns:
+            A `ChatCompletion`, or an iterator of `ChatCompletionChunk`s if
+            `stream=True`.
+        """
+        digest, record = self._replay(kwargs)
+        if record is not None:
+            return self._response(record)
+        response = self._default_ai_callable()(**kwargs)
+        if kwargs.get("stream"):
+            response = [_dump(chunk) for chunk in response]
+        return self._response(self._record(digest, response))
+
+    async def acall(self, **kwargs: Any) -> Any:
+        """Answer a request like calling the cassette, awaiting the real response.
+
+        Args:
+            kwargs: The keyword arguments of the request.
+
+        Returns:
+            A `ChatCompletion`, or an iterator of `ChatCompletionChunk`s if
+            `stream=True`.
+        """
+        digest, record = self._replay(kwargs)
+        if record is not None:
+            return self._response(record)
+        response = self._default_async_ai_callable()(**kwargs)
+        if inspect.isawaitable(response):
+            response = await response
+        if kwargs.get("stream"):
+            if hasattr(response, "__aiter__"):
+                response = [_dump(chunk) async for chunk in response]
+            else:
+                response = [_dump(chunk) for chunk in response]
+        return self._response(self._record(digest, response))
+
+    def _default_ai_callable(self) -> Callable[..., Any]:
+        if self._ai_callable is None:
+            from .ghostfunctions import _default_ai_callable
+
+            self._ai_callable = _default_ai_callable()
+        return self._ai_callable
+
+    def _default_async_ai_callable(self) -> Callable[..., Any]:
+        if self._ai_callable is None:
+            from .ghostfunctions import _default_async_ai_callable
+
+            return _default_async_ai_callable()
+        return self._ai_callable
+
+    def _replay(self, kwargs: Dict[str, Any]) -> Tuple[bytes, Optional[Dict[str, Any]]]:
+        key = request_key(kwargs)
+        digest = bytes.fromhex(key)
+        if self.mode == "refresh":
+            return digest, None
+        with self._lock:
+            record = self._read(digest)
+            if record is not None:
+                self.hits += 1
+                return digest, record
+        if self.mode == "strict":
+            self._miss(key, kwargs)
+        return digest, None
+
+    def _miss(self, key: str, kwargs: Dict[str, Any]) -> None:
+        raise CassetteMiss(
+            f"Request {key} is not recorded in {self.path!r}; record it with"
+            f" mode='record_new'. Messages: {kwargs.get('messages')!r}"
+        )
+
+    @staticmethod
+    def _response(record: Dict[str, Any]) -> Any:
+        if record["stream"]:
+            return _chunks(record["response"])
+        return _completion(record["response"])
+
+    def _record(self, digest: bytes, response: Any) -> Dict[str, Any]:
+        stream = isinstance(response, list)
+        record = {
+            "key": digest.hex(),
+            "stream": stream,
+            "response": response if stream else _dump(response),
+        }
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # the lock keeps other processes from appending between the offset
+            # being read and the record being written; the record is written
+            # before its index entry, so an interrupted write leaves at worst an
+            # unindexed record
+            with open(self.path, "ab") as data, _exclusive(data):
+                offset = data.seek(0, os.SEEK_END)
+                data.write(line)
+                data.flush()
+                with open(self.index_path, "ab") as index:
+                    index.write(_ENTRY.pack(digest, offset, len(line)))
+            self._load_index()
+            self.recorded += 1
+        return record
+
+    def _find(self, digest: bytes) -> Optional[Tuple[int, int]]:
+        location = self._entries.get(digest)
+        if location is None:
+            self._load_index()  # recorded by another process since?
+            location = self._entries.get(digest)
+        return location
+
+    def _read(self, digest: bytes) -> Optional[Dict[str, Any]]:
+        location = self._find(digest)
+        if location is None:
+            return None
+        offset, length = location
+        with open(self.path, "rb") as data:
+            data.seek(offset)
+            record: Dict[str, Any] = json.loads(data.read(length))
+        return record
+
+    def _load_index(self) -> None:
+        """Add the index entries written since the last load to the lookup table."""
+        try:
+            size = os.path.getsize(self.index_path)
+        except OSError:
+            return
+        end = size - size % _ENTRY.size  # ignore a partially written entry
+        if end <= self._indexed:
+            return
+        with open(self.index_path, "rb") as index, mmap.mmap(
+            index.fileno(), 0, access=mmap.ACCESS_READ
+        ) as view:
+            for digest, offset, length in _ENTRY.iter_unpack(view[self._indexed : end]):
+                self._entries[digest] = (offset, length)
+        self._indexed = end
+
+    def _rebuild_index(self) -> None:
+        """Write the index of an existing data file."""
+        entries = []
+        offset = 0
+        with open(self.path, "rb") as data:
+            for line in data:
+                if line.endswith(b"\n"):
+                    digest = bytes.fromhex(json.loads(line)["key"])
+                    entries.append(_ENTRY.pack(digest, offset, len(line)))
+                offset += len(line)
+        with open(self.index_path, "wb") as index:
+            index.write(b"".join(entries))
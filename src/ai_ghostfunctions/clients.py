@@ -0,0 +1,199 @@
+"""Process-wide OpenAI clients shared by every default `ai_callable`.
+
+Clients (and their HTTP connection pools) are created on first use and reused by
+all ghostfunctions in the process. After a fork the registry is emptied, so child
+processes such as pre-fork server workers build their own pools instead of
+sharing sockets with the parent.
+"""
+
+import os
+import threading
+import weakref
+from dataclasses import dataclass
+from dataclasses import replace
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+
+if TYPE_CHECKING:  # imported on first use to keep `import ai_ghostfunctions` fast
+    import openai
+
+
+@dataclass(frozen=True)
+class ClientConfig:
+    """Connection pool and timeout settings for the shared OpenAI clients.
+
+    Args:
+        max_connections: The maximum number of concurrent connections per client.
+        max_keepalive_connections: The maximum number of idle connections kept open.
+        keepalive_expiry: Seconds an idle connection is kept open.
+        http2: Use HTTP/2. Requires the `h2` package (`pip install httpx[http2]`).
+        timeout: Seconds to wait for a response.
+        connect_timeout: Seconds to wait for a connection to be established.
+        max_retries: Retries performed by the OpenAI client itself, on connection
+            errors, timeouts and 408, 409, 429 and 5xx responses. 0 by default,
+            as ghostfunction requests are retried by the shared scheduler (see
+            `ai_ghostfunctions.ratelimit`); retries of both would stack.
+    """
+
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0
+    http2: bool = False
+    timeout: float = 600.0
+    connect_timeout: float = 5.0
+    max_retries: int = 0
+
+    def _client_kwargs(self) -> Dict[str, Any]:
+        import httpx
+
+        return dict(
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+            http2=self.http2,
+        )
+
+
+_lock = threading.Lock()
+_config = ClientConfig()
+_pid = os.getpid()
+# clients are keyed on (api key, base url)
+_Key = Tuple[Optional[str], Optional[str]]
+_clients: Dict[_Key, "openai.OpenAI"] = {}
+_async_clients: "weakref.WeakKeyDictionary[Any, Dict[_Key, openai.AsyncOpenAI]]" = (
+    weakref.WeakKeyDictionary()
+)
+_async_clients_without_loop: Dict[_Key, "openai.AsyncOpenAI"] = {}
+
+
+def _reset() -> None:
+    # the clients are dropped rather than closed: after a fork their sockets
+    # still belong to the parent process
+    global _pid
+    _clients.clear()
+    _async_clients.clear()
+    _async_clients_without_loop.clear()
+    _pid = os.getpid()
+
+
+def _check_pid() -> None:
+    if os.getpid() != _pid:
+        _reset()
+
+
+if hasattr(os, "register_at_fork"):  # not available on windows
+    os.register_at_fork(after_in_child=_reset)
+
+
+def configure_clients(**settings: Any) -> ClientConfig:
+    """Change the settings used for shared clients created from now on.
+
+    Clients that already exist are discarded from the registry; calls that are
+    in progress keep using them until they finish.
+
+    Args:
+        settings: Fields of `ClientConfig` to change.
+
+    Returns:
+        The new configuration.
+    """
+    global _config
+    with _lock:
+        _config = replace(_config, **settings)
+        _reset()
+        return _config
+
+
+def get_client_config() -> ClientConfig:
+    """Return the settings used for shared clients.
+
+    Returns:
+        The current configuration.
+    """
+    return _config
+
+
+def _api_key(api_key: Optional[str]) -> Optional[str]:
+    return api_key if api_key is not None else os.environ.get("OPENAI_API_KEY")
+
+
+def get_client(
+    api_key: Optional[str] = None, base_url: Optional[str] = None
+) -> "openai.OpenAI":
+    """Return the shared OpenAI client for `api_key`, creating it if needed.
+
+    Args:
+        api_key: The OpenAI API key. Defaults to the env var `OPENAI_API_KEY`.
+        base_url: The URL of an OpenAI-compatible server to send requests to instead
+            of the OpenAI API. Defaults to the OpenAI client's own default.
+
+    Returns:
+        An `openai.OpenAI` client shared by every caller in this process.
+    """
+    import httpx
+    import openai
+
+    key = (_api_key(api_key), base_url)
+    with _lock:
+        _check_pid()
+        client = _clients.get(key)
+        if client is None:
+            client = openai.OpenAI(
+                api_key=key[0],
+                base_url=base_url,
+                max_retries=_config.max_retries,
+                http_client=httpx.Client(**_config._client_kwargs()),
+            )
+            _clients[key] = client
+        return client
+
+
+def get_async_client(
+    api_key: Optional[str] = None, base_url: Optional[str] = None
+) -> "openai.AsyncOpenAI":
+    """Return the shared async OpenAI client for `api_key`, creating it if needed.
+
+    Async connection pools cannot be shared between event loops, so one client is
+    kept per running event loop.
+
+    Args:
+        api_key: The OpenAI API key. Defaults to the env var `OPENAI_API_KEY`.
+        base_url: The URL of an OpenAI-compatible server to send requests to instead
+            of the OpenAI API. Defaults to the OpenAI client's own default.
+
+    Returns:
+        An `openai.AsyncOpenAI` client shared by every caller on the running loop.
+    """
+    import asyncio
+
+    import httpx
+    import openai
+
+    key = (_api_key(api_key), base_url)
+    try:
+        loop: Optional[asyncio.AbstractEventLoop] = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    with _lock:
+        _check_pid()
+        if loop is None:
+            clients = _async_clients_without_loop
+        else:
+            clients = _async_clients.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None:
+            client = openai.AsyncOpenAI(
+                api_key=key[0],
+                base_url=base_url,
+                max_retries=_config.max_retries,
+                http_client=httpx.AsyncClient(**_config._client_kwargs()),
+            )
+            clients[key] = client
+        return client
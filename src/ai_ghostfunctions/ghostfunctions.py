@@ -1,55 +1,94 @@
 """The AICallable class."""
 
 import ast
+import copy
 import inspect
-import os
-from functools import wraps
+from collections import deque
+from contextvars import copy_context
+from functools import partial
+from functools import update_wrapper
+from types import MethodType
+from typing import TYPE_CHECKING
 from typing import Any
+from typing import AsyncGenerator
+from typing import AsyncIterable
+from typing import AsyncIterator
+from typing import Awaitable
 from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import Generator
+from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import NoReturn
 from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Union
 from typing import get_type_hints
 
-import openai
-import typeguard
-from openai.types.chat.chat_completion import ChatCompletion
-
+from .aggregators import IncrementalAggregator
+from .aggregators import Tally
+from .backends import Backend
+from .backends import OpenAIBackend
+from .cache import BaseCache
+from .cache import make_cache_key
+from .hedging import HedgingPolicy
+from .instrumentation import current_event
+from .instrumentation import get_hooks
+from .instrumentation import instrument
+from .instrumentation import phase
+from .instrumentation import record_cache_hit
+from .instrumentation import record_response
 from .keywords import ASSISTANT
 from .keywords import SYSTEM
 from .keywords import USER
+from .mapreduce import MapReduce
+from .mapreduce import afold
+from .mapreduce import amap_chunks
+from .mapreduce import fold
+from .mapreduce import map_chunks
+from .offload import ParseOffload
+from .ratelimit import get_scheduler
+from .schema import compile_structured_validator
+from .schema import response_format
+from .singleflight import SingleFlight
+from .streaming import IncrementalListParser
+from .streaming import chunk_text
+from .streaming import chunk_texts
+from .streaming import element_type
+from .templates import FunctionTemplate
+from .templates import compile_template
+from .tokens import TokenBudget
+from .tokens import count_tokens
+from .tokens import model_name
 from .types import Message
+from .validators import Validator
+from .validators import compile_validator
+
+
+if TYPE_CHECKING:  # imported on first use to keep `import ai_ghostfunctions` fast
+    import asyncio
+    from concurrent.futures import Future
+
+    from openai.types.chat.chat_completion import ChatCompletion
+    from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
 
 
 def _make_chatgpt_message_from_function(
     f: Callable[..., Any], *args: Any, **kwargs: Any
 ) -> Message:
-    sig = inspect.signature(f)
-    if args:
-        params = list(sig.parameters)
-        for i, arg in enumerate(args):
-            kwargs[params[i]] = arg
-    if not f.__doc__:
-        raise ValueError("The function must have a docstring.")
-    prompt = (
-        (
-            f"from mymodule import {f.__name__}\n"
-            f"""
-# The return type annotation for the function {f.__name__} is {get_type_hints(f)['return']}
-# The docstring for the function {f.__name__} is the following:
-"""  # noqa: E231
-        )
-        + "\n".join([f"# {line}" for line in f.__doc__.split("\n")])
-        + f"""
-result = {f.__name__}({",".join(f"{k}={kwargs[k].__repr__()}" for k in sig.parameters)})
-print(result)
-"""
-    )
-    return Message(role=USER, content=prompt)
+    return Message(role=USER, content=compile_template(f).render(*args, **kwargs))
 
 
-def _default_prompt_creation(
-    f: Callable[..., Any], *args: Any, **kwargs: Any
-) -> List[Message]:
+def _make_packed_chatgpt_message_from_function(
+    f: Callable[..., Any], calls: Sequence[Tuple[Tuple[Any, ...], Dict[str, Any]]]
+) -> Message:
+    return Message(role=USER, content=compile_template(f).render_packed(calls))
+
+
+def _interpreter_preamble() -> List[Message]:
     return [
         Message(
             role=SYSTEM,
@@ -72,24 +111,33 @@ def _default_prompt_creation(
                 " I will return the output, and nothing else."
             ),
         ),
+    ]
+
+
+def _default_prompt_creation(
+    f: Callable[..., Any], *args: Any, **kwargs: Any
+) -> List[Message]:
+    return [
+        *_interpreter_preamble(),
         _make_chatgpt_message_from_function(f, *args, **kwargs),
     ]
 
 
-def _default_ai_callable() -> Callable[..., ChatCompletion]:
+def _default_packed_prompt_creation(
+    f: Callable[..., Any], calls: Sequence[Tuple[Tuple[Any, ...], Dict[str, Any]]]
+) -> List[Message]:
+    return [
+        *_interpreter_preamble(),
+        _make_packed_chatgpt_message_from_function(f, calls),
+    ]
 
-    client = openai.OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
 
-    def f(**kwargs: Any) -> ChatCompletion:
-        create = client.chat.completions.create
-        try:
-            result: ChatCompletion = create(model="gpt-4", **kwargs)
-        except openai.NotFoundError:
-            # user may not have access to gpt-4 yet, perhaps they have 3.5
-            result: ChatCompletion = create(model="gpt-3.5-turbo", **kwargs)  # type: ignore[no-redef]
-        return result
+def _default_ai_callable() -> Callable[..., "ChatCompletion"]:
+    return OpenAIBackend().complete
 
-    return f
+
+def _default_async_ai_callable() -> Callable[..., Awaitable["ChatCompletion"]]:
+    return OpenAIBackend().acomplete
 
 
 def _assert_function_has_return_type_annotation(function: Callable[..., Any]) -> None:
@@ -99,21 +147,19 @@ def _assert_function_has_return_type_annotation(function: Callable[..., Any]) ->
         )
 
 
-def _string_to_python_data_structure(string: str, data_type: Any) -> Any:
-    if data_type is str:
-        if string.startswith("'") and string.endswith("'"):
-            return ast.literal_eval(string)
-        elif string.startswith('"') and string.endswith('"'):
-            return ast.literal_eval(string)
-        return string
+def _assert_function_has_parameter(function: Callable[..., Any], name: str) -> None:
+    if name not in inspect.signature(function).parameters:
+        raise ValueError(f"Function {function.__name__} has no parameter {name!r}.")
+
 
-    return ast.literal_eval(string)
+def _first_choice(choices: List[Any]) -> Any:
+    return choices[0]
 
 
 def _parse_ai_result(
     ai_result: Any,
     expected_return_type: Any,
-    aggregation_function: Any = lambda x: x[0],
+    aggregation_function: Any = _first_choice,
 ) -> Any:
     """Parse the result from the OpenAI API Call and return data.
 
@@ -129,26 +175,1320 @@ def _parse_ai_result(
         The data from the ai result (data is of type `expected_return_type`)
 
     """
-    string_contents = [choice.message.content for choice in ai_result.choices]
-    data = [
-        typeguard.check_type(
-            _string_to_python_data_structure(string, expected_return_type),
-            expected_return_type,
+    return _parse_string_contents(
+        _completion_contents(ai_result), expected_return_type, aggregation_function
+    )
+
+
+def _completion_contents(ai_result: Any) -> List[str]:
+    return [choice.message.content for choice in ai_result.choices]
+
+
+def _parse_string_contents(
+    string_contents: List[str],
+    expected_return_type: Any,
+    aggregation_function: Any = _first_choice,
+) -> Any:
+    validator = compile_validator(expected_return_type)
+    data = [validator.parse(string) for string in string_contents]
+    return validator.coerce(aggregation_function(data))
+
+
+def _split_packed_result(string: str, count: int) -> List[Any]:
+    data = ast.literal_eval(string)
+    if not isinstance(data, list) or len(data) != count:
+        raise ValueError(f"Expected a list of {count} results, got {string!r}.")
+    return data
+
+
+def _parse_packed_item(
+    values: List[Any], expected_return_type: Any, aggregation_function: Any
+) -> Any:
+    import typeguard
+
+    validator = compile_validator(expected_return_type)
+    data = []
+    error: Optional[Exception] = None
+    for value in values:
+        try:
+            data.append(validator.coerce(value))
+        except typeguard.TypeCheckError as e:
+            error = e
+    if not data:
+        raise error or ValueError("No choice contained a result.")
+    return validator.coerce(aggregation_function(data))
+
+
+def _as_call_arguments(item: Any) -> Tuple[Tuple[Any, ...], Dict[str, Any]]:
+    if isinstance(item, dict):
+        return (), item
+    if isinstance(item, tuple):
+        return item, {}
+    return (item,), {}
+
+
+class _BaseGhostFunction:
+    """Behavior shared by sync and async ghostfunctions."""
+
+    def __init__(
+        self,
+        function: Callable[..., Any],
+        ai_callable: Optional[Callable[..., Any]],
+        prompt_function: Callable[..., List[Message]],
+        aggregation_function: Callable[..., Any],
+        cache: Optional[BaseCache],
+        ai_kwargs: Dict[str, Any],
+        packed_prompt_function: Callable[
+            ..., List[Message]
+        ] = _default_packed_prompt_creation,
+        priority: int = 0,
+        hedging: Optional[HedgingPolicy] = None,
+        coalesce: bool = False,
+        token_budget: Optional[TokenBudget] = None,
+        map_reduce: Optional[MapReduce] = None,
+        structured_output: bool = False,
+        offload: Optional[ParseOffload] = None,
+        backend: Optional[Backend] = None,
+    ) -> None:
+        update_wrapper(self, function)  # type: ignore[arg-type]
+        self.function = function
+        self._ai_callable = ai_callable
+        self.prompt_function = prompt_function
+        self.packed_prompt_function = packed_prompt_function
+        self.aggregation_function = aggregation_function
+        self.cache = cache
+        self.ai_kwargs = ai_kwargs
+        self.priority = priority
+        self.hedging = hedging
+        self._flights: Optional[SingleFlight] = SingleFlight() if coalesce else None
+        self.token_budget = token_budget
+        self.map_reduce = map_reduce
+        if map_reduce is not None:
+            _assert_function_has_parameter(function, map_reduce.argument)
+        self.return_type_annotation = get_type_hints(function)["return"]
+        self.structured_output = structured_output
+        self.offload = offload
+        if backend is not None and ai_callable is not None:
+            raise ValueError("Pass either an ai_callable or a backend, not both.")
+        self.backend = backend
+        if structured_output:
+            self.ai_kwargs = {
+                "response_format": response_format(
+                    self.return_type_annotation, function.__name__
+                ),
+                **ai_kwargs,
+            }
+            self.validator = compile_structured_validator(self.return_type_annotation)
+        else:
+            self.validator = compile_validator(self.return_type_annotation)
+        if prompt_function is _default_prompt_creation:
+            # compile eagerly so a missing docstring is reported at decoration time
+            compile_template(function)
+
+    def __get__(self, instance: Any, owner: Optional[type] = None) -> Any:
+        """Bind the ghostfunction to `instance`, like a function decorating a method."""
+        if instance is None:
+            return self
+        return MethodType(self, instance)  # type: ignore[arg-type]
+
+    @property
+    def ai_callable(self) -> Callable[..., Any]:
+        """The callable sending prompts to the AI, resolved on first use."""
+        if self._ai_callable is None:
+            if self.backend is None:
+                self._ai_callable = self._default_ai_callable()
+            else:
+                self._ai_callable = self._backend_callable(self.backend)
+        return self._ai_callable
+
+    @staticmethod
+    def _default_ai_callable() -> Callable[..., Any]:
+        return _default_ai_callable()
+
+    @staticmethod
+    def _backend_callable(backend: Backend) -> Callable[..., Any]:
+        return backend.complete
+
+    @property
+    def _qualified_name(self) -> str:
+        """The name the rate limiter and the instrumentation know this function by."""
+        return f"{self.function.__module__}.{self.function.__qualname__}"
+
+    @property
+    def template(self) -> FunctionTemplate:
+        """The compiled prompt template of the decorated function.
+
+        Custom `prompt_function`s can reuse it through
+        `ai_ghostfunctions.templates.compile_template`, which returns the same object.
+        """
+        return compile_template(self.function)
+
+    def _prompt(self, *args: Any, **kwargs: Any) -> List[Message]:
+        with phase("prompt"):
+            prompt = self.prompt_function(self.function, *args, **kwargs)
+        event = current_event()
+        if event is not None:
+            event.prompt = prompt
+        return prompt
+
+    def count_tokens(self, *args: Any, **kwargs: Any) -> int:
+        """Return the number of prompt tokens a call with these arguments sends.
+
+        Args:
+            args: Positional arguments of the call.
+            kwargs: Keyword arguments of the call.
+
+        Returns:
+            The token count, for the tokenizer of the `model` of the ghostfunction.
+        """
+        prompt = self.prompt_function(self.function, *args, **kwargs)
+        return count_tokens(prompt, self._tokenizer_model)
+
+    @property
+    def _tokenizer_model(self) -> Optional[str]:
+        if self.token_budget is not None and self.token_budget.model:
+            return self.token_budget.model
+        return model_name(self.ai_kwargs)
+
+    def _fit(
+        self, prompt: List[Message], args: Tuple[Any, ...], kwargs: Dict[str, Any]
+    ) -> Tuple[List[Message], List[Dict[str, Any]]]:
+        """Apply the token budget: return the prompt to send, or the chunks to map."""
+        budget = self.token_budget
+        if budget is None:
+            return prompt, []
+        model = self._tokenizer_model
+        tokens = count_tokens(prompt, model)
+        if tokens <= budget.max_prompt_tokens:
+            return prompt, []
+        arguments = self._bind(args, kwargs)
+        if budget.strategy == "chunk":
+            return prompt, budget.chunks(self._prompt, arguments, tokens, model)
+        prompt, _ = budget.fit(self._prompt, arguments, tokens, model)
+        return prompt, []
+
+    def _bind(self, args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        return dict(inspect.signature(self.function).bind(*args, **kwargs).arguments)
+
+    def _chunks(self, args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> Any:
+        if self.map_reduce is None:
+            raise ValueError(
+                f"{self.function.__name__} was not created with `map_reduce`."
+            )
+        return self.map_reduce.chunks(self._bind(args, kwargs))
+
+    def _from_cache(self, prompt: List[Message]) -> Optional[List[str]]:
+        if self.cache is None:
+            return None
+        with phase("cache"):
+            cached = self.cache.get(prompt, self.ai_kwargs)
+        if cached is not None:
+            record_cache_hit()
+        return cached
+
+    def _offloads(self, string_contents: List[str]) -> bool:
+        return self.offload is not None and self.offload.wants(
+            string_contents, self.return_type_annotation, self.aggregation_function
         )
-        for string in string_contents
-    ]
-    return typeguard.check_type(aggregation_function(data), expected_return_type)
+
+    def _offload(self, string_contents: List[str]) -> "Future[Any]":
+        assert self.offload is not None  # nosec
+        return self.offload.submit(
+            string_contents,
+            self.return_type_annotation,
+            self.structured_output,
+            self.aggregation_function,
+        )
+
+    def _parse(self, string_contents: List[str]) -> Any:
+        if self._offloads(string_contents):
+            # the worker decodes, validates and aggregates: timed as one phase
+            with phase("decode"):
+                return self._offload(string_contents).result()
+        if current_event() is None:
+            data = [self.validator.parse(string) for string in string_contents]
+            return self.validator.coerce(self.aggregation_function(data))
+        # the same steps as above, timed separately
+        with phase("decode"):
+            literals = [self.validator.decode(string) for string in string_contents]
+        with phase("validate"):
+            data = [self.validator.coerce(literal) for literal in literals]
+        with phase("aggregate"):
+            aggregated = self.aggregation_function(data)
+        with phase("validate"):
+            return self.validator.coerce(aggregated)
+
+    def _element_validator(self) -> Validator:
+        element = element_type(self.return_type_annotation)
+        if self.structured_output:
+            # the parser skips the `{"result": ` before the list
+            return compile_structured_validator(element, wrapped=False)
+        return compile_validator(element)
+
+    @property
+    def _packed_ai_kwargs(self) -> Dict[str, Any]:
+        """The request parameters of packed prompts, which ask for a python list."""
+        if not self.structured_output:
+            return self.ai_kwargs
+        return {k: v for k, v in self.ai_kwargs.items() if k != "response_format"}
+
+    def _batch_size(self, pack_size: int) -> int:
+        """Return how many argument sets `map` sends per backend batch, or 0."""
+        backend = self.backend
+        if backend is None or not backend.supports_batch or pack_size > 1:
+            return 0
+        if self.map_reduce or self.token_budget or self.hedging:
+            return 0  # these need each call to be made on its own
+        if self._incremental_choices():
+            return 0
+        return backend.max_batch_size
+
+    def _store_streamed(self, prompt: List[Message], received: List[str]) -> None:
+        if self.cache is not None:
+            self.cache.set(prompt, self.ai_kwargs, ["".join(received)])
+
+    def _incremental_choices(self) -> int:
+        """Return `n` if choices should be aggregated as they arrive, else 0."""
+        n = self.ai_kwargs.get("n") or 1
+        if isinstance(self.aggregation_function, IncrementalAggregator) and n > 1:
+            return int(n)
+        return 0
+
+    def _tally(self, n: int) -> Tally:
+        assert isinstance(self.aggregation_function, IncrementalAggregator)  # nosec
+        return Tally(n, self.validator, self.aggregation_function)
+
+    def _store_tally(self, prompt: List[Message], tally: Tally) -> None:
+        if self.cache is not None:
+            self.cache.set(prompt, self.ai_kwargs, tally.accepted)
+
+    def _parse_and_store(
+        self, prompt: List[Message], string_contents: List[str]
+    ) -> Any:
+        result = self._parse(string_contents)
+        if self.cache is not None:
+            # only responses that parse are worth replaying
+            self.cache.set(prompt, self.ai_kwargs, string_contents)
+        return result
+
+
+class _PackedBatch:
+    """Several argument sets answered by one completion, re-issuing failed items."""
+
+    def __init__(
+        self, ghostfunction: _BaseGhostFunction, items: List[Any], max_retries: int
+    ) -> None:
+        self.ghostfunction = ghostfunction
+        self.calls = [_as_call_arguments(item) for item in items]
+        self.outcomes: List[Any] = [None] * len(items)
+        self.pending = list(range(len(items)))
+        self.attempts_left = max_retries + 1
+
+    def next_prompt(self) -> Optional[List[Message]]:
+        if not self.pending or self.attempts_left == 0:
+            return None
+        self.attempts_left -= 1
+        gf = self.ghostfunction
+        return gf.packed_prompt_function(
+            gf.function, [self.calls[i] for i in self.pending]
+        )
+
+    def fail(self, exception: Exception) -> None:
+        for i in self.pending:
+            self.outcomes[i] = exception
+        self.pending = []
+
+    def feed(self, ai_result: Any) -> None:
+        gf = self.ghostfunction
+        choices = []
+        error: Exception = ValueError("The packed completion has no choices.")
+        for string in _completion_contents(ai_result):
+            try:
+                choices.append(_split_packed_result(string, len(self.pending)))
+            except (SyntaxError, ValueError) as e:
+                error = e
+        if not choices:
+            for i in self.pending:
+                self.outcomes[i] = error
+            return
+        still_pending = []
+        for position, i in enumerate(self.pending):
+            try:
+                self.outcomes[i] = _parse_packed_item(
+                    [choice[position] for choice in choices],
+                    gf.return_type_annotation,
+                    gf.aggregation_function,
+                )
+            except Exception as e:
+                self.outcomes[i] = e
+                still_pending.append(i)
+        self.pending = still_pending
+
+
+class _BackendBatch:
+    """Argument sets sent to a batch-capable backend at once, unless cached."""
+
+    def __init__(self, ghostfunction: _BaseGhostFunction, items: List[Any]) -> None:
+        self.ghostfunction = ghostfunction
+        self.outcomes: List[Any] = [None] * len(items)
+        self.prompts: Dict[int, List[Message]] = {}
+        self.cached: Dict[int, List[str]] = {}
+        for i, item in enumerate(items):
+            args, kwargs = _as_call_arguments(item)
+            try:
+                prompt = ghostfunction._prompt(*args, **kwargs)
+                cached = ghostfunction._from_cache(prompt)
+            except Exception as e:
+                self.outcomes[i] = e
+                continue
+            if cached is None:
+                self.prompts[i] = prompt
+            else:
+                self.cached[i] = cached
+
+    def parse_cached(self) -> None:
+        """Parse the cached responses."""
+        for i, string_contents in self.cached.items():
+            try:
+                self.outcomes[i] = self.ghostfunction._parse(string_contents)
+            except Exception as e:
+                self.outcomes[i] = e
+
+    async def aparse_cached(self, parse: Callable[[List[str]], Awaitable[Any]]) -> None:
+        """Parse the cached responses with the coroutine function `parse`."""
+        for i, string_contents in self.cached.items():
+            try:
+                self.outcomes[i] = await parse(string_contents)
+            except Exception as e:
+                self.outcomes[i] = e
+
+    def requests(self) -> List[Dict[str, Any]]:
+        ai_kwargs = self.ghostfunction.ai_kwargs
+        return [{"messages": prompt, **ai_kwargs} for prompt in self.prompts.values()]
+
+    def fail(self, exception: Exception) -> None:
+        for i in self.prompts:
+            self.outcomes[i] = exception
+
+    def feed(self, ai_results: List[Any]) -> None:
+        """Parse and cache the responses to the requests."""
+        for i, prompt, ai_result in self._responses(ai_results):
+            try:
+                self.outcomes[i] = self.ghostfunction._parse_and_store(
+                    prompt, _completion_contents(ai_result)
+                )
+            except Exception as e:
+                self.outcomes[i] = e
+
+    async def afeed(
+        self,
+        ai_results: List[Any],
+        parse_and_store: Callable[[List[Message], List[str]], Awaitable[Any]],
+    ) -> None:
+        """Like `feed`, parsing with the coroutine function `parse_and_store`."""
+        for i, prompt, ai_result in self._responses(ai_results):
+            try:
+                self.outcomes[i] = await parse_and_store(
+                    prompt, _completion_contents(ai_result)
+                )
+            except Exception as e:
+                self.outcomes[i] = e
+
+    def _responses(
+        self, ai_results: List[Any]
+    ) -> Iterator[Tuple[int, List[Message], Any]]:
+        if len(ai_results) != len(self.prompts):
+            self.fail(
+                ValueError(
+                    f"The backend answered {len(ai_results)} of"
+                    f" {len(self.prompts)} requests."
+                )
+            )
+            return
+        results = zip(self.prompts.items(), ai_results)  # noqa: B905
+        for (i, prompt), ai_result in results:
+            record_response(ai_result)
+            yield i, prompt, ai_result
+
+
+class _HedgeRace:
+    """Bookkeeping for one hedged call: the requests sent and their outcomes.
+
+    Works with both `concurrent.futures` and `asyncio` futures.
+    """
+
+    def __init__(
+        self,
+        ghostfunction: _BaseGhostFunction,
+        prompt: List[Message],
+        policy: HedgingPolicy,
+    ) -> None:
+        self.ghostfunction = ghostfunction
+        self.prompt = prompt
+        self.policy = policy
+        self.started: Dict[Any, float] = {}
+        self.error: Optional[BaseException] = None
+        policy._record_request()
+
+    def add(self, future: Any) -> None:
+        """Register a request just sent."""
+        import time
+
+        if self.started:
+            self.policy._record_hedge()
+        self.started[future] = time.monotonic()
+
+    def can_hedge(self) -> bool:
+        """Whether another duplicate request may be sent."""
+        return len(self.started) <= self.policy.max_hedges
+
+    def timeout(self) -> Optional[float]:
+        """How long to wait for a response before hedging."""
+        return self.policy.delay() if self.can_hedge() else None
+
+    def settle(self, done: Iterable[Any]) -> Tuple[bool, Any]:
+        """Parse completed requests, returning `(True, result)` for the first valid."""
+        remaining = iter(done)
+        for future in remaining:
+            ai_result = self._completed(future)
+            if ai_result is None:
+                continue
+            try:
+                result = self.ghostfunction._parse_and_store(
+                    self.prompt, _completion_contents(ai_result)
+                )
+            except Exception as e:
+                self._reject(ai_result, e)
+                continue
+            self._win(future, remaining)
+            return True, result
+        return False, None
+
+    async def asettle(
+        self,
+        done: Iterable[Any],
+        parse_and_store: Callable[[List[Message], List[str]], Awaitable[Any]],
+    ) -> Tuple[bool, Any]:
+        """Like `settle`, parsing with the coroutine function `parse_and_store`."""
+        remaining = iter(done)
+        for future in remaining:
+            ai_result = self._completed(future)
+            if ai_result is None:
+                continue
+            try:
+                result = await parse_and_store(
+                    self.prompt, _completion_contents(ai_result)
+                )
+            except Exception as e:
+                self._reject(ai_result, e)
+                continue
+            self._win(future, remaining)
+            return True, result
+        return False, None
+
+    def abandon(self, pending: Iterable[Any]) -> None:
+        """Cancel the requests still in flight, accounting for any that answer."""
+        for future in pending:
+            future.cancel()
+            future.add_done_callback(self._late)
+
+    def fail(self) -> NoReturn:
+        """Raise the error of the last request, as no more hedges may be sent."""
+        assert self.error is not None  # nosec
+        raise self.error
+
+    def _completed(self, future: Any) -> Any:
+        if future.cancelled():
+            return None
+        error = future.exception()
+        if error is not None:
+            self.error = error
+            return None
+        import time
+
+        self.policy.record_latency(time.monotonic() - self.started[future])
+        return future.result()
+
+    def _reject(self, ai_result: Any, error: Exception) -> None:
+        self.error = error
+        self.policy._record_unused(ai_result)
+
+    def _win(self, future: Any, others: Iterable[Any]) -> None:
+        if future is not next(iter(self.started)):
+            self.policy._record_win()
+        for other in others:
+            self._late(other)
+
+    def _late(self, future: Any) -> None:
+        ai_result = self._completed(future)
+        if ai_result is not None:
+            self.policy._record_unused(ai_result)
+
+
+class _ChoiceTexts:
+    """Accumulate the text of each choice of a streamed multi-choice completion."""
+
+    def __init__(self) -> None:
+        self._texts: Dict[int, List[str]] = {}
+
+    def add(self, chunk: Any) -> List[str]:
+        """Consume a chunk, returning the texts of the choices it finished."""
+        finished = []
+        for choice in chunk.choices:
+            if choice.delta.content:
+                self._texts.setdefault(choice.index, []).append(choice.delta.content)
+            if choice.finish_reason is not None:
+                finished.append("".join(self._texts.pop(choice.index, [])))
+        return finished
+
+
+def _chunked(iterable: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    chunk: List[Any] = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class GhostFunction(_BaseGhostFunction):
+    """A function whose logic is dispatched to the AI.
+
+    Instances are created by the `ghostfunction` decorator and keep the name,
+    docstring and signature of the decorated function.
+    """
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        """Call the ghostfunction."""
+        if not get_hooks():
+            return self._call(*args, **kwargs)
+        with instrument(self._qualified_name) as event:
+            event.result = self._call(*args, **kwargs)
+        return event.result
+
+    def _call(self, *args: Any, **kwargs: Any) -> Any:
+        if self.map_reduce is None:
+            return self._call_one(*args, **kwargs)
+        return fold(
+            self.partials(*args, **kwargs),
+            self.map_reduce.reduce,
+            self.map_reduce.fanin,
+        )
+
+    def partials(self, *args: Any, **kwargs: Any) -> Iterator[Any]:
+        """Stream the partial results of a ghostfunction created with `map_reduce`.
+
+        The designated argument is split into chunks and the ghostfunction called on
+        each; the results are yielded in chunk order as they become available,
+        without being reduced.
+
+        Args:
+            args: Positional arguments of the call.
+            kwargs: Keyword arguments of the call.
+
+        Returns:
+            An iterator of the partial results.
+        """
+        chunks = self._chunks(args, kwargs)
+        assert self.map_reduce is not None  # nosec
+        return map_chunks(self._call_one, chunks, self.map_reduce.max_concurrency)
+
+    def _call_one(self, *args: Any, **kwargs: Any) -> Any:
+        prompt, chunks = self._fit(self._prompt(*args, **kwargs), args, kwargs)
+        if chunks:
+            return self._call_chunks(chunks)
+        cached = self._from_cache(prompt)
+        if cached is not None:
+            return self._parse(cached)
+        if self._flights is None:
+            return self._fetch(prompt)
+        result, shared = self._flights.do(
+            make_cache_key(prompt, self.ai_kwargs), partial(self._fetch, prompt)
+        )
+        return copy.deepcopy(result) if shared else result
+
+    def _fetch(self, prompt: List[Message]) -> Any:
+        n = self._incremental_choices()
+        if n:
+            return self._call_incrementally(prompt, n)
+        if self.hedging is not None:
+            return self._call_hedged(prompt, self.hedging)
+        ai_result = self._request(messages=prompt, **self.ai_kwargs)
+        return self._parse_and_store(prompt, _completion_contents(ai_result))
+
+    def _call_chunks(self, chunks: List[Dict[str, Any]]) -> Any:
+        assert self.token_budget is not None  # nosec
+        partials = map_chunks(self._call_one, chunks, self.token_budget.max_concurrency)
+        return fold(partials, self.token_budget.reduce)
+
+    def _request(self, **kwargs: Any) -> Any:
+        with phase("request"):
+            ai_result = get_scheduler().call(
+                self._send, kwargs, key=self._qualified_name, priority=self.priority
+            )
+        record_response(ai_result)
+        return ai_result
+
+    def _send(self, **kwargs: Any) -> Any:
+        ai_result = self.ai_callable(**kwargs)
+        if inspect.isawaitable(ai_result):
+            if inspect.iscoroutine(ai_result):
+                ai_result.close()
+            raise TypeError(
+                "ai_callable returned an awaitable; decorate"
+                f" {self.function.__name__} with `async def` or pass"
+                " `async_=True` to use an async ai_callable."
+            )
+        return ai_result
+
+    def _call_hedged(self, prompt: List[Message], policy: HedgingPolicy) -> Any:
+        from concurrent.futures import FIRST_COMPLETED
+        from concurrent.futures import ThreadPoolExecutor
+        from concurrent.futures import wait
+
+        race = _HedgeRace(self, prompt, policy)
+        executor = ThreadPoolExecutor(max_workers=policy.max_hedges + 1)
+
+        def send() -> "Future[Any]":
+            request = partial(self._request, messages=prompt, **self.ai_kwargs)
+            future = executor.submit(copy_context().run, request)
+            race.add(future)
+            return future
+
+        pending = {send()}
+        try:
+            while True:
+                done, pending = wait(
+                    pending, timeout=race.timeout(), return_when=FIRST_COMPLETED
+                )
+                won, result = race.settle(done)
+                if won:
+                    return result
+                if not done or not pending:
+                    if not race.can_hedge():
+                        race.fail()
+                    pending.add(send())
+        finally:
+            race.abandon(pending)
+            executor.shutdown(wait=False)
+
+    def _call_incrementally(self, prompt: List[Message], n: int) -> Any:
+        tally = self._tally(n)
+        if tally.aggregator.strategy == "stream":
+            outcomes = self._streamed_choices(prompt)
+        else:
+            outcomes = self._concurrent_choices(prompt, n)
+        try:
+            for outcome in outcomes:
+                if tally.add(outcome):
+                    break
+            else:
+                tally.finish()
+        finally:
+            outcomes.close()
+        self._store_tally(prompt, tally)
+        return tally.result
+
+    def _concurrent_choices(
+        self, prompt: List[Message], n: int
+    ) -> Generator[Any, None, None]:
+        """Send `n` single-choice requests at once, yielding texts as they complete.
+
+        Closing the generator cancels requests that have not started yet; requests
+        already in flight on a thread cannot be interrupted and are left to finish.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        from concurrent.futures import as_completed
+
+        kwargs = {**self.ai_kwargs, "n": 1}
+        executor = ThreadPoolExecutor(max_workers=n)
+        futures = [
+            executor.submit(
+                copy_context().run, partial(self._request, messages=prompt, **kwargs)
+            )
+            for _ in range(n)
+        ]
+        try:
+            for future in as_completed(futures):
+                try:
+                    yield _completion_contents(future.result())[0]
+                except Exception as e:
+                    yield e
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _streamed_choices(self, prompt: List[Message]) -> Generator[Any, None, None]:
+        """Stream one `n`-choice request, yielding each choice once it has finished.
+
+        Closing the generator closes the stream, so the remaining choices stop
+        generating tokens.
+        """
+        stream = self._request(messages=prompt, stream=True, **self.ai_kwargs)
+        texts = _ChoiceTexts()
+        try:
+            for chunk in stream:
+                yield from texts.add(chunk)
+        finally:
+            close = getattr(stream, "close", None)
+            if callable(close):
+                close()
+
+    def stream(self, *args: Any, **kwargs: Any) -> Iterator[Any]:
+        """Call the ghostfunction, yielding elements of its list result as they arrive.
+
+        The request is sent with `stream=True`, and each element is parsed and
+        validated against the element type of the return annotation (`List[X]`,
+        `Iterator[X]`, ...) as soon as the model has finished writing it.
+
+        Args:
+            args: Positional arguments of the call.
+            kwargs: Keyword arguments of the call.
+
+        Returns:
+            An iterator over the validated elements.
+        """
+        validator = self._element_validator()
+        prompt = self._prompt(*args, **kwargs)
+        return self._stream(prompt, validator)
+
+    def _stream(self, prompt: List[Message], validator: Validator) -> Iterator[Any]:
+        cached = self._from_cache(prompt)
+        if cached is not None:
+            texts: Iterable[str] = cached[:1]
+        else:
+            texts = chunk_texts(
+                self._request(messages=prompt, stream=True, **self.ai_kwargs)
+            )
+        parser = IncrementalListParser()
+        received = []
+        for text in texts:
+            received.append(text)
+            for element in parser.feed(text):
+                yield validator.parse(element)
+        parser.close()
+        if cached is None:
+            self._store_streamed(prompt, received)
+
+    def map(
+        self,
+        iterable_of_args: Iterable[Any],
+        max_concurrency: int = 8,
+        ordered: bool = True,
+        pack_size: int = 1,
+        max_retries: int = 2,
+    ) -> Iterator[Any]:
+        """Call the ghostfunction once per item of `iterable_of_args` using threads.
+
+        Each item is a tuple of positional arguments, a dict of keyword arguments,
+        or a single positional argument. At most `max_concurrency` requests are in
+        flight at once, and `iterable_of_args` is consumed lazily.
+
+        With `pack_size` > 1, up to `pack_size` argument sets are rendered into a single
+        prompt (see `packed_prompt_function`) and answered by one completion, so the
+        system prompt is sent once per pack instead of once per item. Items whose
+        answers fail to parse are re-issued, up to `max_retries` times.
+
+        Args:
+            iterable_of_args: The argument sets to call the ghostfunction with.
+            max_concurrency: The maximum number of concurrent requests.
+            ordered: Yield results in input order. If False, yield them as they complete.
+            pack_size: The number of argument sets answered per request.
+            max_retries: How many times to re-issue packed items that failed to parse.
+
+        Yields:
+            The result of each call. If a call raised, its exception is yielded in place
+            of the result instead of aborting the remaining calls.
+
+        Raises:
+            ValueError: If `max_concurrency` or `pack_size` is less than 1.
+        """
+        if max_concurrency < 1 or pack_size < 1:
+            raise ValueError("max_concurrency and pack_size must be at least 1.")
+
+        batch_size = self._batch_size(pack_size)
+
+        def call(chunk: List[Any]) -> List[Any]:
+            if batch_size:
+                return self._call_batch(chunk)
+            if pack_size > 1:
+                return self._call_packed(chunk, max_retries)
+            args, kwargs = _as_call_arguments(chunk[0])
+            try:
+                return [self(*args, **kwargs)]
+            except Exception as e:
+                return [e]
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            in_flight: Deque["Future[List[Any]]"] = deque()
+            for chunk in _chunked(iterable_of_args, batch_size or pack_size):
+                if len(in_flight) >= max_concurrency:
+                    yield from _drain(in_flight, ordered, until=max_concurrency - 1)
+                in_flight.append(executor.submit(call, chunk))
+            yield from _drain(in_flight, ordered, until=0)
+
+    def _call_batch(self, items: List[Any]) -> List[Any]:
+        assert self.backend is not None  # nosec
+        batch = _BackendBatch(self, items)
+        batch.parse_cached()
+        requests = batch.requests()
+        if requests:
+            try:
+                with phase("request"):
+                    ai_results = self.backend.complete_batch(requests)
+            except Exception as e:
+                batch.fail(e)
+            else:
+                batch.feed(ai_results)
+        return batch.outcomes
+
+    def _call_packed(self, items: List[Any], max_retries: int) -> List[Any]:
+        batch = _PackedBatch(self, items, max_retries)
+        prompt = batch.next_prompt()
+        while prompt is not None:
+            try:
+                ai_result = self._request(messages=prompt, **self._packed_ai_kwargs)
+            except Exception as e:
+                batch.fail(e)
+                break
+            batch.feed(ai_result)
+            prompt = batch.next_prompt()
+        return batch.outcomes
+
+
+def _drain(
+    in_flight: Deque["Future[List[Any]]"], ordered: bool, until: int
+) -> Iterator[Any]:
+    from concurrent.futures import FIRST_COMPLETED
+    from concurrent.futures import wait
+
+    while len(in_flight) > until:
+        if ordered:
+            yield from in_flight.popleft().result()
+            continue
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            in_flight.remove(future)
+            yield from future.result()
+
+
+class AsyncGhostFunction(_BaseGhostFunction):
+    """An async function whose logic is dispatched to the AI.
+
+    Instances are created by the `ghostfunction` decorator for `async def`
+    functions, or when `async_=True` is passed.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        """Create the ghostfunction, marking it as a coroutine function."""
+        super().__init__(*args, **kwargs)
+        if hasattr(inspect, "markcoroutinefunction"):  # python >= 3.12
+            inspect.markcoroutinefunction(self)
+        else:  # the marker `asyncio.iscoroutinefunction` looks for
+            from asyncio import coroutines
+
+            self._is_coroutine = coroutines._is_coroutine  # type: ignore[attr-defined]
+
+    @staticmethod
+    def _default_ai_callable() -> Callable[..., Any]:
+        return _default_async_ai_callable()
+
+    @staticmethod
+    def _backend_callable(backend: Backend) -> Callable[..., Any]:
+        return backend.acomplete
+
+    async def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        """Call the ghostfunction."""
+        if not get_hooks():
+            return await self._call(*args, **kwargs)
+        with instrument(self._qualified_name) as event:
+            event.result = await self._call(*args, **kwargs)
+        return event.result
+
+    async def _call(self, *args: Any, **kwargs: Any) -> Any:
+        if self.map_reduce is None:
+            return await self._call_one(*args, **kwargs)
+        return await afold(
+            self.apartials(*args, **kwargs),
+            self.map_reduce.reduce,
+            self.map_reduce.fanin,
+        )
+
+    def apartials(self, *args: Any, **kwargs: Any) -> AsyncIterator[Any]:
+        """Stream the partial results of a ghostfunction created with `map_reduce`.
+
+        The designated argument is split into chunks and the ghostfunction called on
+        each; the results are yielded in chunk order as they become available,
+        without being reduced.
+
+        Args:
+            args: Positional arguments of the call.
+            kwargs: Keyword arguments of the call.
+
+        Returns:
+            An async iterator of the partial results.
+        """
+        chunks = self._chunks(args, kwargs)
+        assert self.map_reduce is not None  # nosec
+        return amap_chunks(self._call_one, chunks, self.map_reduce.max_concurrency)
+
+    async def _call_one(self, *args: Any, **kwargs: Any) -> Any:
+        prompt, chunks = self._fit(self._prompt(*args, **kwargs), args, kwargs)
+        if chunks:
+            return await self._call_chunks(chunks)
+        cached = self._from_cache(prompt)
+        if cached is not None:
+            return await self._aparse(cached)
+        if self._flights is None:
+            return await self._fetch(prompt)
+        result, shared = await self._flights.ado(
+            make_cache_key(prompt, self.ai_kwargs), partial(self._fetch, prompt)
+        )
+        return copy.deepcopy(result) if shared else result
+
+    async def _fetch(self, prompt: List[Message]) -> Any:
+        n = self._incremental_choices()
+        if n:
+            return await self._call_incrementally(prompt, n)
+        if self.hedging is not None:
+            return await self._call_hedged(prompt, self.hedging)
+        ai_result = await self._request(messages=prompt, **self.ai_kwargs)
+        return await self._aparse_and_store(prompt, _completion_contents(ai_result))
+
+    async def _aparse(self, string_contents: List[str]) -> Any:
+        if not self._offloads(string_contents):
+            return self._parse(string_contents)
+        import asyncio
+
+        with phase("decode"):
+            return await asyncio.wrap_future(self._offload(string_contents))
+
+    async def _aparse_and_store(
+        self, prompt: List[Message], string_contents: List[str]
+    ) -> Any:
+        result = await self._aparse(string_contents)
+        if self.cache is not None:
+            self.cache.set(prompt, self.ai_kwargs, string_contents)
+        return result
+
+    async def _call_chunks(self, chunks: List[Dict[str, Any]]) -> Any:
+        assert self.token_budget is not None  # nosec
+        partials = amap_chunks(
+            self._call_one, chunks, self.token_budget.max_concurrency
+        )
+        return await afold(partials, self.token_budget.reduce)
+
+    async def _request(self, **kwargs: Any) -> Any:
+        with phase("request"):
+            ai_result = await get_scheduler().acall(
+                self.ai_callable,
+                kwargs,
+                key=self._qualified_name,
+                priority=self.priority,
+            )
+        record_response(ai_result)
+        return ai_result
+
+    async def _call_hedged(self, prompt: List[Message], policy: HedgingPolicy) -> Any:
+        import asyncio
+
+        race = _HedgeRace(self, prompt, policy)
+
+        def send() -> "asyncio.Future[Any]":
+            future = asyncio.ensure_future(
+                self._request(messages=prompt, **self.ai_kwargs)
+            )
+            race.add(future)
+            return future
+
+        pending = {send()}
+        try:
+            while True:
+                done, pending = await asyncio.wait(
+                    pending, timeout=race.timeout(), return_when=asyncio.FIRST_COMPLETED
+                )
+                won, result = await race.asettle(done, self._aparse_and_store)
+                if won:
+                    return result
+                if not done or not pending:
+                    if not race.can_hedge():
+                        race.fail()
+                    pending.add(send())
+        finally:
+            race.abandon(pending)
+
+    async def _call_incrementally(self, prompt: List[Message], n: int) -> Any:
+        tally = self._tally(n)
+        if tally.aggregator.strategy == "stream":
+            outcomes = self._streamed_choices(prompt)
+        else:
+            outcomes = self._concurrent_choices(prompt, n)
+        try:
+            async for outcome in outcomes:
+                if tally.add(outcome):
+                    break
+            else:
+                tally.finish()
+        finally:
+            await outcomes.aclose()
+        self._store_tally(prompt, tally)
+        return tally.result
+
+    async def _concurrent_choices(
+        self, prompt: List[Message], n: int
+    ) -> AsyncGenerator[Any, None]:
+        """Send `n` single-choice requests at once, yielding texts as they complete.
+
+        Closing the generator cancels the requests that are still outstanding.
+        """
+        import asyncio
+
+        kwargs = {**self.ai_kwargs, "n": 1}
+        tasks = [
+            asyncio.ensure_future(self._request(messages=prompt, **kwargs))
+            for _ in range(n)
+        ]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    yield _completion_contents(await next_done)[0]
+                except Exception as e:
+                    yield e
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _streamed_choices(
+        self, prompt: List[Message]
+    ) -> AsyncGenerator[Any, None]:
+        """Stream one `n`-choice request, yielding each choice once it has finished.
+
+        Closing the generator closes the stream, so the remaining choices stop
+        generating tokens.
+        """
+        stream = await self._request(messages=prompt, stream=True, **self.ai_kwargs)
+        texts = _ChoiceTexts()
+        try:
+            async for chunk in _aiter(stream):
+                for text in texts.add(chunk):
+                    yield text
+        finally:
+            close = getattr(stream, "close", None)
+            if callable(close):
+                closed = close()
+                if inspect.isawaitable(closed):
+                    await closed
+
+    def astream(self, *args: Any, **kwargs: Any) -> AsyncIterator[Any]:
+        """Call the ghostfunction, yielding elements of its list result as they arrive.
+
+        The async counterpart of `GhostFunction.stream`.
+
+        Args:
+            args: Positional arguments of the call.
+            kwargs: Keyword arguments of the call.
+
+        Returns:
+            An async iterator over the validated elements.
+        """
+        validator = self._element_validator()
+        prompt = self._prompt(*args, **kwargs)
+        return self._astream(prompt, validator)
+
+    async def _astream(
+        self, prompt: List[Message], validator: Validator
+    ) -> AsyncIterator[Any]:
+        cached = self._from_cache(prompt)
+        if cached is not None:
+            chunks: Union[Iterable[Any], AsyncIterable[Any]] = []
+        else:
+            chunks = await self._request(messages=prompt, stream=True, **self.ai_kwargs)
+        parser = IncrementalListParser()
+        received = []
+        async for chunk in _aiter(chunks):
+            text = chunk_text(chunk)
+            if text:
+                received.append(text)
+                for element in parser.feed(text):
+                    yield validator.parse(element)
+        for element in parser.feed(cached[0] if cached is not None else ""):
+            yield validator.parse(element)
+        parser.close()
+        if cached is None:
+            self._store_streamed(prompt, received)
+
+    async def amap(
+        self,
+        iterable_of_args: Union[Iterable[Any], AsyncIterable[Any]],
+        max_concurrency: int = 64,
+        ordered: bool = True,
+        pack_size: int = 1,
+        max_retries: int = 2,
+    ) -> AsyncIterator[Any]:
+        """Call the ghostfunction once per item of `iterable_of_args` on the event loop.
+
+        Each item is a tuple of positional arguments, a dict of keyword arguments,
+        or a single positional argument. At most `max_concurrency` requests are in
+        flight at once, and `iterable_of_args` is consumed lazily. `pack_size` and
+        `max_retries` behave as in `GhostFunction.map`.
+
+        Args:
+            iterable_of_args: The argument sets to call the ghostfunction with.
+            max_concurrency: The maximum number of concurrent requests.
+            ordered: Yield results in input order. If False, yield them as they complete.
+            pack_size: The number of argument sets answered per request.
+            max_retries: How many times to re-issue packed items that failed to parse.
+
+        Yields:
+            The result of each call. If a call raised, its exception is yielded in place
+            of the result instead of aborting the remaining calls.
+
+        Raises:
+            ValueError: If `max_concurrency` or `pack_size` is less than 1.
+        """
+        if max_concurrency < 1 or pack_size < 1:
+            raise ValueError("max_concurrency and pack_size must be at least 1.")
+
+        batch_size = self._batch_size(pack_size)
+
+        async def call(chunk: List[Any]) -> List[Any]:
+            if batch_size:
+                return await self._call_batch(chunk)
+            if pack_size > 1:
+                return await self._call_packed(chunk, max_retries)
+            args, kwargs = _as_call_arguments(chunk[0])
+            try:
+                return [await self(*args, **kwargs)]
+            except Exception as e:
+                return [e]
+
+        import asyncio
+
+        in_flight: Deque["asyncio.Task[List[Any]]"] = deque()
+        try:
+            async for chunk in _achunked(iterable_of_args, batch_size or pack_size):
+                while len(in_flight) >= max_concurrency:
+                    async for result in _adrain(in_flight, ordered):
+                        yield result
+                in_flight.append(asyncio.ensure_future(call(chunk)))
+            while in_flight:
+                async for result in _adrain(in_flight, ordered):
+                    yield result
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+    async def _call_batch(self, items: List[Any]) -> List[Any]:
+        assert self.backend is not None  # nosec
+        batch = _BackendBatch(self, items)
+        await batch.aparse_cached(self._aparse)
+        requests = batch.requests()
+        if requests:
+            try:
+                with phase("request"):
+                    ai_results = await self.backend.acomplete_batch(requests)
+            except Exception as e:
+                batch.fail(e)
+            else:
+                await batch.afeed(ai_results, self._aparse_and_store)
+        return batch.outcomes
+
+    async def _call_packed(self, items: List[Any], max_retries: int) -> List[Any]:
+        batch = _PackedBatch(self, items, max_retries)
+        prompt = batch.next_prompt()
+        while prompt is not None:
+            try:
+                ai_result = await self._request(
+                    messages=prompt, **self._packed_ai_kwargs
+                )
+            except Exception as e:
+                batch.fail(e)
+                break
+            batch.feed(ai_result)
+            prompt = batch.next_prompt()
+        return batch.outcomes
+
+
+async def _achunked(
+    iterable: Union[Iterable[Any], AsyncIterable[Any]], size: int
+) -> AsyncIterator[List[Any]]:
+    chunk: List[Any] = []
+    async for item in _aiter(iterable):
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def _aiter(
+    iterable: Union[Iterable[Any], AsyncIterable[Any]]
+) -> AsyncIterator[Any]:
+    if isinstance(iterable, AsyncIterable):
+        async for item in iterable:
+            yield item
+    else:
+        for item in iterable:
+            yield item
+
+
+async def _adrain(
+    in_flight: Deque["asyncio.Task[List[Any]]"], ordered: bool
+) -> AsyncIterator[Any]:
+    """Yield the next results (in order) or every finished result (as completed)."""
+    import asyncio
+
+    if ordered:
+        for result in await in_flight.popleft():
+            yield result
+        return
+    done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+    for task in done:
+        in_flight.remove(task)
+        for result in task.result():
+            yield result
 
 
 def ghostfunction(
     function: Optional[Callable[..., Any]] = None,
     /,
     *,
-    ai_callable: Optional[Callable[..., ChatCompletion]] = None,
+    ai_callable: Optional[
+        Callable[
+            ...,
+            Union[
+                "ChatCompletion",
+                Iterator["ChatCompletionChunk"],
+                Awaitable[
+                    Union["ChatCompletion", AsyncIterator["ChatCompletionChunk"]]
+                ],
+            ],
+        ]
+    ] = None,
     prompt_function: Callable[
         [Callable[..., Any]], List[Message]
     ] = _default_prompt_creation,
-    aggregation_function: Callable[..., Any] = lambda x: x[0],
+    aggregation_function: Callable[..., Any] = _first_choice,
+    cache: Optional[BaseCache] = None,
+    async_: bool = False,
+    packed_prompt_function: Callable[
+        [Callable[..., Any], Sequence[Tuple[Tuple[Any, ...], Dict[str, Any]]]],
+        List[Message],
+    ] = _default_packed_prompt_creation,
+    priority: int = 0,
+    hedging: Optional[HedgingPolicy] = None,
+    coalesce: bool = False,
+    token_budget: Optional[TokenBudget] = None,
+    map_reduce: Optional[MapReduce] = None,
+    structured_output: bool = False,
+    offload: Optional[ParseOffload] = None,
+    backend: Optional[Backend] = None,
     **kwargs: Any,
 ) -> Callable[..., Any]:
     '''Decorate `function` to make it a ghostfunction which dispatches logic to the AI.
@@ -161,14 +1501,59 @@ def ghostfunction(
     Args:
         function: The function to decorate
         ai_callable: Function to receives output of prompt_function and return result.
+            Async ghostfunctions also accept a coroutine function here. For
+            `stream`/`astream`, it may return (or await to) an iterator of
+            `ChatCompletionChunk`s instead. Defaults to calling the OpenAI API, set up
+            on the first call of the ghostfunction.
         prompt_function: Function to turn the function into a prompt.
         aggregation_function: Function to aggregate the `n` choices from the OpenAI API.
             Ghostfunctions passes a list of `n` different results from OpenAI (parsed into python
             data structures) to this function for aggregation into the output of the ghostfunction.
-        kwargs: Extra keyword arguments to pass to `ai_callable`.
+        cache: Optional cache (see `ai_ghostfunctions.cache`) holding the raw completion
+            text for each prompt and set of `kwargs`. Repeated calls with the same
+            arguments are answered from the cache instead of calling `ai_callable`.
+        async_: Return a coroutine function even if `function` is a plain function.
+            Decorating an `async def` function always produces an async ghostfunction,
+            which calls `openai.AsyncOpenAI` by default.
+        packed_prompt_function: Function to turn the function and a sequence of
+            `(args, kwargs)` argument sets into one prompt asking for a list of results.
+            Used by `map`/`amap` when `pack_size` > 1.
+        priority: Priority of this function's requests when the shared rate limiter
+            (see `ai_ghostfunctions.ratelimit`) makes requests wait. Higher values are
+            sent first; requests of equal priority take turns between functions.
+        hedging: Optional `ai_ghostfunctions.hedging.HedgingPolicy`. If a response
+            takes longer than the policy's delay, the request is sent again and the
+            first response that parses is returned. Share one policy between
+            functions to pool their latency statistics and counters.
+        coalesce: Share one request between concurrent calls with the same arguments
+            (see `ai_ghostfunctions.singleflight`). Calls arriving while an identical
+            call is in flight wait for it and return a copy of its result.
+        token_budget: Optional `ai_ghostfunctions.tokens.TokenBudget` limiting the
+            prompt tokens of a call. Prompts over budget have their largest
+            arguments truncated or sampled, or are split into chunks whose results
+            are combined, depending on the budget's strategy.
+        map_reduce: Optional `ai_ghostfunctions.mapreduce.MapReduce`. Each call splits
+            the argument it names into chunks, calls the ghostfunction on every chunk
+            concurrently and reduces the partial results into the return value.
+        structured_output: Request JSON matching a schema derived from the return
+            annotation (`response_format` of type `json_schema`, see
+            `ai_ghostfunctions.schema`) and parse it with a JSON decoder, instead of
+            asking for a python repr.
+        offload: Optional `ai_ghostfunctions.offload.ParseOffload`. Responses longer
+            than its threshold are parsed in its worker pool, so that parsing them
+            does not hold up the other threads of the process.
+        backend: Optional `ai_ghostfunctions.backends.Backend` answering the requests
+            instead of `ai_callable`, e.g. a local model. With a batch-capable
+            backend, `map` sends argument sets to it in batches.
+        kwargs: Extra keyword arguments to pass to `ai_callable`. With the default
+            `ai_callable`, `model` may be a model name or a list of models to try in
+            order (see `ai_ghostfunctions.routing`).
 
     Returns:
-        Decorated function that will dispatch function logic to OpenAI.
+        Decorated function that will dispatch function logic to OpenAI: a `GhostFunction`,
+        or an `AsyncGhostFunction` when `function` is a coroutine function or `async_` is
+        set. Use their `map`/`amap` methods to call the ghostfunction over many
+        argument sets concurrently.
 
     Notes:
         This function is intended to be used as a decorator. See Example.
@@ -188,28 +1573,30 @@ def ghostfunction(
         ['goofy', 'google', 'goose', 'goodness']
         >>> # xdoctest: -SKIP
     '''
-    if not callable(ai_callable):
-        ai_callable = _default_ai_callable()
 
     def new_decorator(
         function_to_be_decorated: Callable[..., Any]
     ) -> Callable[..., Any]:
         _assert_function_has_return_type_annotation(function_to_be_decorated)
-        return_type_annotation = get_type_hints(function_to_be_decorated)["return"]
-
-        @wraps(function_to_be_decorated)
-        def wrapper(*args_inner: Any, **kwargs_inner: Any) -> Any:
-            prompt = prompt_function(
-                function_to_be_decorated, *args_inner, **kwargs_inner
-            )
-            ai_result = ai_callable(messages=prompt, **kwargs)
-            return _parse_ai_result(
-                ai_result=ai_result,
-                expected_return_type=return_type_annotation,
-                aggregation_function=aggregation_function,
-            )
-
-        return wrapper
+        is_async = async_ or inspect.iscoroutinefunction(function_to_be_decorated)
+        ghostfunction_class = AsyncGhostFunction if is_async else GhostFunction
+        return ghostfunction_class(
+            function_to_be_decorated,
+            ai_callable=ai_callable if callable(ai_callable) else None,
+            prompt_function=prompt_function,
+            aggregation_function=aggregation_function,
+            cache=cache,
+            ai_kwargs=kwargs,
+            packed_prompt_function=packed_prompt_function,
+            priority=priority,
+            hedging=hedging,
+            coalesce=coalesce,
+            token_budget=token_budget,
+            map_reduce=map_reduce,
+            structured_output=structured_output,
+            offload=offload,
+            backend=backend,
+        )
 
     # to work around mypy:
     # https://github.com/python/mypy/issues/10740#issuecomment-878622464
@@ -0,0 +1,118 @@
+"""Hedged requests, trading a few extra tokens for a shorter latency tail.
+
+With a `HedgingPolicy`, a ghostfunction that has not received a response after a
+delay sends the same request again, and returns the first response that parses
+into its return type. The other request is cancelled if it has not started, and
+otherwise ignored. The delay is either fixed or a percentile of the recently
+observed latencies, so only the slowest requests are duplicated.
+"""
+
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Any
+from typing import Deque
+from typing import Optional
+
+
+@dataclass(frozen=True)
+class HedgingStats:
+    """Counters describing how a hedging policy has been used.
+
+    `extra_tokens` counts the tokens of responses that were received but not used.
+    Requests abandoned before answering are not included, as their usage is unknown.
+    """
+
+    requests: int = 0
+    hedges_fired: int = 0
+    hedges_won: int = 0
+    extra_tokens: int = 0
+
+
+class HedgingPolicy:
+    """Decide when a ghostfunction sends a duplicate request.
+
+    Args:
+        delay: Seconds to wait for a response before hedging. If None, the delay is
+            the `percentile` of the latencies observed by this policy.
+        percentile: The latency percentile used when `delay` is None.
+        window: The number of recent latencies the percentile is computed over.
+        min_samples: Latencies needed before a learned delay is used. Until then
+            requests are not hedged.
+        max_hedges: The maximum number of duplicate requests per call. A response
+            that fails to parse also triggers the next hedge immediately.
+    """
+
+    def __init__(
+        self,
+        delay: Optional[float] = None,
+        percentile: float = 95.0,
+        window: int = 200,
+        min_samples: int = 20,
+        max_hedges: int = 1,
+    ) -> None:
+        """Create the policy."""
+        if not 0 <= percentile <= 100:
+            raise ValueError("percentile must be between 0 and 100.")
+        self.fixed_delay = delay
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_hedges = max_hedges
+        self._lock = threading.Lock()
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self._requests = 0
+        self._hedges_fired = 0
+        self._hedges_won = 0
+        self._extra_tokens = 0
+
+    def delay(self) -> Optional[float]:
+        """Return the seconds to wait for a response before hedging.
+
+        Returns:
+            The delay, or None if requests should not be hedged yet.
+        """
+        if self.fixed_delay is not None:
+            return self.fixed_delay
+        with self._lock:
+            if len(self._latencies) < max(self.min_samples, 1):
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[round(self.percentile / 100 * (len(latencies) - 1))]
+
+    def record_latency(self, seconds: float) -> None:
+        """Record how long a request took to answer.
+
+        Args:
+            seconds: The latency of the request.
+        """
+        with self._lock:
+            self._latencies.append(seconds)
+
+    @property
+    def stats(self) -> HedgingStats:
+        """A snapshot of the hedging counters."""
+        with self._lock:
+            return HedgingStats(
+                requests=self._requests,
+                hedges_fired=self._hedges_fired,
+                hedges_won=self._hedges_won,
+                extra_tokens=self._extra_tokens,
+            )
+
+    def _record_request(self) -> None:
+        with self._lock:
+            self._requests += 1
+
+    def _record_hedge(self) -> None:
+        with self._lock:
+            self._hedges_fired += 1
+
+    def _record_win(self) -> None:
+        with self._lock:
+            self._hedges_won += 1
+
+    def _record_unused(self, ai_result: Any) -> None:
+        tokens = getattr(getattr(ai_result, "usage", None), "total_tokens", None)
+        if isinstance(tokens, int):
+            with self._lock:
+                self._extra_tokens += tokens
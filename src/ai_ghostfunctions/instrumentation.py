@@ -0,0 +1,581 @@
+"""Hooks observing ghostfunction calls, and a metrics collector built on them.
+
+Register a `Hook` with `add_hook` to be told when a call starts (`before_prompt`),
+when each response arrives (`after_request`), when the result is ready
+(`after_parse`) and when a call fails (`on_error`). Each event carries a `CallEvent`
+with the time spent in every phase of the call: prompt construction, cache
+lookup, the request itself, decoding the completion text, validating it against
+the return type, and aggregating the choices.
+
+`MetricsCollector` is a hook keeping per-function latency histograms and counters,
+exportable in the Prometheus text format. `OpenTelemetryHook` records each call as
+a span when `opentelemetry-api` is installed.
+
+Without registered hooks, calls skip all of this bookkeeping.
+"""
+
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from dataclasses import field
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import TypeVar
+
+from .types import Message
+
+
+PHASES = ("prompt", "cache", "request", "decode", "validate", "aggregate")
+_PARSE_PHASES = frozenset({"decode", "validate", "aggregate"})
+
+
+@dataclass
+class CallEvent:
+    """What is known about a ghostfunction call when a hook runs.
+
+    Args:
+        function: The qualified name of the ghostfunction.
+        started: `time.perf_counter()` when the call started.
+        prompt: The messages sent, once built.
+        ai_result: The most recent response of the `ai_callable`.
+        result: The value returned by the ghostfunction.
+        error: The exception raised by the call.
+        cached: Whether the result was answered from the cache.
+        requests: The number of responses received.
+        retries: The number of requests retried by the rate limiter.
+        parse_failures: The number of responses that failed to parse.
+        prompt_tokens: Prompt tokens reported by the responses' `usage`.
+        completion_tokens: Completion tokens reported by the responses' `usage`.
+        timings: Seconds spent in each phase (see `PHASES`). Concurrent requests
+            add up, so phases can exceed the call's duration.
+        duration: Seconds the whole call took, once finished.
+        extras: Storage for hooks that need per-call state.
+    """
+
+    function: str
+    started: float = field(default_factory=time.perf_counter)
+    prompt: Optional[List[Message]] = None
+    ai_result: Any = None
+    result: Any = None
+    error: Optional[BaseException] = None
+    cached: bool = False
+    requests: int = 0
+    retries: int = 0
+    parse_failures: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    timings: Dict[str, float] = field(default_factory=dict)
+    duration: Optional[float] = None
+    extras: Dict[Any, Any] = field(default_factory=dict)
+
+
+class Hook:
+    """Base class for instrumentation hooks. Override the events of interest.
+
+    Hooks run synchronously in the calling thread; exceptions they raise propagate
+    to the caller of the ghostfunction.
+    """
+
+    def before_prompt(self, event: CallEvent) -> None:
+        """Run when a call starts, before its prompt is built.
+
+        Args:
+            event: The call.
+        """
+
+    def after_request(self, event: CallEvent) -> None:
+        """Run when a response from the `ai_callable` arrives.
+
+        Args:
+            event: The call. `event.ai_result` is the response.
+        """
+
+    def after_parse(self, event: CallEvent) -> None:
+        """Run when a call returns.
+
+        Args:
+            event: The call. `event.result` is the returned value.
+        """
+
+    def on_error(self, event: CallEvent) -> None:
+        """Run when a call raises.
+
+        Args:
+            event: The call. `event.error` is the exception.
+        """
+
+
+H = TypeVar("H", bound=Hook)
+
+_lock = threading.Lock()
+_hooks: Tuple[Hook, ...] = ()
+_current: "contextvars.ContextVar[Optional[CallEvent]]" = contextvars.ContextVar(
+    "ai_ghostfunctions_call", default=None
+)
+
+
+def add_hook(hook: H) -> H:
+    """Register `hook` for every ghostfunction call.
+
+    Args:
+        hook: The hook.
+
+    Returns:
+        The hook, so this can be used as `collector = add_hook(MetricsCollector())`.
+    """
+    global _hooks
+    with _lock:
+        _hooks = (*_hooks, hook)
+    return hook
+
+
+def remove_hook(hook: Hook) -> None:
+    """Unregister `hook`.
+
+    Args:
+        hook: A hook registered with `add_hook`.
+    """
+    global _hooks
+    with _lock:
+        _hooks = tuple(h for h in _hooks if h is not hook)
+
+
+def get_hooks() -> Sequence[Hook]:
+    """Return the registered hooks.
+
+    Returns:
+        The hooks, in registration order.
+    """
+    return _hooks
+
+
+def current_event() -> Optional[CallEvent]:
+    """Return the event of the ghostfunction call running in this context.
+
+    Returns:
+        The event, or None outside an instrumented call.
+    """
+    return _current.get()
+
+
+@contextmanager
+def instrument(function: str) -> Iterator[CallEvent]:
+    """Track a ghostfunction call, running the hooks at its start and end.
+
+    Args:
+        function: The qualified name of the ghostfunction.
+
+    Yields:
+        The event of the call. Set its `result` before leaving the block.
+
+    Raises:
+        BaseException: Whatever the call raised, after the `on_error` hooks ran.
+    """
+    hooks = _hooks
+    event = CallEvent(function)
+    token = _current.set(event)
+    try:
+        for hook in hooks:
+            hook.before_prompt(event)
+        yield event
+    except BaseException as e:
+        event.error = e
+        event.duration = time.perf_counter() - event.started
+        for hook in hooks:
+            hook.on_error(event)
+        raise
+    else:
+        event.duration = time.perf_counter() - event.started
+        for hook in hooks:
+            hook.after_parse(event)
+    finally:
+        _current.reset(token)
+
+
+class _NoPhase:
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *exc_info: Any) -> None:
+        return None
+
+
+_NO_PHASE = _NoPhase()
+
+
+class _Phase:
+    def __init__(self, event: CallEvent, name: str) -> None:
+        self.event = event
+        self.name = name
+
+    def __enter__(self) -> None:
+        self.started = time.perf_counter()
+
+    def __exit__(self, exc_type: Any, *exc_info: Any) -> None:
+        timings = self.event.timings
+        elapsed = time.perf_counter() - self.started
+        timings[self.name] = timings.get(self.name, 0.0) + elapsed
+        if exc_type is not None and self.name in _PARSE_PHASES:
+            self.event.parse_failures += 1
+
+
+def phase(name: str) -> Any:
+    """Return a context manager timing a phase of the current call.
+
+    Args:
+        name: The phase, one of `PHASES`.
+
+    Returns:
+        The context manager. It does nothing outside an instrumented call.
+    """
+    event = _current.get()
+    return _NO_PHASE if event is None else _Phase(event, name)
+
+
+def record_response(ai_result: Any) -> None:
+    """Record a response of the `ai_callable` and run the `after_request` hooks.
+
+    Args:
+        ai_result: The response.
+    """
+    event = _current.get()
+    if event is None:
+        return
+    event.ai_result = ai_result
+    event.requests += 1
+    usage = getattr(ai_result, "usage", None)
+    if usage is not None:
+        event.prompt_tokens += getattr(usage, "prompt_tokens", None) or 0
+        event.completion_tokens += getattr(usage, "completion_tokens", None) or 0
+    for hook in _hooks:
+        hook.after_request(event)
+
+
+def record_cache_hit() -> None:
+    """Record that the current call was answered from the cache."""
+    event = _current.get()
+    if event is not None:
+        event.cached = True
+
+
+def record_retry() -> None:
+    """Record that a request of the current call is being retried."""
+    event = _current.get()
+    if event is not None:
+        event.retries += 1
+
+
+class Histogram:
+    """A cumulative histogram in the style of Prometheus.
+
+    Not thread safe: `MetricsCollector` guards its histograms with its own lock.
+
+    Args:
+        buckets: The upper bounds of the buckets, ascending.
+    """
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        """Create an empty histogram."""
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """Add an observation.
+
+        Args:
+            value: The observed value.
+        """
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate a quantile as the upper bound of the bucket containing it.
+
+        Args:
+            q: The quantile, between 0 and 1.
+
+        Returns:
+            The bucket bound, `inf` past the last bucket, or None if empty.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        for bound, count in zip(self.buckets, self.counts):  # noqa: B905
+            if count >= rank:
+                return bound
+        return float("inf")
+
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+_COUNTERS = (
+    "calls",
+    "errors",
+    "cache_hits",
+    "requests",
+    "retries",
+    "parse_failures",
+    "prompt_tokens",
+    "completion_tokens",
+)
+
+
+@dataclass(frozen=True)
+class FunctionMetrics:
+    """Counters collected for one ghostfunction."""
+
+    calls: int = 0
+    errors: int = 0
+    cache_hits: int = 0
+    requests: int = 0
+    retries: int = 0
+    parse_failures: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+class MetricsCollector(Hook):
+    """Collect per-function latency histograms and counters.
+
+    Args:
+        buckets: The histogram bucket bounds, in seconds.
+        namespace: Prefix of the exported metric names.
+    """
+
+    def __init__(
+        self,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+        namespace: str = "ghostfunction",
+    ) -> None:
+        """Create an empty collector."""
+        self.buckets = tuple(buckets)
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[str, int]] = {}
+        self._latency: Dict[str, Histogram] = {}
+        self._phases: Dict[Tuple[str, str], Histogram] = {}
+
+    def after_parse(self, event: CallEvent) -> None:
+        """Record a successful call.
+
+        Args:
+            event: The call.
+        """
+        self._record(event)
+
+    def on_error(self, event: CallEvent) -> None:
+        """Record a failed call.
+
+        Args:
+            event: The call.
+        """
+        self._record(event)
+
+    def _record(self, event: CallEvent) -> None:
+        name = event.function
+        with self._lock:
+            counters = self._counters.setdefault(name, dict.fromkeys(_COUNTERS, 0))
+            counters["calls"] += 1
+            counters["errors"] += event.error is not None
+            counters["cache_hits"] += event.cached
+            counters["requests"] += event.requests
+            counters["retries"] += event.retries
+            counters["parse_failures"] += event.parse_failures
+            counters["prompt_tokens"] += event.prompt_tokens
+            counters["completion_tokens"] += event.completion_tokens
+            if event.duration is not None:
+                self._histogram(self._latency, name).observe(event.duration)
+            for phase_name, seconds in event.timings.items():
+                self._histogram(self._phases, (name, phase_name)).observe(seconds)
+
+    def _histogram(self, histograms: Dict[Any, Histogram], key: Any) -> Histogram:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(self.buckets)
+        return histogram
+
+    def metrics(self) -> Dict[str, FunctionMetrics]:
+        """Return a snapshot of the counters of every function.
+
+        Returns:
+            The counters, keyed by qualified function name.
+        """
+        with self._lock:
+            return {k: FunctionMetrics(**v) for k, v in self._counters.items()}
+
+    def latency(
+        self, function: str, phase: Optional[str] = None
+    ) -> Optional[Histogram]:
+        """Return the latency histogram of a function or of one phase of its calls.
+
+        Args:
+            function: The qualified function name.
+            phase: One of `PHASES`, or None for the whole call.
+
+        Returns:
+            The histogram (not a copy), or None if nothing was recorded.
+        """
+        with self._lock:
+            if phase is None:
+                return self._latency.get(function)
+            return self._phases.get((function, phase))
+
+    def reset(self) -> None:
+        """Forget everything collected so far."""
+        with self._lock:
+            self._counters.clear()
+            self._latency.clear()
+            self._phases.clear()
+
+    def prometheus_text(self) -> str:
+        """Render the metrics in the Prometheus text exposition format.
+
+        Returns:
+            The metrics, ready to be served on a `/metrics` endpoint.
+        """
+        ns = self.namespace
+        lines: List[str] = []
+        with self._lock:
+            lines += [
+                f"# HELP {ns}_call_duration_seconds Duration of ghostfunction calls.",
+                f"# TYPE {ns}_call_duration_seconds histogram",
+            ]
+            for name, histogram in sorted(self._latency.items()):
+                lines += _histogram_lines(
+                    f"{ns}_call_duration_seconds", {"function": name}, histogram
+                )
+            lines += [
+                f"# HELP {ns}_phase_duration_seconds Time spent in each phase of a call.",
+                f"# TYPE {ns}_phase_duration_seconds histogram",
+            ]
+            for (name, phase_name), histogram in sorted(self._phases.items()):
+                labels = {"function": name, "phase": phase_name}
+                lines += _histogram_lines(
+                    f"{ns}_phase_duration_seconds", labels, histogram
+                )
+            for counter in _COUNTERS:
+                metric = f"{ns}_{counter}_total"
+                lines += [
+                    f"# HELP {metric} Total {counter.replace('_', ' ')}.",
+                    f"# TYPE {metric} counter",
+                ]
+                for name, counters in sorted(self._counters.items()):
+                    lines.append(
+                        f"{metric}{_labels({'function': name})} {counters[counter]}"
+                    )
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    pairs = ",".join(k + '="' + _escape(v) + '"' for k, v in labels.items())
+    return "{" + pairs + "}"
+
+
+def _histogram_lines(
+    metric: str, labels: Dict[str, str], histogram: Histogram
+) -> List[str]:
+    lines = [
+        f"{metric}_bucket{_labels({**labels, 'le': repr(float(bound))})} {count}"
+        for bound, count in zip(histogram.buckets, histogram.counts)  # noqa: B905
+    ]
+    lines.append(
+        f"{metric}_bucket{_labels({**labels, 'le': '+Inf'})} {histogram.count}"
+    )
+    lines.append(f"{metric}_sum{_labels(labels)} {histogram.sum!r}")
+    lines.append(f"{metric}_count{_labels(labels)} {histogram.count}")
+    return lines
+
+
+class OpenTelemetryHook(Hook):
+    """Record every ghostfunction call as an OpenTelemetry span.
+
+    Args:
+        tracer: The tracer creating the spans. Defaults to the tracer of the global
+            tracer provider, which requires the `opentelemetry-api` package.
+    """
+
+    def __init__(self, tracer: Any = None) -> None:
+        """Create the hook."""
+        if tracer is None:
+            from opentelemetry import trace
+
+            tracer = trace.get_tracer("ai_ghostfunctions")
+        self.tracer = tracer
+
+    def before_prompt(self, event: CallEvent) -> None:
+        """Start the span of the call.
+
+        Args:
+            event: The call.
+        """
+        event.extras[self] = self.tracer.start_span(f"ghostfunction {event.function}")
+
+    def after_parse(self, event: CallEvent) -> None:
+        """End the span of the call.
+
+        Args:
+            event: The call.
+        """
+        self._end(event)
+
+    def on_error(self, event: CallEvent) -> None:
+        """Record the exception and end the span of the call.
+
+        Args:
+            event: The call.
+        """
+        span = event.extras.get(self)
+        if span is not None and event.error is not None:
+            span.record_exception(event.error)
+            try:
+                from opentelemetry.trace import Status
+                from opentelemetry.trace import StatusCode
+
+                span.set_status(Status(StatusCode.ERROR, str(event.error)))
+            except ImportError:
+                pass
+        self._end(event)
+
+    def _end(self, event: CallEvent) -> None:
+        span = event.extras.pop(self, None)
+        if span is None:
+            return
+        span.set_attribute("ghostfunction.function", event.function)
+        span.set_attribute("ghostfunction.cached", event.cached)
+        span.set_attribute("ghostfunction.requests", event.requests)
+        span.set_attribute("ghostfunction.retries", event.retries)
+        span.set_attribute("ghostfunction.parse_failures", event.parse_failures)
+        span.set_attribute("ghostfunction.prompt_tokens", event.prompt_tokens)
+        span.set_attribute("ghostfunction.completion_tokens", event.completion_tokens)
+        for phase_name, seconds in event.timings.items():
+            span.set_attribute(f"ghostfunction.{phase_name}_seconds", seconds)
+        span.end()
+
+
+def enable_opentelemetry() -> Optional[OpenTelemetryHook]:
+    """Register an `OpenTelemetryHook` if `opentelemetry-api` is installed.
+
+    Returns:
+        The registered hook, or None if OpenTelemetry is not available.
+    """
+    try:
+        hook = OpenTelemetryHook()
+    except ImportError:
+        return None
+    add_hook(hook)
+    return hook
@@ -0,0 +1,271 @@
+"""Map-reduce execution of ghostfunctions over inputs larger than one prompt.
+
+A ghostfunction created with `map_reduce=MapReduce("texts")` splits its `texts`
+argument into chunks, calls itself on every chunk concurrently, and folds the
+partial results into one with `reduce`, a python callable or another ghostfunction
+taking the list of partial results::
+
+    @ghostfunction
+    def combine(summaries: List[str]) -> str:
+        '''Return one summary of all the `summaries`.'''
+
+    @ghostfunction(map_reduce=MapReduce("texts", chunk_size=20, reduce=combine, fanin=8))
+    def summarize(texts: List[str]) -> str:
+        '''Return a summary of `texts`.'''
+
+Memory stays bounded: chunks are cut lazily from the argument (which may be any
+iterable, e.g. a generator reading a file), at most `max_concurrency` chunks are
+in flight, and with `fanin` set partial results are reduced in a tree as soon as
+`fanin` of them are available, instead of all at the end. `GhostFunction.partials`
+streams the partial results themselves.
+"""
+
+import inspect
+from collections import deque
+from contextvars import copy_context
+from functools import partial
+from itertools import islice
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import AsyncIterator
+from typing import Awaitable
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Mapping
+from typing import Optional
+from typing import Tuple
+
+from .tokens import concatenate
+
+
+if TYPE_CHECKING:  # imported on first use to keep `import ai_ghostfunctions` fast
+    from concurrent.futures import Future
+
+Reduce = Callable[[List[Any]], Any]
+
+
+def map_chunks(
+    call: Callable[..., Any], chunks: Iterable[Dict[str, Any]], max_concurrency: int
+) -> Iterator[Any]:
+    """Call `call(**chunk)` for every chunk using threads, yielding results in order.
+
+    Args:
+        call: The function to call.
+        chunks: The keyword arguments of each call, consumed lazily.
+        max_concurrency: The maximum number of calls in flight.
+
+    Yields:
+        The result of each call. The first exception raised by a call is raised.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        in_flight: Deque["Future[Any]"] = deque()
+        try:
+            for chunk in chunks:
+                if len(in_flight) >= max_concurrency:
+                    yield in_flight.popleft().result()
+                in_flight.append(
+                    executor.submit(copy_context().run, partial(call, **chunk))
+                )
+            while in_flight:
+                yield in_flight.popleft().result()
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+
+async def amap_chunks(
+    call: Callable[..., Awaitable[Any]],
+    chunks: Iterable[Dict[str, Any]],
+    max_concurrency: int,
+) -> AsyncIterator[Any]:
+    """Await `call(**chunk)` for every chunk concurrently, yielding results in order.
+
+    Args:
+        call: The coroutine function to call.
+        chunks: The keyword arguments of each call, consumed lazily.
+        max_concurrency: The maximum number of calls in flight.
+
+    Yields:
+        The result of each call. The first exception raised by a call is raised.
+    """
+    import asyncio
+
+    in_flight: Deque["asyncio.Future[Any]"] = deque()
+    try:
+        for chunk in chunks:
+            if len(in_flight) >= max_concurrency:
+                yield await in_flight.popleft()
+            in_flight.append(asyncio.ensure_future(call(**chunk)))
+        while in_flight:
+            yield await in_flight.popleft()
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+
+class _TreeFold:
+    """Partial results waiting to be reduced, by depth in the reduction tree."""
+
+    def __init__(self, fanin: Optional[int]) -> None:
+        self.fanin = fanin
+        self.levels: List[List[Any]] = []
+
+    def add(self, value: Any, level: int = 0) -> Optional[Tuple[List[Any], int]]:
+        """Add a value; return a full group to reduce and the level of its result."""
+        while len(self.levels) <= level:
+            self.levels.append([])
+        self.levels[level].append(value)
+        if self.fanin is None or len(self.levels[level]) < self.fanin:
+            return None
+        group, self.levels[level] = self.levels[level], []
+        return group, level + 1
+
+    def groups(self) -> List[List[Any]]:
+        """Return the remaining values, in input order, in groups of `fanin`."""
+        # deeper levels hold reductions of earlier values
+        return _regroup(
+            [v for level in reversed(self.levels) for v in level], self.fanin
+        )
+
+
+def _regroup(values: List[Any], fanin: Optional[int]) -> List[List[Any]]:
+    size = fanin or max(len(values), 1)
+    return [values[i : i + size] for i in range(0, len(values), size)] or [[]]
+
+
+def fold(partials: Iterable[Any], reduce: Reduce, fanin: Optional[int] = None) -> Any:
+    """Reduce partial results to one, in a tree of `fanin` children per node.
+
+    Args:
+        partials: The partial results, in order.
+        reduce: Combines a list of partial results into one.
+        fanin: How many results are reduced at a time. `None` reduces all of them
+            at once, at the end.
+
+    Returns:
+        The reduced result. A single partial result is returned as is.
+    """
+    tree = _TreeFold(fanin)
+    for value in partials:
+        full = tree.add(value)
+        while full is not None:
+            group, level = full
+            full = tree.add(reduce(group), level)
+    groups = tree.groups()
+    while len(groups) > 1 or len(groups[0]) != 1:
+        values = [group[0] if len(group) == 1 else reduce(group) for group in groups]
+        groups = _regroup(values, fanin)
+    return groups[0][0]
+
+
+async def afold(
+    partials: AsyncIterator[Any], reduce: Reduce, fanin: Optional[int] = None
+) -> Any:
+    """Reduce partial results to one like `fold`, awaiting async `reduce` results.
+
+    Args:
+        partials: The partial results, in order.
+        reduce: Combines a list of partial results into one; it may be a coroutine
+            function, such as an async ghostfunction.
+        fanin: How many results are reduced at a time. `None` reduces all of them
+            at once, at the end.
+
+    Returns:
+        The reduced result. A single partial result is returned as is.
+    """
+
+    async def areduce(group: List[Any]) -> Any:
+        result = reduce(group)
+        return await result if inspect.isawaitable(result) else result
+
+    tree = _TreeFold(fanin)
+    async for value in partials:
+        full = tree.add(value)
+        while full is not None:
+            group, level = full
+            full = tree.add(await areduce(group), level)
+    groups = tree.groups()
+    while len(groups) > 1 or len(groups[0]) != 1:
+        values = [
+            group[0] if len(group) == 1 else await areduce(group) for group in groups
+        ]
+        groups = _regroup(values, fanin)
+    return groups[0][0]
+
+
+class MapReduce:
+    """How a ghostfunction splits an argument and combines the partial results.
+
+    Args:
+        argument: The name of the parameter to split. Strings, bytes, lists and
+            tuples are sliced, dicts, sets and frozensets split into smaller ones of
+            the same type, and other iterables into lists, consumed lazily.
+        chunk_size: The number of elements (characters for strings) per chunk.
+        reduce: Combines a list of partial results into one: a python callable, or a
+            ghostfunction taking a list. Defaults to concatenating lists and joining
+            strings (see `ai_ghostfunctions.tokens.concatenate`).
+        fanin: Reduce partial results in groups of this size as they arrive, and the
+            reduced results again in groups of this size, until one is left. `None`
+            reduces all partial results at once, at the end.
+        max_concurrency: The maximum number of chunks processed at once.
+
+    Raises:
+        ValueError: If `chunk_size` or `max_concurrency` is less than 1, or `fanin`
+            is less than 2.
+    """
+
+    def __init__(
+        self,
+        argument: str,
+        chunk_size: int = 100,
+        reduce: Reduce = concatenate,
+        fanin: Optional[int] = None,
+        max_concurrency: int = 8,
+    ) -> None:
+        """Create the configuration."""
+        if chunk_size < 1 or max_concurrency < 1:
+            raise ValueError("chunk_size and max_concurrency must be at least 1.")
+        if fanin is not None and fanin < 2:
+            raise ValueError("fanin must be at least 2.")
+        self.argument = argument
+        self.chunk_size = chunk_size
+        self.reduce = reduce
+        self.fanin = fanin
+        self.max_concurrency = max_concurrency
+
+    def chunks(self, arguments: Mapping[str, Any]) -> Iterator[Dict[str, Any]]:
+        """Split the arguments of a call into the arguments of each chunk.
+
+        Args:
+            arguments: The arguments of the call, by parameter name.
+
+        Yields:
+            The arguments of each chunk, lazily. An empty argument gives one chunk.
+        """
+        empty = True
+        for chunk in self._split(arguments[self.argument]):
+            empty = False
+            yield {**arguments, self.argument: chunk}
+        if empty:
+            yield dict(arguments)
+
+    def _split(self, value: Any) -> Iterator[Any]:
+        size = self.chunk_size
+        if isinstance(value, (str, bytes, list, tuple)):
+            for start in range(0, len(value), size):
+                yield value[start : start + size]
+            return
+        kind: Callable[[Any], Any] = list
+        if isinstance(value, (dict, set, frozenset)):
+            kind = type(value)
+        iterator = iter(value.items() if isinstance(value, dict) else value)
+        chunk = list(islice(iterator, size))
+        while chunk:
+            yield kind(chunk)
+            chunk = list(islice(iterator, size))
@@ -0,0 +1,286 @@
+"""Parsing of large responses away from the calling thread's interpreter lock.
+
+Turning a long response into python objects (`ast.literal_eval`, then type checking
+every element) is pure python work that holds the GIL: while one thread parses a
+list of ten thousand dicts, the other threads of the process, e.g. those waiting on
+the network for other ghostfunctions, cannot run. A ghostfunction created with
+`offload=ParseOffload()` parses responses longer than `threshold` characters in a
+worker process instead; the calling thread waits without holding the GIL, and an
+async caller's event loop keeps running::
+
+    offload = ParseOffload(threshold=100_000)
+
+    @ghostfunction(offload=offload)
+    def records() -> List[Dict[str, Any]]:
+        '''Return records.'''
+
+The raw text is handed to the worker through shared memory rather than through
+the pool's pipe, and the parsed result comes back pickled. The return type and
+the `aggregation_function` must be picklable (module-level types and functions
+are); responses of ghostfunctions whose aren't are parsed in the calling thread.
+Workers are started with the `"spawn"` method, so as for any such process pool, a
+script using it must guard its entry point with `if __name__ == "__main__":`.
+
+On a free-threaded interpreter (with the GIL disabled), threads parse in parallel
+on their own, so a thread pool is used and nothing needs pickling.
+"""
+
+import pickle  # nosec: only used to check that objects can be sent to workers
+import sys
+import threading
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from .schema import compile_structured_validator
+from .validators import compile_validator
+
+
+if TYPE_CHECKING:  # imported on first use to keep `import ai_ghostfunctions` fast
+    from concurrent.futures import Executor
+    from concurrent.futures import Future
+
+KINDS = ("auto", "process", "thread")
+
+
+def gil_enabled() -> bool:
+    """Return whether the interpreter runs with a global interpreter lock.
+
+    Returns:
+        False only on a free-threaded build running with the GIL disabled.
+    """
+    is_gil_enabled: Callable[[], bool] = getattr(sys, "_is_gil_enabled", lambda: True)
+    return is_gil_enabled()
+
+
+def parse(
+    texts: Sequence[str],
+    annotation: Any,
+    structured: bool,
+    aggregation_function: Callable[[List[Any]], Any],
+) -> Any:
+    """Parse the completion texts of a request into the return value.
+
+    This is what ghostfunctions do in the calling thread, as one picklable function.
+
+    Args:
+        texts: The completion texts, one per choice.
+        annotation: The return type.
+        structured: Whether the texts are JSON (see `ai_ghostfunctions.schema`)
+            rather than python literals.
+        aggregation_function: Combines the parsed choices.
+
+    Returns:
+        The return value.
+    """
+    if structured:
+        validator = compile_structured_validator(annotation)
+    else:
+        validator = compile_validator(annotation)
+    data = [validator.parse(text) for text in texts]
+    return validator.coerce(aggregation_function(data))
+
+
+def _parse_shared(
+    name: str,
+    lengths: Sequence[int],
+    annotation: Any,
+    structured: bool,
+    aggregation_function: Callable[[List[Any]], Any],
+) -> Any:
+    """Parse texts stored in a shared memory block, in a worker process."""
+    from multiprocessing.shared_memory import SharedMemory
+
+    block = SharedMemory(name=name)
+    try:
+        buffer = block.buf
+        assert buffer is not None  # nosec
+        texts = []
+        start = 0
+        for length in lengths:
+            with buffer[start : start + length] as view:
+                texts.append(str(view, "utf-8"))
+            start += length
+        del buffer
+    finally:
+        block.close()
+    return parse(texts, annotation, structured, aggregation_function)
+
+
+class ParseOffload:
+    """Parse large responses in a pool of workers.
+
+    One instance can be shared by many ghostfunctions, which then share its pool.
+
+    Args:
+        threshold: Responses with at least this many characters (over all choices)
+            are offloaded; shorter ones are cheaper to parse than to hand over.
+        max_workers: The size of the pool. Defaults to the pool's own default.
+        kind: `"process"` for a process pool, `"thread"` for a thread pool (which
+            only helps on a free-threaded interpreter), or `"auto"` for the latter
+            when the GIL is disabled and the former otherwise.
+        mp_context: The multiprocessing context of a process pool. Defaults to the
+            `"spawn"` context, as forking a process that runs threads is unsafe.
+
+    Raises:
+        ValueError: If `kind` is unknown or `threshold` is negative.
+    """
+
+    def __init__(
+        self,
+        threshold: int = 100_000,
+        max_workers: Optional[int] = None,
+        kind: str = "auto",
+        mp_context: Any = None,
+    ) -> None:
+        """Create the configuration; the pool is started on first use."""
+        if kind not in KINDS:
+            raise ValueError(f"kind must be one of {KINDS}, not {kind!r}.")
+        if threshold < 0:
+            raise ValueError("threshold must not be negative.")
+        self.threshold = threshold
+        self.max_workers = max_workers
+        self.kind = kind
+        if kind == "auto":
+            self.kind = "process" if gil_enabled() else "thread"
+        self.mp_context = mp_context
+        self._lock = threading.Lock()
+        self._executor: Optional["Executor"] = None
+        self._portable: Dict[Tuple[Any, Any], bool] = {}
+
+    def wants(self, texts: Sequence[str], annotation: Any, aggregation: Any) -> bool:
+        """Return whether parsing `texts` should be offloaded.
+
+        Args:
+            texts: The completion texts of a request.
+            annotation: The return type.
+            aggregation: The aggregation function.
+
+        Returns:
+            Whether the texts are long enough and the parsing can run in the pool.
+        """
+        if sum(len(text) for text in texts) < self.threshold:
+            return False
+        return self.kind == "thread" or self._is_portable(annotation, aggregation)
+
+    def _is_portable(self, annotation: Any, aggregation: Any) -> bool:
+        key = (annotation, aggregation)
+        try:
+            return self._portable[key]
+        except KeyError:
+            pass
+        except TypeError:  # unhashable annotation
+            return self._pickles(key)
+        portable = self._pickles(key)
+        with self._lock:
+            return self._portable.setdefault(key, portable)
+
+    @staticmethod
+    def _pickles(value: Any) -> bool:
+        try:
+            pickle.dumps(value)
+        except Exception:  # nosec: anything that fails to pickle
+            return False
+        return True
+
+    def submit(
+        self,
+        texts: Sequence[str],
+        annotation: Any,
+        structured: bool,
+        aggregation_function: Callable[[List[Any]], Any],
+    ) -> "Future[Any]":
+        """Start parsing texts in the pool.
+
+        Args:
+            texts: The completion texts, one per choice.
+            annotation: The return type.
+            structured: Whether the texts are JSON rather than python literals.
+            aggregation_function: Combines the parsed choices.
+
+        Returns:
+            A future of the return value, or of the parsing error.
+        """
+        executor = self._pool()
+        if self.kind == "thread":
+            return executor.submit(
+                parse, list(texts), annotation, structured, aggregation_function
+            )
+        return self._submit_shared(
+            executor, texts, annotation, structured, aggregation_function
+        )
+
+    @staticmethod
+    def _submit_shared(
+        executor: "Executor",
+        texts: Sequence[str],
+        annotation: Any,
+        structured: bool,
+        aggregation_function: Callable[[List[Any]], Any],
+    ) -> "Future[Any]":
+        from multiprocessing.shared_memory import SharedMemory
+
+        encoded = [text.encode("utf-8") for text in texts]
+        lengths = [len(data) for data in encoded]
+        block = SharedMemory(create=True, size=max(sum(lengths), 1))
+        try:
+            buffer = block.buf
+            assert buffer is not None  # nosec
+            start = 0
+            for data in encoded:
+                buffer[start : start + len(data)] = data
+                start += len(data)
+            del encoded, buffer
+            future = executor.submit(
+                _parse_shared,
+                block.name,
+                lengths,
+                annotation,
+                structured,
+                aggregation_function,
+            )
+        except BaseException:
+            _release(block)
+            raise
+        future.add_done_callback(lambda _: _release(block))
+        return future
+
+    def _pool(self) -> "Executor":
+        with self._lock:
+            if self._executor is None:
+                self._executor = self._new_pool()
+            return self._executor
+
+    def _new_pool(self) -> "Executor":
+        if self.kind == "thread":
+            from concurrent.futures import ThreadPoolExecutor
+
+            return ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="ghostfunction-parse"
+            )
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        context = self.mp_context or multiprocessing.get_context("spawn")
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stop the pool; it is started again if the offload is used afterwards.
+
+        Args:
+            wait: Whether to wait for the parses in progress to finish.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+def _release(block: Any) -> None:
+    block.close()
+    block.unlink()
@@ -0,0 +1,458 @@
+"""Client-side rate limiting and retries shared by every ghostfunction call.
+
+Every request sent by a ghostfunction passes through the process-wide `Scheduler`.
+Once `configure_rate_limits` sets the requests-per-minute and tokens-per-minute
+quota of the API key, requests wait for a token bucket instead of being rejected
+with a 429. Waiting requests are served by priority, then fairly (round robin)
+between ghostfunctions, so one busy function cannot starve the others.
+
+Requests failing with a connection error, a timeout or a 408, 409, 429 or 5xx
+status are retried with jittered exponential backoff, honoring the `Retry-After`
+header. The shared OpenAI clients (see `ai_ghostfunctions.clients`) do not retry on
+their own, so the two backoff schedules do not stack. A 429 pauses every waiting request,
+not just the one that failed, so the callers do not all hit the limit again at
+the same moment.
+"""
+
+import heapq
+import itertools
+import random
+import sys
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from functools import partial
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Mapping
+from typing import Optional
+
+from .instrumentation import record_retry
+
+
+class TokenBucket:
+    """A token bucket refilled continuously at a per-minute rate.
+
+    Not thread safe: the scheduler guards its buckets with its own lock.
+
+    Args:
+        per_minute: Tokens added per minute.
+        capacity: The maximum number of tokens held. Defaults to `per_minute`.
+        clock: Function returning the current time in seconds.
+    """
+
+    def __init__(
+        self,
+        per_minute: float,
+        capacity: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        """Create a full bucket."""
+        if per_minute <= 0:
+            raise ValueError("per_minute must be positive.")
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute if capacity is None else capacity
+        self.level = self.capacity
+        self._clock = clock
+        self._updated = clock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, amount: float) -> float:
+        """Return the seconds until `amount` tokens are available.
+
+        Amounts above the capacity only wait for a full bucket, so that oversized
+        requests are delayed rather than blocked forever.
+
+        Args:
+            amount: The number of tokens needed.
+
+        Returns:
+            0 if the tokens are available now.
+        """
+        self._refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(missing, 0.0) / self.rate
+
+    def take(self, amount: float) -> None:
+        """Remove `amount` tokens. The level may become negative.
+
+        Args:
+            amount: The number of tokens to remove.
+        """
+        self._refill()
+        self.level -= amount
+
+    def give(self, amount: float) -> None:
+        """Return `amount` unused tokens to the bucket.
+
+        Args:
+            amount: The number of tokens to return.
+        """
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+def estimate_tokens(kwargs: Mapping[str, Any], completion_tokens: int = 256) -> int:
+    """Estimate the tokens a chat completion request will use.
+
+    Args:
+        kwargs: The keyword arguments of the request.
+        completion_tokens: The completion size assumed when `max_tokens` is not set.
+
+    Returns:
+        Roughly 4 characters per prompt token plus the completion tokens of each of
+        the `n` choices.
+    """
+    prompt = sum(len(m["content"]) // 4 + 4 for m in kwargs.get("messages") or ())
+    completion = kwargs.get("max_tokens") or completion_tokens
+    return int(prompt + completion * (kwargs.get("n") or 1))
+
+
+def retry_after(exception: BaseException) -> Optional[float]:
+    """Return the delay requested by the `Retry-After` header of a failed request.
+
+    Args:
+        exception: The exception raised by the request, e.g. an `openai.APIStatusError`.
+
+    Returns:
+        The delay in seconds, or None if the response has no usable header.
+    """
+    headers = getattr(getattr(exception, "response", None), "headers", None)
+    if headers is None:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return max(float(headers["retry-after-ms"]) / 1000, 0.0)
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_retryable(exception: BaseException) -> bool:
+    status = getattr(exception, "status_code", None)
+    if isinstance(status, int):
+        return status in (408, 409, 429) or status >= 500
+    # an openai exception can only have been raised if openai is imported
+    openai = sys.modules.get("openai")
+    return openai is not None and isinstance(exception, openai.APIConnectionError)
+
+
+class _Waiter:
+    def __init__(self, order: Any, tokens: float) -> None:
+        self.order = order
+        self.tokens = tokens
+        self.cancelled = False
+        self.wake: Callable[[], Any] = lambda: None
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return bool(self.order < other.order)
+
+
+class Scheduler:
+    """Admit requests under a requests-per-minute and tokens-per-minute budget.
+
+    Args:
+        requests_per_minute: The request quota. None means unlimited.
+        tokens_per_minute: The token quota. None means unlimited. Requests are
+            charged an estimate up front, corrected by the `usage` of the response.
+        max_retries: How many times a failed request is retried, if the error is
+            transient: a connection error, a timeout, or a 408, 409, 429 or 5xx.
+        backoff: The base delay in seconds of the exponential backoff.
+        max_backoff: The maximum backoff delay, when there is no `Retry-After`.
+        completion_tokens: The completion size assumed when `max_tokens` is not set.
+        clock: Function returning the current time in seconds.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        max_backoff: float = 60.0,
+        completion_tokens: int = 256,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        """Create the scheduler."""
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.completion_tokens = completion_tokens
+        self._clock = clock
+        self._requests = (
+            None
+            if requests_per_minute is None
+            else TokenBucket(requests_per_minute, clock=clock)
+        )
+        self._tokens = (
+            None
+            if tokens_per_minute is None
+            else TokenBucket(tokens_per_minute, clock=clock)
+        )
+        self._lock = threading.Lock()
+        self._queue: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._virtual_time = 0
+        self._finish: Dict[str, int] = {}
+        self._paused_until = 0.0
+
+    @property
+    def limited(self) -> bool:
+        """Whether requests are subject to a quota."""
+        return self._requests is not None or self._tokens is not None
+
+    def _enqueue(self, key: str, tokens: float, priority: int) -> _Waiter:
+        # start-time fair queueing: each key's requests get consecutive virtual
+        # times starting from the one being served, so keys take turns
+        with self._lock:
+            virtual = max(self._finish.get(key, 0), self._virtual_time) + 1
+            self._finish[key] = virtual
+            waiter = _Waiter((-priority, virtual, next(self._seq)), tokens)
+            heapq.heappush(self._queue, waiter)
+            return waiter
+
+    def _head(self) -> Optional[_Waiter]:
+        while self._queue and self._queue[0].cancelled:
+            heapq.heappop(self._queue)
+        return self._queue[0] if self._queue else None
+
+    def _poll(self, waiter: _Waiter) -> Optional[float]:
+        """Admit `waiter` if possible; return 0, the delay to retry after, or None."""
+        with self._lock:
+            if self._head() is not waiter:
+                return None  # woken once it reaches the head
+            delay = self._paused_until - self._clock()
+            if self._requests is not None:
+                delay = max(delay, self._requests.delay(1))
+            if self._tokens is not None:
+                delay = max(delay, self._tokens.delay(waiter.tokens))
+            if delay > 0:
+                return delay
+            if self._requests is not None:
+                self._requests.take(1)
+            if self._tokens is not None:
+                self._tokens.take(waiter.tokens)
+            heapq.heappop(self._queue)
+            self._virtual_time = waiter.order[1]
+            self._wake_head()
+            return 0.0
+
+    def _cancel(self, waiter: _Waiter) -> None:
+        with self._lock:
+            waiter.cancelled = True
+            self._wake_head()
+
+    def _wake_head(self) -> None:
+        head = self._head()
+        if head is not None:
+            head.wake()
+
+    def acquire(self, key: str = "", tokens: float = 0, priority: int = 0) -> None:
+        """Block until a request may be sent.
+
+        Args:
+            key: The fairness key, e.g. the ghostfunction's name.
+            tokens: The estimated tokens of the request.
+            priority: Requests with a higher priority are admitted first.
+        """
+        if not self.limited:
+            self._sleep_while_paused()
+            return
+        self._wait(self._enqueue(key, tokens, priority))
+
+    def _wait(self, waiter: _Waiter) -> None:
+        event = threading.Event()
+        waiter.wake = event.set
+        try:
+            delay = self._poll(waiter)
+            while delay != 0:
+                event.wait(delay)
+                event.clear()
+                delay = self._poll(waiter)
+        except BaseException:
+            self._cancel(waiter)
+            raise
+
+    async def aacquire(
+        self, key: str = "", tokens: float = 0, priority: int = 0
+    ) -> None:
+        """Wait on the running event loop until a request may be sent.
+
+        Args:
+            key: The fairness key, e.g. the ghostfunction's name.
+            tokens: The estimated tokens of the request.
+            priority: Requests with a higher priority are admitted first.
+        """
+        import asyncio
+
+        if not self.limited:
+            paused = self._paused_until - self._clock()
+            if paused > 0:
+                await asyncio.sleep(paused)
+            return
+        await self._await(self._enqueue(key, tokens, priority))
+
+    async def _await(self, waiter: _Waiter) -> None:
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                woken = loop.create_future()
+                waiter.wake = partial(loop.call_soon_threadsafe, _resolve, woken)
+                delay = self._poll(waiter)
+                if delay == 0:
+                    return
+                await asyncio.wait([woken], timeout=delay)
+        except BaseException:
+            self._cancel(waiter)
+            raise
+
+    def _sleep_while_paused(self) -> None:
+        delay = self._paused_until - self._clock()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _retry_delay(self, exception: Exception, attempt: int) -> float:
+        """Return how long to wait before retrying, or re-raise to give up."""
+        if attempt >= self.max_retries or not _is_retryable(exception):
+            raise exception
+        record_retry()
+        requested = retry_after(exception)
+        if requested is None:
+            # full jitter keeps the retries of concurrent callers apart
+            delay = random.uniform(
+                0, min(self.max_backoff, self.backoff * 2**attempt)
+            )
+        else:
+            delay = requested + random.uniform(0, self.backoff)
+        if getattr(exception, "status_code", None) == 429:
+            with self._lock:
+                self._paused_until = max(self._paused_until, self._clock() + delay)
+        return delay
+
+    def _settle(self, estimated: float, result: Any) -> None:
+        """Correct the token bucket with the usage reported by the response."""
+        used = getattr(getattr(result, "usage", None), "total_tokens", None)
+        if self._tokens is None or not isinstance(used, int):
+            return
+        with self._lock:
+            if used < estimated:
+                self._tokens.give(estimated - used)
+            else:
+                self._tokens.take(used - estimated)
+
+    def call(
+        self,
+        ai_callable: Callable[..., Any],
+        kwargs: Dict[str, Any],
+        key: str = "",
+        priority: int = 0,
+    ) -> Any:
+        """Send a request once admitted, retrying on transient errors.
+
+        Args:
+            ai_callable: The function sending the request.
+            kwargs: The keyword arguments of the request.
+            key: The fairness key, e.g. the ghostfunction's name.
+            priority: Requests with a higher priority are admitted first.
+
+        Returns:
+            The result of `ai_callable`.
+        """
+        tokens = estimate_tokens(kwargs, self.completion_tokens) if self._tokens else 0
+        attempt = 0
+        while True:
+            self.acquire(key, tokens, priority)
+            try:
+                result = ai_callable(**kwargs)
+            except Exception as e:
+                time.sleep(self._retry_delay(e, attempt))
+                attempt += 1
+                continue
+            self._settle(tokens, result)
+            return result
+
+    async def acall(
+        self,
+        ai_callable: Callable[..., Any],
+        kwargs: Dict[str, Any],
+        key: str = "",
+        priority: int = 0,
+    ) -> Any:
+        """Send a request once admitted, retrying on transient errors.
+
+        Args:
+            ai_callable: The function sending the request, sync or async.
+            kwargs: The keyword arguments of the request.
+            key: The fairness key, e.g. the ghostfunction's name.
+            priority: Requests with a higher priority are admitted first.
+
+        Returns:
+            The (awaited) result of `ai_callable`.
+        """
+        import asyncio
+        import inspect
+
+        tokens = estimate_tokens(kwargs, self.completion_tokens) if self._tokens else 0
+        attempt = 0
+        while True:
+            await self.aacquire(key, tokens, priority)
+            try:
+                result = ai_callable(**kwargs)
+                if inspect.isawaitable(result):
+                    result = await result
+            except Exception as e:
+                await asyncio.sleep(self._retry_delay(e, attempt))
+                attempt += 1
+                continue
+            self._settle(tokens, result)
+            return result
+
+
+def _resolve(future: Any) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+_lock = threading.Lock()
+_scheduler = Scheduler()
+
+
+def configure_rate_limits(**settings: Any) -> Scheduler:
+    """Replace the shared scheduler with one using `settings`.
+
+    Requests already waiting on the previous scheduler are admitted by it.
+
+    Args:
+        settings: Arguments of `Scheduler`, e.g. `requests_per_minute` and
+            `tokens_per_minute`.
+
+    Returns:
+        The new scheduler.
+    """
+    global _scheduler
+    with _lock:
+        _scheduler = Scheduler(**settings)
+        return _scheduler
+
+
+def get_scheduler() -> Scheduler:
+    """Return the scheduler shared by every ghostfunction.
+
+    Returns:
+        The current scheduler. By default it has no quota and only retries.
+    """
+    return _scheduler
@@ -0,0 +1,233 @@
+"""Choose the model each request of the default `ai_callable` is sent to.
+
+The `ModelRouter` tries an ordered list of models. A model the account cannot use
+(the API answers 404) is remembered as unavailable, so later requests go straight
+to the next model instead of paying for the failed request again. Routing rules
+can send some prompts, such as short ones, to a faster model first.
+
+A ghostfunction selects its own model with the `model` keyword argument, e.g.
+`@ghostfunction(model="gpt-4o")`, or its own fallback list with
+`@ghostfunction(model=["gpt-4o", "gpt-4"])`. Rules do not apply to those calls.
+"""
+
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Mapping
+from typing import NoReturn
+from typing import Optional
+from typing import Sequence
+from typing import Union
+
+
+@dataclass(frozen=True)
+class RoutingRule:
+    """Send matching requests to `model` first.
+
+    A rule matches when every condition that is set holds.
+
+    Args:
+        model: The model to try first for matching requests.
+        max_prompt_chars: Match prompts with at most this many characters.
+        when: Predicate on the keyword arguments of the request.
+    """
+
+    model: str
+    max_prompt_chars: Optional[int] = None
+    when: Optional[Callable[[Mapping[str, Any]], bool]] = None
+
+    def matches(self, kwargs: Mapping[str, Any]) -> bool:
+        """Return whether the rule applies to a request.
+
+        Args:
+            kwargs: The keyword arguments of the request.
+
+        Returns:
+            True if every condition of the rule holds.
+        """
+        if self.max_prompt_chars is not None:
+            chars = sum(len(m["content"]) for m in kwargs.get("messages") or ())
+            if chars > self.max_prompt_chars:
+                return False
+        return self.when is None or self.when(kwargs)
+
+
+def _is_model_unavailable(exception: BaseException) -> bool:
+    return getattr(exception, "status_code", None) == 404
+
+
+class ModelRouter:
+    """Send requests to the first available model.
+
+    Args:
+        models: The models to try, in order.
+        rules: Rules choosing a model to try before `models`. The first matching
+            rule wins.
+        recheck_after: Seconds after which an unavailable model is tried again.
+            None means never, until `forget` is called.
+        clock: Function returning the current time in seconds.
+    """
+
+    def __init__(
+        self,
+        models: Sequence[str] = ("gpt-4", "gpt-3.5-turbo"),
+        rules: Sequence[RoutingRule] = (),
+        recheck_after: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        """Create the router."""
+        if not models:
+            raise ValueError("At least one model is required.")
+        self.models = tuple(models)
+        self.rules = tuple(rules)
+        self.recheck_after = recheck_after
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._unavailable: Dict[str, float] = {}
+
+    def is_available(self, model: str) -> bool:
+        """Return whether `model` has not been found unavailable.
+
+        Args:
+            model: The model name.
+
+        Returns:
+            False if a request to `model` failed with a 404 (recently, if
+            `recheck_after` is set).
+        """
+        since = self._unavailable.get(model)
+        if since is None:
+            return True
+        if (
+            self.recheck_after is not None
+            and self._clock() - since >= self.recheck_after
+        ):
+            with self._lock:
+                self._unavailable.pop(model, None)
+            return True
+        return False
+
+    def mark_unavailable(self, model: str) -> None:
+        """Remember that `model` cannot be used.
+
+        Args:
+            model: The model name.
+        """
+        with self._lock:
+            self._unavailable[model] = self._clock()
+
+    def forget(self) -> None:
+        """Forget every unavailable model, so they are tried again."""
+        with self._lock:
+            self._unavailable.clear()
+
+    def candidates(self, kwargs: Mapping[str, Any]) -> List[str]:
+        """Return the models to try for a request, in order.
+
+        Args:
+            kwargs: The keyword arguments of the request. A `model` entry (a name or
+                a list of names) replaces the router's models and rules.
+
+        Returns:
+            The available models, without duplicates. If every model is unavailable,
+            the last one is returned so the request still reports the API's error.
+        """
+        requested: Union[str, Sequence[str], None] = kwargs.get("model")
+        if isinstance(requested, str):
+            ordered: Sequence[str] = [requested]
+        elif requested is not None:
+            ordered = list(requested)
+        else:
+            first = [r.model for r in self.rules if r.matches(kwargs)][:1]
+            ordered = [*first, *self.models]
+        models = list(dict.fromkeys(ordered))
+        return [m for m in models if self.is_available(m)] or models[-1:]
+
+    def call(self, create: Callable[..., Any], kwargs: Mapping[str, Any]) -> Any:
+        """Send a request with `create`, falling back to the next model on a 404.
+
+        Args:
+            create: The function sending the request, e.g.
+                `client.chat.completions.create`.
+            kwargs: The keyword arguments of the request.
+
+        Returns:
+            The result of `create` for the first available model.
+        """
+        request = {k: v for k, v in kwargs.items() if k != "model"}
+        models = self.candidates(kwargs)
+        for model in models[:-1]:
+            try:
+                return create(model=model, **request)
+            except Exception as e:
+                self._fall_back(e, model)
+        try:
+            return create(model=models[-1], **request)
+        except Exception as e:
+            self._fail(e, models[-1])
+
+    async def acall(self, create: Callable[..., Any], kwargs: Mapping[str, Any]) -> Any:
+        """Send a request with the async `create`, falling back on a 404.
+
+        Args:
+            create: The coroutine function sending the request, e.g.
+                `async_client.chat.completions.create`.
+            kwargs: The keyword arguments of the request.
+
+        Returns:
+            The awaited result of `create` for the first available model.
+        """
+        request = {k: v for k, v in kwargs.items() if k != "model"}
+        models = self.candidates(kwargs)
+        for model in models[:-1]:
+            try:
+                return await create(model=model, **request)
+            except Exception as e:
+                self._fall_back(e, model)
+        try:
+            return await create(model=models[-1], **request)
+        except Exception as e:
+            self._fail(e, models[-1])
+
+    def _fall_back(self, exception: Exception, model: str) -> None:
+        if not _is_model_unavailable(exception):
+            raise exception
+        self.mark_unavailable(model)
+
+    def _fail(self, exception: Exception, model: str) -> NoReturn:
+        # the last candidate's 404 is reported to the caller, but still remembered
+        if _is_model_unavailable(exception):
+            self.mark_unavailable(model)
+        raise exception
+
+
+_lock = threading.Lock()
+_router = ModelRouter()
+
+
+def configure_routing(**settings: Any) -> ModelRouter:
+    """Replace the router used by the default `ai_callable`.
+
+    Args:
+        settings: Arguments of `ModelRouter`, e.g. `models` and `rules`.
+
+    Returns:
+        The new router.
+    """
+    global _router
+    with _lock:
+        _router = ModelRouter(**settings)
+        return _router
+
+
+def get_router() -> ModelRouter:
+    """Return the router used by the default `ai_callable`.
+
+    Returns:
+        The current router. By default it tries gpt-4, then gpt-3.5-turbo.
+    """
+    return _router
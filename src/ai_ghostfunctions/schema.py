@@ -0,0 +1,282 @@
+"""JSON Schemas of return annotations, for structured-output requests.
+
+A ghostfunction created with `structured_output=True` asks the model for JSON
+matching the schema of its return annotation (with OpenAI's `response_format` of
+type `json_schema`) instead of a python repr, and parses the answer with a JSON
+decoder rather than `ast.literal_eval`. The model can then only answer with text
+that parses, so fewer calls fail and have to be repeated.
+
+The API requires an object at the root of the schema, so the value is wrapped as
+`{"result": <value>}`. The schema is sent in strict mode when it only uses the
+subset of JSON Schema that strict mode supports.
+"""
+
+import dataclasses
+import enum
+import json
+import threading
+import typing
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Set
+from typing import Tuple
+from typing import get_type_hints
+
+from .validators import _UNION_TYPES
+from .validators import Validator
+from .validators import _is_typeddict
+from .validators import _NoneType
+from .validators import compile_validator
+
+
+_SCALARS: Dict[Any, str] = {
+    str: "string",
+    bool: "boolean",
+    int: "integer",
+    float: "number",
+    _NoneType: "null",
+}
+
+Decoder = Callable[[Any], Any]
+
+
+def _identity(value: Any) -> Any:
+    return value
+
+
+class _Builder:
+    """Build the schema and the JSON decoder of an annotation, recursively."""
+
+    def __init__(self) -> None:
+        self.strict = True
+        self._building: Set[Any] = set()
+
+    def build(self, annotation: Any) -> Tuple[Dict[str, Any], Decoder]:
+        if annotation is None:
+            annotation = _NoneType
+        try:
+            recursive = annotation in self._building
+        except TypeError:  # unhashable annotation
+            recursive = False
+        if recursive:
+            raise TypeError(f"Recursive type {annotation!r} has no JSON Schema.")
+        if annotation is Any:
+            self.strict = False
+            return {}, _identity
+        if annotation in _SCALARS:
+            return {"type": _SCALARS[annotation]}, _identity
+        if isinstance(annotation, type) and issubclass(annotation, enum.Enum):
+            return {"enum": [member.value for member in annotation]}, annotation
+        if _is_typeddict(annotation) or dataclasses.is_dataclass(annotation):
+            self._building.add(annotation)
+            try:
+                return self._object(annotation)
+            finally:
+                self._building.discard(annotation)
+        origin = typing.get_origin(annotation) or annotation
+        args = typing.get_args(annotation)
+        if origin is typing.Literal:
+            return {"enum": list(args)}, _identity
+        if origin in _UNION_TYPES:
+            return self._union(args)
+        if origin in (list, set, frozenset) or (origin is tuple and args[1:] == (...,)):
+            return self._array(origin, args[0] if args else Any)
+        if origin is tuple and args and args != ((),):
+            return self._tuple(args)
+        if origin is dict:
+            return self._dict(*(args or (Any, Any)))
+        raise TypeError(f"{annotation!r} has no JSON Schema.")
+
+    def _object(self, annotation: Any) -> Tuple[Dict[str, Any], Decoder]:
+        hints = get_type_hints(annotation)
+        if dataclasses.is_dataclass(annotation):
+            fields = [f for f in dataclasses.fields(annotation) if f.init]
+            names = [f.name for f in fields]
+            required = [
+                f.name
+                for f in fields
+                if f.default is dataclasses.MISSING
+                and f.default_factory is dataclasses.MISSING
+            ]
+        else:
+            names = list(hints)
+            required_keys = getattr(
+                annotation,
+                "__required_keys__",
+                frozenset(names) if annotation.__total__ else frozenset(),
+            )
+            required = [n for n in names if n in required_keys]
+        built = {name: self.build(hints[name]) for name in names}
+        if len(required) < len(names):
+            self.strict = False
+        decoders = {name: decoder for name, (_, decoder) in built.items()}
+
+        def decode(value: Any) -> Any:
+            if not isinstance(value, dict):
+                return value
+            return {k: decoders[k](v) if k in decoders else v for k, v in value.items()}
+
+        schema = {
+            "type": "object",
+            "properties": {name: schema for name, (schema, _) in built.items()},
+            "required": required,
+            "additionalProperties": False,
+        }
+        return schema, decode
+
+    def _union(self, args: Tuple[Any, ...]) -> Tuple[Dict[str, Any], Decoder]:
+        built = [self.build(arg) for arg in args]
+        options = [
+            (compile_validator(arg), decoder)
+            for arg, (_, decoder) in zip(args, built)  # noqa: B905
+        ]
+
+        def decode(value: Any) -> Any:
+            # the first option the decoded value is valid for, as typeguard would
+            for validator, decoder in options:
+                try:
+                    decoded = decoder(value)
+                    validator.coerce(decoded)
+                except Exception:  # nosec: try the next option
+                    continue
+                return decoded
+            return value
+
+        return {"anyOf": [schema for schema, _ in built]}, decode
+
+    def _array(self, container: Any, element: Any) -> Tuple[Dict[str, Any], Decoder]:
+        schema, decoder = self.build(element)
+
+        def decode(value: Any) -> Any:
+            if not isinstance(value, list):
+                return value
+            return container(decoder(item) for item in value)
+
+        return {"type": "array", "items": schema}, decode
+
+    def _tuple(self, args: Tuple[Any, ...]) -> Tuple[Dict[str, Any], Decoder]:
+        self.strict = False  # strict mode supports neither prefixItems nor minItems
+        built = [self.build(arg) for arg in args]
+        decoders = [decoder for _, decoder in built]
+
+        def decode(value: Any) -> Any:
+            if not isinstance(value, list) or len(value) != len(decoders):
+                return value
+            return tuple(d(item) for d, item in zip(decoders, value))  # noqa: B905
+
+        schema = {
+            "type": "array",
+            "prefixItems": [schema for schema, _ in built],
+            "minItems": len(args),
+            "maxItems": len(args),
+        }
+        return schema, decode
+
+    def _dict(self, key: Any, value: Any) -> Tuple[Dict[str, Any], Decoder]:
+        self.strict = False  # strict mode requires every property to be named
+        if key not in (str, int, float, Any):
+            raise TypeError(f"Dict keys of type {key!r} have no JSON Schema.")
+        schema, decoder = self.build(value)
+        convert_key = key if key in (int, float) else _identity
+
+        def decode(items: Any) -> Any:
+            if not isinstance(items, dict):
+                return items
+            return {convert_key(k): decoder(v) for k, v in items.items()}
+
+        return {"type": "object", "additionalProperties": schema}, decode
+
+
+def json_schema(annotation: Any) -> Dict[str, Any]:
+    """Return the JSON Schema of values of a type.
+
+    Args:
+        annotation: A return type annotation: builtin scalars, lists, sets, tuples,
+            dicts, unions, literals, enums, TypedDicts and dataclasses, nested.
+
+    Returns:
+        The schema.
+    """
+    schema, _ = _Builder().build(annotation)
+    return schema
+
+
+def response_format(annotation: Any, name: str) -> Dict[str, Any]:
+    """Return the `response_format` requesting JSON of a type, wrapped in an object.
+
+    Args:
+        annotation: A return type annotation.
+        name: The name of the schema, e.g. the function name.
+
+    Returns:
+        The value of the `response_format` request parameter.
+    """
+    builder = _Builder()
+    schema, _ = builder.build(annotation)
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "strict": builder.strict,
+            "schema": {
+                "type": "object",
+                "properties": {"result": schema},
+                "required": ["result"],
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+def _json_loads() -> Callable[[str], Any]:
+    try:
+        import orjson
+    except ImportError:
+        return json.loads
+    loads: Callable[[str], Any] = orjson.loads
+    return loads
+
+
+def _compile_structured(annotation: Any, wrapped: bool) -> Validator:
+    _, decoder = _Builder().build(annotation)
+    loads = _json_loads()
+    if wrapped:
+
+        def literal(string: str) -> Any:
+            return decoder(loads(string)["result"])
+
+    else:
+
+        def literal(string: str) -> Any:
+            return decoder(loads(string))
+
+    return Validator(annotation, compile_validator(annotation).coerce, literal)
+
+
+_lock = threading.Lock()
+_validators: Dict[Tuple[Any, bool], Validator] = {}
+
+
+def compile_structured_validator(annotation: Any, wrapped: bool = True) -> Validator:
+    """Return a validator parsing JSON answers, compiling it on first use.
+
+    Args:
+        annotation: A return type annotation.
+        wrapped: Whether values are wrapped as `{"result": <value>}`, as requested by
+            `response_format`.
+
+    Returns:
+        The validator, cached per type. JSON arrays are turned into the tuples and
+        sets the annotation asks for, and enum values into enum members.
+    """
+    key = (annotation, wrapped)
+    try:
+        return _validators[key]
+    except KeyError:
+        pass
+    except TypeError:  # unhashable annotation, so it cannot be cached
+        return _compile_structured(annotation, wrapped)
+    validator = _compile_structured(annotation, wrapped)
+    with _lock:
+        return _validators.setdefault(key, validator)
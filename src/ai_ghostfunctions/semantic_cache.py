@@ -0,0 +1,360 @@
+"""A cache answering near-duplicate calls, matched by embedding similarity.
+
+An exact cache misses whenever two calls differ at all, even only in whitespace
+inside a string argument. `SemanticCache` embeds the rendered call and answers a
+request with the response of the most similar cached call of the same function, if
+their cosine similarity reaches a threshold::
+
+    cache = TieredCache(InMemoryCache(), SemanticCache(threshold=0.99))
+
+    @ghostfunction(cache=cache)
+    def sentiment(text: str) -> str:
+        '''Return "positive" or "negative".'''
+
+Requests are only compared with cached requests of the same scope: the same
+parameters and the same prompt apart from the call line (with the default prompt,
+the same function). Vectors are kept in a NumPy array and looked up with random
+hyperplane locality-sensitive hashing, so a lookup only scores the few entries
+sharing a hash bucket with the request.
+
+NumPy is imported on first use and must be installed to use this module, e.g. with
+the `semantic` extra: `pip install ai-ghostfunctions[semantic]`.
+"""
+
+import copy
+import re
+import threading
+import time
+import zlib
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Mapping
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+from typing import Union
+
+from .cache import BaseCache
+from .cache import make_cache_key
+from .types import Message
+
+
+if TYPE_CHECKING:  # imported on first use to keep `import ai_ghostfunctions` fast
+    import numpy as np
+
+Embedder = Callable[[str], Union[Sequence[float], "np.ndarray[Any, Any]"]]
+
+_CALL_MARKER = "\nresult = "
+_TOKEN = re.compile(r"\w+|[^\w\s]")
+
+
+def split_call(messages: Sequence[Message]) -> Tuple[List[Message], str]:
+    """Split a prompt into the part that scopes a lookup and the text to embed.
+
+    The text to embed is everything from the `result = ...` line of the last
+    message, as rendered by the default prompt; the scope is the rest of the prompt.
+    For a last message without that line, the whole message is embedded.
+
+    Args:
+        messages: The messages produced by the `prompt_function`.
+
+    Returns:
+        The scope messages and the text to embed.
+    """
+    *preamble, last = messages
+    content = last["content"]
+    index = content.rfind(_CALL_MARKER)
+    if index < 0:
+        return list(preamble), content
+    scope = Message(role=last["role"], content=content[:index])
+    return [*preamble, scope], content[index:]
+
+
+def _require_numpy() -> None:
+    try:
+        import numpy  # noqa: F401
+    except ImportError as e:
+        raise ImportError(
+            "The semantic cache needs NumPy. Install it with"
+            " `pip install ai-ghostfunctions[semantic]`."
+        ) from e
+
+
+class HashingEmbedder:
+    """Embed text as hashed counts of its word n-grams.
+
+    The text is split into words and punctuation marks, so texts differing only in
+    whitespace are identical. Letter case and every word are kept: changing a
+    number, a negation or a word's case can change what a call means. Texts sharing
+    most of their n-grams are close whatever the changed words mean, and the longer
+    the texts the closer, so use a high threshold with this embedder.
+
+    Args:
+        dim: The dimension of the vectors.
+        ngram: The length of the longest word n-grams; all shorter ones are counted
+            too.
+    """
+
+    def __init__(self, dim: int = 256, ngram: int = 2) -> None:
+        """Create the embedder."""
+        _require_numpy()
+        self.dim = dim
+        self.ngram = ngram
+
+    def __call__(self, text: str) -> "np.ndarray[Any, Any]":
+        """Embed `text`.
+
+        Args:
+            text: The text to embed.
+
+        Returns:
+            The vector, of shape `(dim,)`.
+        """
+        import numpy as np
+
+        tokens = _TOKEN.findall(text)
+        hashes = [
+            zlib.crc32(" ".join(tokens[i : i + size]).encode("utf-8"))
+            for size in range(1, self.ngram + 1)
+            for i in range(len(tokens) - size + 1)
+        ]
+        codes = np.array(hashes or [0], dtype=np.int64)
+        signs = np.where(codes & 1, 1.0, -1.0)
+        return np.bincount((codes >> 1) % self.dim, weights=signs, minlength=self.dim)
+
+
+class _Index:
+    """Fixed-capacity vector storage with LSH buckets, shared by cache views."""
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: Optional[float],
+        bits: int,
+        tables: int,
+        seed: int,
+        clock: Callable[[], float],
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.bits = bits
+        self.tables = tables
+        self.seed = seed
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.dim = 0
+        self.vectors: Any = None
+        self.planes: Any = None
+        self.created: Any = None
+        self.accessed: Any = None
+        self.codes: Any = None
+        self.scopes: List[Optional[str]] = [None] * maxsize
+        self.values: List[List[str]] = [[] for _ in range(maxsize)]
+        self.free = list(range(maxsize - 1, -1, -1))
+        self.buckets: Dict[Tuple[int, str, int], Set[int]] = {}
+
+    def _allocate(self, dim: int) -> None:
+        import numpy as np
+
+        rng = np.random.default_rng(self.seed)
+        self.dim = dim
+        self.vectors = np.zeros((self.maxsize, dim), dtype=np.float32)
+        self.planes = rng.standard_normal((self.tables * self.bits, dim))
+        self.created = np.zeros(self.maxsize)
+        self.accessed = np.full(self.maxsize, np.inf)
+        self.codes = np.zeros((self.maxsize, self.tables), dtype=np.int64)
+
+    def _hash(self, vector: Any) -> Any:
+        import numpy as np
+
+        bits = (self.planes @ vector > 0).reshape(self.tables, self.bits)
+        codes: Any = bits @ (1 << np.arange(self.bits))
+        return codes
+
+    def _candidates(self, scope: str, codes: Any) -> List[int]:
+        slots: Set[int] = set()
+        for table, code in enumerate(codes.tolist()):
+            slots.update(self.buckets.get((table, scope, code), ()))
+        return sorted(slots)
+
+    def _remove(self, slot: int) -> None:
+        scope = self.scopes[slot]
+        assert scope is not None  # nosec
+        for table, code in enumerate(self.codes[slot].tolist()):
+            bucket = self.buckets[(table, scope, code)]
+            bucket.discard(slot)
+            if not bucket:
+                del self.buckets[(table, scope, code)]
+        self.scopes[slot] = None
+        self.values[slot] = []
+        self.accessed[slot] = float("inf")
+        self.free.append(slot)
+
+    def _expire(self, slots: List[int], now: float) -> Tuple[List[int], int]:
+        if self.ttl is None:
+            return slots, 0
+        expired = {s for s in slots if self.created[s] + self.ttl < now}
+        for slot in expired:
+            self._remove(slot)
+        return [s for s in slots if s not in expired], len(expired)
+
+    def _nearest(self, scope: str, vector: Any, codes: Any) -> Tuple[int, float, int]:
+        """Return the most similar live slot (or -1), its similarity and evictions."""
+        slots, evicted = self._expire(self._candidates(scope, codes), self.clock())
+        if not slots:
+            return -1, -1.0, evicted
+        similarities = self.vectors[slots] @ vector
+        best = int(similarities.argmax())
+        return slots[best], float(similarities[best]), evicted
+
+    def lookup(
+        self, scope: str, vector: Any, threshold: float
+    ) -> Tuple[Optional[List[str]], int]:
+        with self.lock:
+            if self.vectors is None or vector.shape[0] != self.dim:
+                return None, 0
+            slot, similarity, evicted = self._nearest(scope, vector, self._hash(vector))
+            if slot < 0 or similarity < threshold:
+                return None, evicted
+            self.accessed[slot] = self.clock()
+            return list(self.values[slot]), evicted
+
+    def insert(self, scope: str, vector: Any, value: List[str]) -> int:
+        with self.lock:
+            if self.vectors is None:
+                self._allocate(vector.shape[0])
+            codes = self._hash(vector)
+            slot, similarity, evicted = self._nearest(scope, vector, codes)
+            if slot >= 0 and similarity >= 1 - 1e-6:
+                self._remove(slot)  # the same call again: replace its response
+            elif not self.free:
+                evicted += self._make_room()
+            slot = self.free.pop()
+            now = self.clock()
+            self.vectors[slot] = vector
+            self.created[slot] = self.accessed[slot] = now
+            self.codes[slot] = codes
+            self.scopes[slot] = scope
+            self.values[slot] = list(value)
+            for table, code in enumerate(codes.tolist()):
+                self.buckets.setdefault((table, scope, code), set()).add(slot)
+            return evicted
+
+    def _make_room(self) -> int:
+        """Drop expired entries, or else the least recently used one."""
+        _, evicted = self._expire(list(range(self.maxsize)), self.clock())
+        if not evicted:
+            self._remove(int(self.accessed.argmin()))
+            evicted = 1
+        return evicted
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.maxsize - len(self.free)
+
+    def clear(self) -> None:
+        with self.lock:
+            for slot, scope in enumerate(self.scopes):
+                if scope is not None:
+                    self._remove(slot)
+
+
+class SemanticCache(BaseCache):
+    """An in-memory cache matching requests by the similarity of their calls.
+
+    Args:
+        threshold: The minimum cosine similarity, between -1 and 1, for a cached
+            response to answer a request. A lower threshold answers more requests,
+            but also some whose calls mean something else than the cached one.
+        embedder: A function embedding the text of a call as a vector. Defaults to a
+            `HashingEmbedder`; any local model returning vectors of a fixed dimension
+            can be used instead.
+        maxsize: The maximum number of responses to keep; the least recently used
+            is evicted first.
+        ttl: Seconds after which a response expires. `None` means never.
+        bits: Hyperplanes per hash table. More bits make buckets smaller and lookups
+            cheaper, but near-duplicates more likely to land in different buckets.
+        tables: Hash tables. More tables make a near-duplicate likelier to share a
+            bucket with the request in at least one of them.
+        seed: The seed of the random hyperplanes.
+        clock: The time source used for `ttl` and recency.
+
+    Raises:
+        ValueError: If `threshold` or `maxsize` is out of range.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.99,
+        embedder: Optional[Embedder] = None,
+        maxsize: int = 1024,
+        ttl: Optional[float] = None,
+        bits: int = 8,
+        tables: int = 8,
+        seed: int = 0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        """Create the cache."""
+        super().__init__()
+        _require_numpy()
+        if not -1 <= threshold <= 1:
+            raise ValueError("threshold must be between -1 and 1.")
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1.")
+        self.threshold = threshold
+        self.embedder: Embedder = embedder or HashingEmbedder()
+        self._index = _Index(maxsize, ttl, bits, tables, seed, clock)
+
+    def with_threshold(self, threshold: float) -> "SemanticCache":
+        """Return a cache sharing this one's entries but using another threshold.
+
+        Use it to give each ghostfunction its own threshold over a single store.
+
+        Args:
+            threshold: The minimum cosine similarity of the new cache.
+
+        Returns:
+            The new cache. Its statistics are counted separately.
+        """
+        view = copy.copy(self)
+        BaseCache.__init__(view)
+        view.threshold = threshold
+        return view
+
+    def _embed(
+        self, messages: Sequence[Message], params: Mapping[str, Any]
+    ) -> Tuple[str, Any]:
+        import numpy as np
+
+        scope_messages, text = split_call(messages)
+        vector = np.asarray(self.embedder(text), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector = vector / norm
+        return make_cache_key(scope_messages, params), vector
+
+    def _lookup(
+        self, messages: Sequence[Message], params: Mapping[str, Any]
+    ) -> Optional[List[str]]:
+        scope, vector = self._embed(messages, params)
+        value, evicted = self._index.lookup(scope, vector, self.threshold)
+        self._record_eviction(evicted)
+        return value
+
+    def _store(
+        self, messages: Sequence[Message], params: Mapping[str, Any], value: List[str]
+    ) -> None:
+        scope, vector = self._embed(messages, params)
+        self._record_eviction(self._index.insert(scope, vector, value))
+
+    def __len__(self) -> int:
+        """Return the number of responses currently stored."""
+        return len(self._index)
+
+    def clear(self) -> None:
+        """Remove every response from the cache."""
+        self._index.clear()
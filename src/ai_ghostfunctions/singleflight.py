@@ -0,0 +1,125 @@
+"""Coalescing of identical concurrent calls.
+
+When many callers ask for the same thing at the same time, only the first one (the
+leader) does the work; the others wait for it and receive its outcome, result or
+exception alike. A key is only in flight while its leader runs: callers arriving
+afterwards start a new flight (or, for ghostfunctions, find the response in the
+cache the leader filled).
+
+Ghostfunctions created with `coalesce=True` use one `SingleFlight` each, keyed on the
+rendered messages and the `ai_callable` keyword arguments.
+"""
+
+import threading
+from functools import partial
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Generic
+from typing import Hashable
+from typing import Optional
+from typing import Tuple
+from typing import TypeVar
+
+
+if TYPE_CHECKING:  # imported on first use to keep `import ai_ghostfunctions` fast
+    import asyncio
+
+T = TypeVar("T")
+
+
+class _Flight(Generic[T]):
+    """The outcome of one threaded call, awaited by its followers."""
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Optional[T] = None
+        self.exception: Optional[BaseException] = None
+
+    def outcome(self) -> T:
+        if self.exception is not None:
+            raise self.exception
+        return self.result  # type: ignore[return-value]
+
+
+class SingleFlight:
+    """Share the outcome of a call between concurrent callers with the same key.
+
+    Threaded callers use `do`, asyncio callers `ado`; the two never share a flight.
+    Async flights are also kept apart per event loop.
+    """
+
+    def __init__(self) -> None:
+        """Create a group with no call in flight."""
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, _Flight[Any]] = {}
+        self._tasks: Dict[Tuple[int, Hashable], "asyncio.Future[Any]"] = {}
+
+    def do(self, key: Hashable, function: Callable[[], T]) -> Tuple[T, bool]:
+        """Call `function`, unless a call with the same key is in flight.
+
+        Args:
+            key: Identifies calls that have the same outcome.
+            function: The call to make if none is in flight.
+
+        Returns:
+            The outcome of the call, and whether it was taken from another caller's
+            call. Such a result is the very object the other caller got: copy it
+            before handing it out if it may be mutated.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            return flight.outcome(), True
+        return self._lead(key, flight, function), False
+
+    def _lead(self, key: Hashable, flight: _Flight[T], function: Callable[[], T]) -> T:
+        try:
+            flight.result = function()
+            return flight.result
+        except BaseException as e:
+            flight.exception = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    async def ado(
+        self, key: Hashable, function: Callable[[], Awaitable[T]]
+    ) -> Tuple[T, bool]:
+        """Await `function()`, unless a call with the same key is in flight.
+
+        The call runs in a task of its own, so it goes on if the caller that started
+        it is cancelled while others still wait for it.
+
+        Args:
+            key: Identifies calls that have the same outcome.
+            function: The coroutine function to call if no call is in flight.
+
+        Returns:
+            The outcome of the call, and whether it was taken from another caller's
+            call. Such a result is the very object the other caller got: copy it
+            before handing it out if it may be mutated.
+        """
+        import asyncio
+
+        loop_key = (id(asyncio.get_running_loop()), key)
+        with self._lock:
+            task = self._tasks.get(loop_key)
+            leader = task is None
+            if task is None:
+                task = self._tasks[loop_key] = asyncio.ensure_future(function())
+                task.add_done_callback(partial(self._land, loop_key))
+        result: T = await asyncio.shield(task)
+        return result, not leader
+
+    def _land(self, loop_key: Tuple[int, Hashable], task: Any) -> None:
+        with self._lock:
+            del self._tasks[loop_key]
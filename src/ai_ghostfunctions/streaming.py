@@ -0,0 +1,157 @@
+"""Incremental parsing of streamed list results.
+
+When a ghostfunction returns a list (or an iterator) the completion text is a list
+literal such as `['a', 'b', 'c']`. `IncrementalListParser` splits that text into
+the source of each element as soon as the element is complete, so elements can be
+parsed and handed to the caller while the rest of the response is still streaming.
+"""
+
+import collections.abc
+import typing
+from typing import Any
+from typing import Iterable
+from typing import List
+from typing import Optional
+
+
+_OPENING = "[({"
+_CLOSING = "])}"
+_STREAMABLE_ORIGINS = (
+    list,
+    collections.abc.Iterator,
+    collections.abc.Iterable,
+    collections.abc.Generator,
+    collections.abc.Sequence,
+    collections.abc.AsyncIterator,
+    collections.abc.AsyncIterable,
+    collections.abc.AsyncGenerator,
+)
+
+
+def element_type(return_type: Any) -> Any:
+    """Return the element type of a list or iterator return type.
+
+    Args:
+        return_type: The return annotation of a ghostfunction.
+
+    Returns:
+        The element type, `Any` if the annotation is not parameterized.
+
+    Raises:
+        TypeError: If `return_type` is not a list or iterator type.
+    """
+    if return_type is list:
+        return Any
+    origin = typing.get_origin(return_type)
+    if origin in _STREAMABLE_ORIGINS:
+        args = typing.get_args(return_type)
+        return args[0] if args else Any
+    raise TypeError(
+        f"Only list or iterator return types can be streamed, not {return_type!r}."
+    )
+
+
+class IncrementalListParser:
+    """Split a streamed list literal into the source text of its elements.
+
+    Feed chunks of text with `feed`; it returns the elements completed by the chunk.
+    Text before the opening `[` is ignored. Call `close` once the stream ends.
+    """
+
+    def __init__(self) -> None:
+        """Create a parser waiting for the opening bracket."""
+        self._started = False
+        self._finished = False
+        self._depth = 0
+        self._quote: Optional[str] = None
+        self._escaped = False
+        self._current: List[str] = []
+
+    @property
+    def finished(self) -> bool:
+        """Whether the closing bracket of the list has been seen."""
+        return self._finished
+
+    def feed(self, text: str) -> List[str]:
+        """Consume a chunk of text.
+
+        Args:
+            text: The next chunk of the completion.
+
+        Returns:
+            The source of every element completed by this chunk.
+        """
+        elements: List[str] = []
+        for char in text:
+            if self._finished:
+                break
+            if not self._started:
+                self._started = char == "["
+                continue
+            if self._quote is not None:
+                self._current.append(char)
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == self._quote:
+                    self._quote = None
+                continue
+            if self._depth == 0 and char in ",]":
+                self._emit(elements)
+                self._finished = char == "]"
+                continue
+            self._current.append(char)
+            if char in "'\"":
+                self._quote = char
+            elif char in _OPENING:
+                self._depth += 1
+            elif char in _CLOSING:
+                self._depth -= 1
+        return elements
+
+    def close(self) -> None:
+        """Signal the end of the stream.
+
+        Raises:
+            SyntaxError: If the text did not contain a complete list.
+        """
+        if not self._finished:
+            raise SyntaxError("The streamed result ended before the list was closed.")
+
+    def _emit(self, elements: List[str]) -> None:
+        source = "".join(self._current).strip()
+        self._current = []
+        if source:  # empty lists and trailing commas have no element
+            elements.append(source)
+
+
+def chunk_texts(chunks: Iterable[Any]) -> Iterable[str]:
+    """Extract the text of the first choice from streamed completion chunks.
+
+    Args:
+        chunks: `ChatCompletionChunk`s from a `stream=True` completion.
+
+    Yields:
+        The non-empty text deltas of choice 0.
+    """
+    for chunk in chunks:
+        text = chunk_text(chunk)
+        if text:
+            yield text
+
+
+def chunk_text(chunk: Any) -> Optional[str]:
+    """Return the text delta of the first choice of a streamed completion chunk.
+
+    Args:
+        chunk: A `ChatCompletionChunk`.
+
+    Returns:
+        The text, or None if the chunk has no text for choice 0.
+    """
+    for choice in chunk.choices:
+        if choice.index == 0:
+            content: Optional[str] = choice.delta.content
+            return content
+    return None
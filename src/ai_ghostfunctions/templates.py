@@ -0,0 +1,124 @@
+"""Per-function prompt templates.
+
+Everything in a ghostfunction prompt except the call line depends only on the
+decorated function: its name, return annotation, docstring and parameter order.
+`compile_template` computes those parts once per function so each call only has
+to render the argument reprs.
+"""
+
+import inspect
+import threading
+import weakref
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Sequence
+from typing import Tuple
+from typing import get_type_hints
+
+
+class FunctionTemplate:
+    """The argument-independent parts of the prompt for a function.
+
+    Args:
+        function: The function to compile a template for.
+
+    Raises:
+        ValueError: If `function` has no docstring.
+    """
+
+    def __init__(self, function: Callable[..., Any]) -> None:
+        """Compile the template."""
+        if not function.__doc__:
+            raise ValueError("The function must have a docstring.")
+        self.name: str = function.__name__
+        self.parameters: Tuple[str, ...] = tuple(inspect.signature(function).parameters)
+        self.return_type_annotation: Any = get_type_hints(function)["return"]
+        self.docstring_block = "\n".join(
+            [f"# {line}" for line in function.__doc__.split("\n")]
+        )
+        self.header = (
+            (
+                f"from mymodule import {self.name}\n"
+                f"""
+# The return type annotation for the function {self.name} is {self.return_type_annotation}
+# The docstring for the function {self.name} is the following:
+"""  # noqa: E231
+            )
+            + self.docstring_block
+            + "\n"
+        )
+
+    def render_call(self, *args: Any, **kwargs: Any) -> str:
+        """Render the call expression, e.g. `f(x=1,y='a')`.
+
+        Args:
+            args: Positional arguments of the call.
+            kwargs: Keyword arguments of the call.
+
+        Returns:
+            The function name applied to the repr of every argument, by keyword.
+        """
+        values = dict(kwargs)
+        values.update((self.parameters[i], arg) for i, arg in enumerate(args))
+        return f"""{self.name}({",".join(f"{k}={values[k]!r}" for k in self.parameters)})"""
+
+    def render(self, *args: Any, **kwargs: Any) -> str:
+        """Render the prompt for a single call.
+
+        Args:
+            args: Positional arguments of the call.
+            kwargs: Keyword arguments of the call.
+
+        Returns:
+            The header followed by `result = <call>` and `print(result)`.
+        """
+        call = self.render_call(*args, **kwargs)
+        return f"{self.header}result = {call}\nprint(result)\n"
+
+    def render_packed(
+        self, calls: Sequence[Tuple[Tuple[Any, ...], Dict[str, Any]]]
+    ) -> str:
+        """Render the prompt for several calls answered together.
+
+        Args:
+            calls: The `(args, kwargs)` of each call.
+
+        Returns:
+            The header followed by one `result_i = <call>` line per call and a print of
+            the list of results.
+        """
+        return (
+            self.header
+            + "".join(
+                f"result_{i} = {self.render_call(*args, **kwargs)}\n"
+                for i, (args, kwargs) in enumerate(calls)
+            )
+            + f"print([{', '.join(f'result_{i}' for i in range(len(calls)))}])\n"
+        )
+
+
+_lock = threading.Lock()
+_templates: "weakref.WeakKeyDictionary[Callable[..., Any], FunctionTemplate]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def compile_template(function: Callable[..., Any]) -> FunctionTemplate:
+    """Return the compiled template for `function`, compiling it on first use.
+
+    Args:
+        function: The function whose prompt template to return.
+
+    Returns:
+        The template, cached for as long as `function` is alive.
+    """
+    try:
+        return _templates[function]
+    except KeyError:
+        pass
+    except TypeError:  # not weak-referenceable, so it cannot be cached
+        return FunctionTemplate(function)
+    template = FunctionTemplate(function)
+    with _lock:
+        return _templates.setdefault(function, template)
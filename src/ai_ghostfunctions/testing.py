@@ -0,0 +1,183 @@
+"""A deterministic stand-in for the OpenAI API, for tests and benchmarks.
+
+`FakeAI` is an `ai_callable` answering every request locally, after a
+configurable latency, with completions produced by a `responder`. It understands
+`n` and `stream=True`, and reports `usage` like the API does, so every code path of
+a ghostfunction can be exercised without network access or API costs::
+
+    fake = FakeAI(list_response(1000), latency=0.05)
+
+    @ghostfunction(ai_callable=fake)
+    def numbers() -> List[int]:
+        '''Return numbers.'''
+
+`fake.acall` is the same fake as a coroutine function, for async ghostfunctions.
+"""
+
+import itertools
+import random
+import threading
+import time
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Union
+
+from .backends import make_chunks
+from .backends import make_completion
+
+
+if TYPE_CHECKING:  # imported on first use to keep `import ai_ghostfunctions` fast
+    from openai.types.chat.chat_completion import ChatCompletion
+    from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+
+Responder = Callable[[Dict[str, Any], int], str]
+
+
+def list_response(size: int) -> Responder:
+    """Return a responder answering a list literal of `size` integers.
+
+    Args:
+        size: The number of elements.
+
+    Returns:
+        The responder.
+    """
+    text = repr(list(range(size)))
+    return lambda kwargs, index: text
+
+
+def dict_response(size: int) -> Responder:
+    """Return a responder answering a dict literal of `size` string keys.
+
+    Args:
+        size: The number of items.
+
+    Returns:
+        The responder.
+    """
+    text = repr({f"key_{i}": [i, str(i)] for i in range(size)})
+    return lambda kwargs, index: text
+
+
+def cycle_response(*texts: str) -> Responder:
+    """Return a responder answering `texts` in turn, one per choice.
+
+    Args:
+        texts: The completion texts.
+
+    Returns:
+        The responder.
+    """
+    counter = itertools.count()
+    lock = threading.Lock()
+
+    def respond(kwargs: Dict[str, Any], index: int) -> str:
+        with lock:
+            return texts[next(counter) % len(texts)]
+
+    return respond
+
+
+class FakeAI:
+    """An `ai_callable` answering requests locally.
+
+    Args:
+        responder: The completion text of every choice, or a function of the request
+            keyword arguments and the choice index returning it.
+        latency: Seconds each request takes.
+        jitter: Up to this many seconds are added to `latency`, drawn from a
+            generator seeded with `seed`, so runs are reproducible.
+        seed: The seed of the jitter.
+        chunk_size: Characters per chunk of streamed responses.
+        model: The model reported in the responses.
+    """
+
+    def __init__(
+        self,
+        responder: Union[str, Responder] = "None",
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        seed: int = 0,
+        chunk_size: int = 16,
+        model: str = "fake",
+    ) -> None:
+        """Create the fake."""
+        if isinstance(responder, str):
+            text = responder
+            self.responder: Responder = lambda kwargs, index: text
+        else:
+            self.responder = responder
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_size = chunk_size
+        self.model = model
+        self._random = random.Random(seed)  # nosec: not used for security
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def _delay(self) -> float:
+        with self._lock:
+            self.calls += 1
+            if not self.jitter:
+                return self.latency
+            return self.latency + self._random.uniform(0, self.jitter)
+
+    def __call__(self, **kwargs: Any) -> Any:
+        """Answer a request after the latency.
+
+        Args:
+            kwargs: The keyword arguments of the request.
+
+        Returns:
+            A `ChatCompletion`, or an iterator of `ChatCompletionChunk`s if
+            `stream=True`.
+        """
+        delay = self._delay()
+        if delay:
+            time.sleep(delay)
+        return self._respond(kwargs)
+
+    async def acall(self, **kwargs: Any) -> Any:
+        """Answer a request after the latency, without blocking the event loop.
+
+        Args:
+            kwargs: The keyword arguments of the request.
+
+        Returns:
+            A `ChatCompletion`, or an iterator of `ChatCompletionChunk`s if
+            `stream=True`.
+        """
+        import asyncio
+
+        delay = self._delay()
+        if delay:
+            await asyncio.sleep(delay)
+        return self._respond(kwargs)
+
+    def _texts(self, kwargs: Dict[str, Any]) -> List[str]:
+        return [self.responder(kwargs, i) for i in range(kwargs.get("n") or 1)]
+
+    def _respond(self, kwargs: Dict[str, Any]) -> Any:
+        texts = self._texts(kwargs)
+        if kwargs.get("stream"):
+            return self._stream(texts)
+        return self._completion(kwargs, texts)
+
+    def _completion(self, kwargs: Dict[str, Any], texts: List[str]) -> "ChatCompletion":
+        prompt_tokens = (
+            sum(len(m["content"]) for m in kwargs.get("messages") or ()) // 4
+        )
+        completion_tokens = sum(len(t) for t in texts) // 4
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        return make_completion(texts, self.model, usage)
+
+    def _stream(self, texts: List[str]) -> Iterator["ChatCompletionChunk"]:
+        return make_chunks(texts, self.model, self.chunk_size)
@@ -0,0 +1,426 @@
+"""Prompt token accounting and per-function token budgets.
+
+Ghostfunction prompts embed the `repr()` of every argument, so one large argument
+can make a prompt exceed the model's context window, or cost far more than
+intended. `count_tokens` measures a prompt before it is sent, and a ghostfunction
+created with a `TokenBudget` shrinks its arguments until the prompt fits::
+
+    @ghostfunction(token_budget=TokenBudget(2000, strategy="sample"))
+    def classify(reviews: List[str]) -> str:
+        '''Return the overall sentiment of `reviews`.'''
+
+Tokens are counted with `tiktoken` when it is installed, and estimated from the
+words and punctuation of the text otherwise.
+"""
+
+import math
+import re
+import threading
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Mapping
+from typing import NoReturn
+from typing import Optional
+from typing import Protocol
+from typing import Sequence
+from typing import Tuple
+
+from .types import Message
+
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+
+STRATEGIES = ("truncate", "sample", "chunk", "error")
+
+# tokens added per message, and to prime the reply, by the chat format
+_TOKENS_PER_MESSAGE = 3
+_TOKENS_PER_REPLY = 3
+
+_ELLIPSIS = "..."
+
+
+class Tokenizer(Protocol):
+    """Counts the tokens of a text for one model."""
+
+    def count(self, text: str) -> int:  # noqa: DAR202
+        """Return the number of tokens of `text`.
+
+        Args:
+            text: The text to count.
+        """
+
+
+class HeuristicTokenizer:
+    """Estimate token counts without a tokenizer.
+
+    Every punctuation character counts as a token, and every run of word
+    characters as one token per `chars_per_token` characters, which is close to
+    the BPE tokenizers of OpenAI models for English text and code.
+
+    Args:
+        chars_per_token: The average length of a word piece.
+    """
+
+    _pieces = re.compile(r"\w+|[^\w\s]")
+
+    def __init__(self, chars_per_token: float = 4.0) -> None:
+        """Create the tokenizer."""
+        self.chars_per_token = chars_per_token
+
+    def count(self, text: str) -> int:
+        """Return the estimated number of tokens of `text`.
+
+        Args:
+            text: The text to count.
+
+        Returns:
+            The estimate.
+        """
+        per_token = self.chars_per_token
+        return sum(
+            math.ceil(len(piece) / per_token) for piece in self._pieces.findall(text)
+        )
+
+
+class TiktokenTokenizer:
+    """Count tokens exactly with `tiktoken`.
+
+    Args:
+        model: The model whose encoding to use. Unknown models use `cl100k_base`.
+    """
+
+    def __init__(self, model: str) -> None:
+        """Load the encoding of `model`."""
+        import tiktoken
+
+        try:
+            self.encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            self.encoding = tiktoken.get_encoding("cl100k_base")
+
+    def count(self, text: str) -> int:
+        """Return the number of tokens of `text`.
+
+        Args:
+            text: The text to count.
+
+        Returns:
+            The number of tokens.
+        """
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+
+_lock = threading.Lock()
+_tokenizers: Dict[str, Tokenizer] = {}
+
+
+def get_tokenizer(model: Optional[str] = None) -> Tokenizer:
+    """Return the tokenizer of `model`, loading it on first use.
+
+    Args:
+        model: The model name. Defaults to `DEFAULT_MODEL`.
+
+    Returns:
+        A `TiktokenTokenizer` if `tiktoken` is installed, else a `HeuristicTokenizer`.
+    """
+    model = model or DEFAULT_MODEL
+    tokenizer = _tokenizers.get(model)
+    if tokenizer is None:
+        try:
+            tokenizer = TiktokenTokenizer(model)
+        except ImportError:
+            tokenizer = HeuristicTokenizer()
+        with _lock:
+            tokenizer = _tokenizers.setdefault(model, tokenizer)
+    return tokenizer
+
+
+def count_tokens(messages: Sequence[Message], model: Optional[str] = None) -> int:
+    """Return the number of prompt tokens of a chat completion request.
+
+    Args:
+        messages: The messages of the request.
+        model: The model the request is sent to.
+
+    Returns:
+        The tokens of every message, including the chat format overhead.
+    """
+    tokenizer = get_tokenizer(model)
+    return _TOKENS_PER_REPLY + sum(
+        _TOKENS_PER_MESSAGE + tokenizer.count(message["content"])
+        for message in messages
+    )
+
+
+def model_name(ai_kwargs: Mapping[str, Any]) -> Optional[str]:
+    """Return the (first) model named in the keyword arguments of a ghostfunction.
+
+    Args:
+        ai_kwargs: The keyword arguments sent to the `ai_callable`.
+
+    Returns:
+        The model, or None if none is set.
+    """
+    model = ai_kwargs.get("model")
+    if isinstance(model, (list, tuple)):
+        return str(model[0]) if model else None
+    return None if model is None else str(model)
+
+
+class TokenBudgetExceeded(ValueError):
+    """Raised when a prompt does not fit a `TokenBudget`."""
+
+
+class _Abridged:
+    """An argument standing in for one whose repr was cut short."""
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+
+    def __repr__(self) -> str:
+        return self.text
+
+
+_SPLITTABLE = (str, bytes, list, tuple, dict, set, frozenset)
+
+
+def _size(value: Any) -> int:
+    """Return the number of parts `value` can be cut into: elements or characters."""
+    return len(value) if isinstance(value, _SPLITTABLE) else len(repr(value))
+
+
+def _truncate(value: Any, keep: int) -> Any:
+    if isinstance(value, str):
+        return value[:keep] + _ELLIPSIS
+    if isinstance(value, (bytes, list, tuple)):
+        return value[:keep]
+    if isinstance(value, dict):
+        return dict(list(value.items())[:keep])
+    if isinstance(value, (set, frozenset)):
+        return type(value)(list(value)[:keep])
+    return _Abridged(repr(value)[:keep] + _ELLIPSIS)
+
+
+def _spread(count: int, keep: int) -> List[int]:
+    """Return `keep` evenly spaced indices out of `count`."""
+    return [i * count // keep for i in range(keep)] if keep else []
+
+
+def _evenly(count: int, keep: int) -> List[int]:
+    """Return `keep` evenly spaced indices out of `count`, first and last included."""
+    if keep < 2:
+        return list(range(keep))
+    return [i * (count - 1) // (keep - 1) for i in range(keep)]
+
+
+def _sample(value: Any, keep: int) -> Any:
+    if isinstance(value, (list, tuple)):
+        return type(value)(value[i] for i in _evenly(len(value), keep))
+    if isinstance(value, dict):
+        items = list(value.items())
+        return dict(items[i] for i in _evenly(len(items), keep))
+    if isinstance(value, (set, frozenset)):
+        elements = list(value)
+        return type(value)(elements[i] for i in _evenly(len(elements), keep))
+    return _truncate(value, keep)
+
+
+def split(value: Any, parts: int) -> List[Any]:
+    """Split a collection or string into `parts` contiguous chunks of similar size.
+
+    Args:
+        value: A str, bytes, list, tuple, dict, set or frozenset.
+        parts: The number of chunks.
+
+    Returns:
+        The non-empty chunks, of the type of `value`.
+
+    Raises:
+        TypeError: If `value` cannot be split.
+    """
+    if not isinstance(value, _SPLITTABLE):
+        raise TypeError(f"Cannot split an argument of type {type(value).__name__}.")
+    if isinstance(value, (str, bytes, list, tuple)):
+        elements: Sequence[Any] = value
+    else:
+        elements = list(value.items() if isinstance(value, dict) else value)
+    bounds = _spread(len(elements), min(parts, len(elements))) + [len(elements)]
+    chunks = [
+        elements[start:stop] for start, stop in zip(bounds, bounds[1:])  # noqa: B905
+    ]
+    if isinstance(value, (str, bytes, list, tuple)):
+        return chunks
+    return [type(value)(chunk) for chunk in chunks]
+
+
+def concatenate(partials: Iterable[Any]) -> Any:
+    """Combine the results of a ghostfunction called on chunks of an argument.
+
+    Args:
+        partials: The results, in chunk order.
+
+    Returns:
+        Lists and tuples concatenated, dicts merged, strings joined by newlines.
+
+    Raises:
+        TypeError: If the results are of another type; pass a `reduce` function
+            to `TokenBudget` for those.
+    """
+    partials = list(partials)
+    first = partials[0] if partials else None
+    if isinstance(first, str):
+        return "\n".join(partials)
+    if isinstance(first, (list, tuple)):
+        return type(first)(element for partial in partials for element in partial)
+    if isinstance(first, dict):
+        merged: Dict[Any, Any] = {}
+        for partial in partials:
+            merged.update(partial)
+        return merged
+    raise TypeError(
+        "Cannot combine partial results of type"
+        f" {type(first).__name__}; pass a reduce function to TokenBudget."
+    )
+
+
+class TokenBudget:
+    """The maximum prompt size of a ghostfunction, and how to stay within it.
+
+    When the prompt of a call has more than `max_prompt_tokens` tokens, the largest
+    argument is shrunk and the prompt rendered again, until it fits:
+
+    - `"truncate"` cuts strings and collections short (other arguments are cut in
+      their repr), keeping their beginning.
+    - `"sample"` keeps evenly spaced elements of collections, so the whole range of
+      the data is represented; strings and other arguments are truncated.
+    - `"chunk"` splits the largest argument, calls the ghostfunction on each chunk
+      concurrently and combines the partial results with `reduce`.
+    - `"error"` raises `TokenBudgetExceeded`.
+
+    Args:
+        max_prompt_tokens: The maximum number of prompt tokens.
+        strategy: One of `STRATEGIES`.
+        reduce: Combines the results of the chunks with the `"chunk"` strategy.
+            Defaults to `concatenate`.
+        model: The model whose tokenizer to use. Defaults to the `model` the
+            ghostfunction sends requests to.
+        max_rounds: How many times arguments are shrunk before giving up.
+        max_concurrency: The maximum number of chunks called at once with the
+            `"chunk"` strategy.
+
+    Raises:
+        ValueError: If `strategy` is unknown, or `max_prompt_tokens` or
+            `max_concurrency` < 1.
+    """
+
+    def __init__(
+        self,
+        max_prompt_tokens: int,
+        strategy: str = "truncate",
+        reduce: Callable[[List[Any]], Any] = concatenate,
+        model: Optional[str] = None,
+        max_rounds: int = 32,
+        max_concurrency: int = 8,
+    ) -> None:
+        """Create the budget."""
+        if strategy not in STRATEGIES:
+            raise ValueError(f"strategy must be one of {', '.join(STRATEGIES)}.")
+        if max_prompt_tokens < 1:
+            raise ValueError("max_prompt_tokens must be at least 1.")
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1.")
+        self.max_prompt_tokens = max_prompt_tokens
+        self.strategy = strategy
+        self.reduce = reduce
+        self.model = model
+        self.max_rounds = max_rounds
+        self.max_concurrency = max_concurrency
+
+    def fit(
+        self,
+        render: Callable[..., List[Message]],
+        arguments: Dict[str, Any],
+        tokens: int,
+        model: Optional[str] = None,
+    ) -> Tuple[List[Message], Dict[str, Any]]:
+        """Shrink `arguments` until their prompt fits the budget.
+
+        Args:
+            render: Renders the prompt of keyword arguments.
+            arguments: The arguments of the call, by parameter name.
+            tokens: The token count of the prompt of `arguments`.
+            model: The model to count tokens for, unless the budget names one.
+
+        Returns:
+            The prompt that fits, and the arguments it was rendered from.
+        """
+        model = self.model or model
+        shrink = _sample if self.strategy == "sample" else _truncate
+        rounds = self.max_rounds if self.strategy in ("truncate", "sample") else 0
+        sizes = {name: _size(value) for name, value in arguments.items()}
+        shrunk = dict(arguments)
+        for _ in range(rounds):
+            name = max(sizes, key=sizes.__getitem__, default="")
+            size = sizes.get(name, 0)
+            if not size:
+                break
+            # shrink in proportion to the excess, and by at least one part
+            value_tokens = max(get_tokenizer(model).count(repr(shrunk[name])), 1)
+            excess = tokens - self.max_prompt_tokens
+            sizes[name] = min(
+                size - 1, max(0, size * (value_tokens - excess) // value_tokens)
+            )
+            shrunk[name] = shrink(arguments[name], sizes[name])
+            prompt = render(**shrunk)
+            tokens = count_tokens(prompt, model)
+            if tokens <= self.max_prompt_tokens:
+                return prompt, shrunk
+        self._exceeded(tokens)
+
+    def chunks(
+        self,
+        render: Callable[..., List[Message]],
+        arguments: Dict[str, Any],
+        tokens: int,
+        model: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """Split the largest argument so that the prompt of every chunk fits.
+
+        Args:
+            render: Renders the prompt of keyword arguments.
+            arguments: The arguments of the call, by parameter name.
+            tokens: The token count of the prompt of `arguments`.
+            model: The model to count tokens for, unless the budget names one.
+
+        Returns:
+            The arguments of each chunk, in order.
+        """
+        model = self.model or model
+        splittable = [n for n, v in arguments.items() if isinstance(v, _SPLITTABLE)]
+        name = max(splittable, key=lambda n: len(arguments[n]), default="")
+        value = arguments.get(name, ())
+        if len(value) < 2:
+            self._exceeded(tokens)
+        fixed = count_tokens(render(**{**arguments, name: _truncate(value, 0)}), model)
+        room = max(self.max_prompt_tokens - fixed, 1)
+        parts = max(2, math.ceil((tokens - fixed) / room))
+        while True:
+            parts = min(parts, len(value))
+            chunks = [{**arguments, name: chunk} for chunk in split(value, parts)]
+            if all(
+                count_tokens(render(**chunk), model) <= self.max_prompt_tokens
+                for chunk in chunks
+            ):
+                return chunks
+            if parts == len(value):
+                self._exceeded(tokens)
+            parts *= 2
+
+    def _exceeded(self, tokens: int) -> NoReturn:
+        raise TokenBudgetExceeded(
+            f"The prompt has {tokens} tokens, more than the budget of"
+            f" {self.max_prompt_tokens} allows (strategy {self.strategy!r})."
+        )
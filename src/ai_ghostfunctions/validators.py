@@ -0,0 +1,330 @@
+"""Compiled parsers and type checkers for ghostfunction return types.
+
+`compile_validator` turns a return annotation into a `Validator` once, with fast
+paths for builtin scalars, lists, dicts, tuples, unions, TypedDicts and dataclasses.
+Types without a fast path fall back to `typeguard.check_type`. Validators raise
+`typeguard.TypeCheckError` on mismatches, like `typeguard.check_type` does.
+"""
+
+import ast
+import dataclasses
+import json
+import sys
+import threading
+import typing
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import NoReturn
+from typing import Optional
+from typing import Tuple
+from typing import get_type_hints
+
+
+if sys.version_info >= (3, 10):  # pragma: no cover
+    from types import UnionType
+
+    _UNION_TYPES: Tuple[Any, ...] = (typing.Union, UnionType)
+else:  # pragma: no cover
+    _UNION_TYPES = (typing.Union,)
+
+_NoneType = type(None)
+_SCALARS = (str, bytes, int, float, bool, complex, _NoneType)
+
+
+def _fail(value: Any, expected: Any) -> NoReturn:
+    import typeguard
+
+    raise typeguard.TypeCheckError(
+        f"{type(value).__qualname__} is not an instance of {expected!r}"
+    )
+
+
+def _literal(string: str) -> Any:
+    return ast.literal_eval(string)
+
+
+def _json_or_literal(string: str) -> Any:
+    # json's C parser is much faster than literal_eval on large containers, and
+    # models often answer with json anyway; python reprs fall back to literal_eval
+    if string[:1] in "[{":
+        try:
+            return json.loads(string)
+        except ValueError:
+            pass
+    return ast.literal_eval(string)
+
+
+def _parse_str(string: str) -> Any:
+    if string.startswith("'") and string.endswith("'"):
+        return ast.literal_eval(string)
+    elif string.startswith('"') and string.endswith('"'):
+        return ast.literal_eval(string)
+    return string
+
+
+def _parse_int(string: str) -> Any:
+    try:
+        return int(string)
+    except ValueError:
+        return ast.literal_eval(string)
+
+
+def _parse_bool(string: str) -> Any:
+    stripped = string.strip()
+    if stripped == "True":
+        return True
+    if stripped == "False":
+        return False
+    return ast.literal_eval(string)
+
+
+class Validator:
+    """Parse completion text into, and check values against, one type.
+
+    Args:
+        expected_type: The type this validator checks.
+        coerce: Function converting a literal python value to `expected_type`,
+            raising `typeguard.TypeCheckError` if it cannot.
+        literal: Function turning completion text into a literal python value.
+    """
+
+    def __init__(
+        self,
+        expected_type: Any,
+        coerce: Callable[[Any], Any],
+        literal: Callable[[str], Any] = _literal,
+    ) -> None:
+        """Create the validator."""
+        self.expected_type = expected_type
+        self.coerce = coerce
+        self._literal = literal
+
+    def parse(self, string: str) -> Any:
+        """Parse completion text into a value of the expected type.
+
+        Args:
+            string: The text returned by the AI.
+
+        Returns:
+            The parsed and validated value.
+        """
+        return self.coerce(self._literal(string))
+
+    def decode(self, string: str) -> Any:
+        """Turn completion text into a python value, without validating it.
+
+        Args:
+            string: The text returned by the AI.
+
+        Returns:
+            The literal value, to be passed to `coerce`.
+        """
+        return self._literal(string)
+
+
+def _coerce_scalar(expected_type: Any) -> Callable[[Any], Any]:
+    accepted: Tuple[type, ...] = (expected_type,)
+    # the numeric tower of PEP 484, as in typeguard
+    if expected_type is float:
+        accepted = (int, float)
+    elif expected_type is complex:
+        accepted = (int, float, complex)
+
+    def coerce(value: Any) -> Any:
+        if isinstance(value, accepted):
+            return value
+        return _fail(value, expected_type)
+
+    return coerce
+
+
+def _coerce_list(container: Any, element: Optional[Validator]) -> Callable[[Any], Any]:
+    def coerce(value: Any) -> Any:
+        if not isinstance(value, container):
+            return _fail(value, container)
+        if element is None:
+            return value
+        return container(element.coerce(item) for item in value)
+
+    return coerce
+
+
+def _coerce_dict(
+    key: Optional[Validator], val: Optional[Validator]
+) -> Callable[[Any], Any]:
+    def coerce(value: Any) -> Any:
+        if not isinstance(value, dict):
+            return _fail(value, dict)
+        if key is None and val is None:
+            return value
+        return {
+            (k if key is None else key.coerce(k)): (v if val is None else val.coerce(v))
+            for k, v in value.items()
+        }
+
+    return coerce
+
+
+def _coerce_tuple(elements: Tuple[Validator, ...]) -> Callable[[Any], Any]:
+    def coerce(value: Any) -> Any:
+        if not isinstance(value, tuple) or len(value) != len(elements):
+            return _fail(value, tuple)
+        return tuple(e.coerce(v) for e, v in zip(elements, value))  # noqa: B905
+
+    return coerce
+
+
+def _coerce_union(
+    options: Tuple[Validator, ...], expected: Any
+) -> Callable[[Any], Any]:
+    def coerce(value: Any) -> Any:
+        import typeguard
+
+        for option in options:
+            try:
+                return option.coerce(value)
+            except typeguard.TypeCheckError:
+                continue
+        return _fail(value, expected)
+
+    return coerce
+
+
+def _coerce_typeddict(expected_type: Any) -> Callable[[Any], Any]:
+    fields = {k: compile_validator(v) for k, v in get_type_hints(expected_type).items()}
+    required = getattr(
+        expected_type,
+        "__required_keys__",
+        frozenset(fields) if expected_type.__total__ else frozenset(),
+    )
+
+    def coerce(value: Any) -> Any:
+        if not isinstance(value, dict) or not required <= value.keys():
+            return _fail(value, expected_type)
+        if not value.keys() <= fields.keys():
+            return _fail(value, expected_type)
+        return {k: fields[k].coerce(v) for k, v in value.items()}
+
+    return coerce
+
+
+def _coerce_dataclass(expected_type: Any) -> Callable[[Any], Any]:
+    hints = get_type_hints(expected_type)
+    fields = {
+        f.name: compile_validator(hints[f.name])
+        for f in dataclasses.fields(expected_type)
+        if f.init
+    }
+
+    def coerce(value: Any) -> Any:
+        if isinstance(value, expected_type):
+            return value
+        if not isinstance(value, dict) or not value.keys() <= fields.keys():
+            return _fail(value, expected_type)
+        try:
+            return expected_type(**{k: fields[k].coerce(v) for k, v in value.items()})
+        except TypeError:  # missing required fields
+            return _fail(value, expected_type)
+
+    return coerce
+
+
+def _coerce_with_typeguard(expected_type: Any) -> Callable[[Any], Any]:
+    def coerce(value: Any) -> Any:
+        import typeguard
+
+        return typeguard.check_type(value, expected_type)
+
+    return coerce
+
+
+def _is_typeddict(expected_type: Any) -> bool:
+    return (
+        isinstance(expected_type, type)
+        and issubclass(expected_type, dict)
+        and hasattr(expected_type, "__total__")
+    )
+
+
+def _optional_validator(arg: Any) -> Optional[Validator]:
+    return None if arg is Any else compile_validator(arg)
+
+
+def _compile(expected_type: Any) -> Validator:
+    if expected_type is None:
+        expected_type = _NoneType
+    if expected_type is Any:
+        return Validator(expected_type, lambda value: value)
+    if expected_type is str:
+        return Validator(expected_type, _coerce_scalar(str), _parse_str)
+    if expected_type is int:
+        return Validator(expected_type, _coerce_scalar(int), _parse_int)
+    if expected_type is bool:
+        return Validator(expected_type, _coerce_scalar(bool), _parse_bool)
+    if expected_type in _SCALARS:
+        return Validator(expected_type, _coerce_scalar(expected_type))
+    if expected_type in (list, dict):
+        return Validator(expected_type, _coerce_scalar(expected_type), _json_or_literal)
+    if _is_typeddict(expected_type):
+        return Validator(
+            expected_type, _coerce_typeddict(expected_type), _json_or_literal
+        )
+    if dataclasses.is_dataclass(expected_type) and isinstance(expected_type, type):
+        return Validator(
+            expected_type, _coerce_dataclass(expected_type), _json_or_literal
+        )
+
+    origin = typing.get_origin(expected_type)
+    args = typing.get_args(expected_type)
+    if origin is list and len(args) == 1:
+        return Validator(
+            expected_type,
+            _coerce_list(list, _optional_validator(args[0])),
+            _json_or_literal,
+        )
+    if origin is dict and len(args) == 2:
+        return Validator(
+            expected_type,
+            _coerce_dict(_optional_validator(args[0]), _optional_validator(args[1])),
+            _json_or_literal,
+        )
+    if origin is tuple and len(args) == 2 and args[1] is Ellipsis:
+        return Validator(
+            expected_type, _coerce_list(tuple, _optional_validator(args[0]))
+        )
+    if origin is tuple and args and Ellipsis not in args and args != ((),):
+        return Validator(
+            expected_type, _coerce_tuple(tuple(compile_validator(a) for a in args))
+        )
+    if origin in _UNION_TYPES:
+        return Validator(
+            expected_type,
+            _coerce_union(tuple(compile_validator(a) for a in args), expected_type),
+            _json_or_literal,
+        )
+    return Validator(expected_type, _coerce_with_typeguard(expected_type))
+
+
+_lock = threading.Lock()
+_validators: Dict[Any, Validator] = {}
+
+
+def compile_validator(expected_type: Any) -> Validator:
+    """Return the validator for `expected_type`, compiling it on first use.
+
+    Args:
+        expected_type: A return type annotation.
+
+    Returns:
+        The validator, cached per type.
+    """
+    try:
+        return _validators[expected_type]
+    except KeyError:
+        pass
+    except TypeError:  # unhashable annotation, so it cannot be cached
+        return _compile(expected_type)
+    validator = _compile(expected_type)
+    with _lock:
+        return _validators.setdefault(expected_type, validator)
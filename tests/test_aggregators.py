@@ -0,0 +1,145 @@
+import asyncio
+import threading
+from typing import Any
+from typing import Iterator
+from typing import List
+from unittest.mock import Mock
+
+import pytest
+from openai.types.chat.chat_completion import ChatCompletion
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+
+from ai_ghostfunctions import ghostfunction
+from ai_ghostfunctions.aggregators import first_valid
+from ai_ghostfunctions.aggregators import majority_vote
+from ai_ghostfunctions.aggregators import quorum
+from ai_ghostfunctions.backends import make_completion
+from ai_ghostfunctions.cache import InMemoryCache
+
+
+def _chunk(index: int, text: str, finished: bool = False) -> ChatCompletionChunk:
+    return ChatCompletionChunk.model_construct(  # type: ignore[no-any-return]
+        choices=[
+            {  # type: ignore[list-item]
+                "index": index,
+                "delta": {"content": text},
+                "finish_reason": "stop" if finished else None,
+            }
+        ]
+    )
+
+
+def test_majority_vote_decides_once_the_leader_cannot_be_caught() -> None:
+    assert majority_vote.decide([1, 1], remaining=3) == (False, None)
+    assert majority_vote.decide([1, 1, 1], remaining=2) == (True, 1)
+    assert majority_vote.decide([1, 2], remaining=0) == (True, 1)
+    assert majority_vote([[1], [2], [2]]) == [2]
+
+
+def test_quorum_fails_once_unreachable() -> None:
+    assert quorum(2).decide(["a", "b", "a"], remaining=1) == (True, "a")
+    assert quorum(2).decide(["a", "b"], remaining=1) == (False, None)
+    with pytest.raises(ValueError, match="quorum of 3"):
+        quorum(3).decide(["a", "b"], remaining=1)
+
+
+def test_first_valid_returns_first_parseable_choice_and_skips_the_rest() -> None:
+    replies = iter(["not a number", "42", "7", "7"])
+    lock = threading.Lock()
+
+    def ai_callable(**kwargs: Any) -> ChatCompletion:
+        assert kwargs["n"] == 1
+        with lock:
+            return make_completion([next(replies)], "fake")
+
+    mock_callable = Mock(side_effect=ai_callable)
+    cache = InMemoryCache()
+
+    @ghostfunction(
+        ai_callable=mock_callable,
+        aggregation_function=first_valid,
+        n=4,
+        cache=cache,
+    )
+    def toy_function() -> int:  # type: ignore[empty-body]
+        """Return a number."""
+        pass
+
+    assert toy_function() in (42, 7)
+    assert toy_function() in (42, 7)
+    assert mock_callable.call_count <= 4
+    assert cache.stats.hits == 1
+
+
+def test_incremental_aggregation_raises_last_error_if_nothing_parses() -> None:
+    @ghostfunction(
+        ai_callable=lambda **kwargs: make_completion(["nope"], "fake"),
+        aggregation_function=first_valid,
+        n=2,
+    )
+    def toy_function() -> int:  # type: ignore[empty-body]
+        """Return a number."""
+        pass
+
+    with pytest.raises((ValueError, SyntaxError)):
+        toy_function()
+
+
+def test_stream_strategy_closes_the_stream_once_decided() -> None:
+    closed = []
+
+    class Stream:
+        def __iter__(self) -> Iterator[ChatCompletionChunk]:
+            yield _chunk(0, "[1,")
+            yield _chunk(1, "[1, 2]", finished=True)
+            yield _chunk(0, " 2]", finished=True)
+            yield _chunk(2, "[3]", finished=True)
+            raise AssertionError("the stream should have been closed")
+
+        def close(self) -> None:
+            closed.append(True)
+
+    mock_callable = Mock(return_value=Stream())
+
+    @ghostfunction(
+        ai_callable=mock_callable,
+        aggregation_function=quorum(2, strategy="stream"),
+        n=3,
+    )
+    def toy_function() -> List[int]:  # type: ignore[empty-body]
+        """Return numbers."""
+        pass
+
+    assert toy_function() == [1, 2]
+    assert closed == [True]
+    assert mock_callable.call_args.kwargs["stream"] is True
+    assert mock_callable.call_args.kwargs["n"] == 3
+
+
+def test_async_concurrent_strategy_cancels_outstanding_requests() -> None:
+    started: List[int] = []
+    cancelled: List[int] = []
+
+    async def ai_callable(**kwargs: Any) -> ChatCompletion:
+        started.append(len(started))
+        delay = 0 if len(started) == 1 else 10
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            cancelled.append(delay)
+            raise
+        return make_completion(["'done'"], "fake")
+
+    @ghostfunction(ai_callable=ai_callable, aggregation_function=first_valid, n=3)
+    async def toy_function() -> str:  # type: ignore[empty-body]
+        """Return a word."""
+        pass
+
+    async def run() -> str:
+        result: str = await toy_function()
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(run()) == "done"
+    assert len(started) == 3
+    assert cancelled == [10, 10]
@@ -0,0 +1,136 @@
+import asyncio
+from typing import Any
+from typing import Dict
+from typing import List
+from unittest.mock import Mock
+
+import pytest
+
+from ai_ghostfunctions import ghostfunction
+from ai_ghostfunctions.backends import Backend
+from ai_ghostfunctions.backends import LocalModelBackend
+from ai_ghostfunctions.backends import OpenAICompatibleBackend
+from ai_ghostfunctions.cache import InMemoryCache
+from ai_ghostfunctions.types import Message
+
+
+class _Echo:
+    """A local model answering the length of the last message of each prompt."""
+
+    def __init__(self) -> None:
+        self.batches: List[int] = []
+        self.params: List[Dict[str, Any]] = []
+
+    def __call__(
+        self, prompts: List[List[Message]], params: Dict[str, Any]
+    ) -> List[str]:
+        self.batches.append(len(prompts))
+        self.params.append(params)
+        return [repr(len(prompt[-1]["content"])) for prompt in prompts]
+
+
+def _length(**kwargs: Any) -> Any:
+    @ghostfunction(**kwargs)
+    def length(text: str) -> int:  # type: ignore[empty-body]
+        """Return a number."""
+        pass
+
+    return length
+
+
+def test_map_sends_batches_to_a_batch_capable_backend() -> None:
+    model = _Echo()
+    length = _length(backend=LocalModelBackend(model, max_batch_size=4))
+    results = list(length.map(["a" * i for i in range(10)], max_concurrency=1))
+    assert model.batches == [4, 4, 2]
+    assert results == [length(text="a" * i) for i in range(10)]
+    assert results[3] == results[2] + 1
+
+
+def test_cached_items_are_not_sent_to_the_backend() -> None:
+    model = _Echo()
+    length = _length(backend=LocalModelBackend(model), cache=InMemoryCache())
+    first = length(text="cached")
+    assert list(length.map(["cached", "new"])) == [first, first - 3]
+    assert model.batches == [1, 1]
+
+
+def test_local_backend_groups_requests_by_parameters_and_repeats_n() -> None:
+    model = _Echo()
+    backend = LocalModelBackend(model, max_batch_size=8)
+    messages = [{"role": "user", "content": "abc"}]
+    responses = backend.complete_batch(
+        [
+            {"messages": messages, "temperature": 0.0, "n": 2},
+            {"messages": messages, "temperature": 1.0},
+            {"messages": messages, "temperature": 0.0, "model": "x"},
+        ]
+    )
+    assert model.batches == [3, 1]
+    assert model.params == [{"temperature": 0.0}, {"temperature": 1.0}]
+    assert [len(r.choices) for r in responses] == [2, 1, 1]
+    assert responses[0].usage.prompt_tokens > 0
+
+
+def test_local_backend_streams_and_answers_async_ghostfunctions() -> None:
+    backend = LocalModelBackend(lambda prompts, params: ["[1, 2, 3]"] * len(prompts))
+
+    @ghostfunction(backend=backend)
+    def numbers() -> List[int]:  # type: ignore[empty-body]
+        """Return numbers."""
+        pass
+
+    assert list(numbers.stream()) == [1, 2, 3]
+
+    @ghostfunction(backend=backend, async_=True)
+    async def anumbers() -> List[int]:  # type: ignore[empty-body]
+        """Return numbers."""
+        pass
+
+    async def amap() -> List[Any]:
+        return [result async for result in anumbers.amap([(), ()])]
+
+    assert asyncio.run(anumbers()) == [1, 2, 3]
+    assert asyncio.run(amap()) == [[1, 2, 3], [1, 2, 3]]
+
+
+def test_backend_errors_are_yielded_per_item() -> None:
+    backend = LocalModelBackend(lambda prompts, params: ["1"])
+    results = list(_length(backend=backend).map(["a", "b"]))
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_backend_answering_too_few_requests_fails_every_item() -> None:
+    class _Short(Backend):
+        supports_batch = True
+        max_batch_size = 4
+
+        def complete(self, **kwargs: Any) -> Any:
+            return LocalModelBackend(_Echo()).complete(**kwargs)
+
+        def complete_batch(self, requests: Any) -> List[Any]:
+            return super().complete_batch(requests)[:-1]
+
+    results = list(_length(backend=_Short()).map(["a", "b", "c"]))
+    assert len(results) == 3
+    assert all(isinstance(result, ValueError) for result in results)
+    assert "answered 2 of 3 requests" in str(results[0])
+
+
+def test_openai_compatible_backend_fills_in_its_model() -> None:
+    backend = OpenAICompatibleBackend("http://localhost:8000/v1", model="llama")
+    assert backend._request({"messages": []}) == {"model": "llama", "messages": []}
+    assert backend._request({"model": "x"}) == {"model": "x"}
+
+
+def test_backend_and_ai_callable_are_exclusive() -> None:
+    with pytest.raises(ValueError):
+        _length(backend=LocalModelBackend(_Echo()), ai_callable=Mock())
+
+
+def test_backend_subclass_without_complete_cannot_be_created() -> None:
+    class _Incomplete(Backend):
+        supports_batch = True
+
+    with pytest.raises(TypeError):
+        _Incomplete()  # type: ignore[abstract]
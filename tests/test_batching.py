@@ -0,0 +1,86 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Dict
+from typing import List
+
+import pytest
+
+from ai_ghostfunctions import ghostfunction
+from ai_ghostfunctions.backends import LocalModelBackend
+from ai_ghostfunctions.batching import MicroBatcher
+from ai_ghostfunctions.types import Message
+
+
+class _Model:
+    def __init__(self) -> None:
+        self.batches: List[int] = []
+
+    def __call__(
+        self, prompts: List[List[Message]], params: Dict[str, Any]
+    ) -> List[str]:
+        self.batches.append(len(prompts))
+        return [repr(len(prompt[-1]["content"])) for prompt in prompts]
+
+
+def _length(backend: Any, async_: bool = False) -> Any:
+    @ghostfunction(backend=backend, async_=async_)
+    def length(text: str) -> int:  # type: ignore[empty-body]
+        """Return a number."""
+        pass
+
+    return length
+
+
+def test_concurrent_calls_are_sent_in_one_batch() -> None:
+    model = _Model()
+    batcher = MicroBatcher(LocalModelBackend(model, max_batch_size=8), max_wait=5.0)
+    length = _length(batcher)
+    barrier = threading.Barrier(8)
+
+    def call(i: int) -> int:
+        barrier.wait()
+        result: int = length(text="a" * i)
+        return result
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(call, range(8)))
+    assert model.batches == [8]  # full before the window ended
+    assert [b - a for a, b in zip(results, results[1:])] == [1] * 7  # noqa: B905
+    stats = batcher.stats
+    assert (stats.batches, stats.requests, stats.mean_fill) == (1, 8, 1.0)
+    assert 0 <= stats.mean_delay <= stats.max_delay < 5.0
+    batcher.close()
+
+
+def test_a_lone_call_is_sent_when_the_window_ends() -> None:
+    model = _Model()
+    batcher = MicroBatcher(LocalModelBackend(model, max_batch_size=8), max_wait=0.01)
+    assert isinstance(_length(batcher)(text="abc"), int)
+    assert model.batches == [1]
+    assert batcher.stats.mean_fill == 1 / 8
+    batcher.close()
+    with pytest.raises(RuntimeError):
+        batcher.submit({"messages": []})
+
+
+def test_async_calls_share_batches() -> None:
+    model = _Model()
+    batcher = MicroBatcher(LocalModelBackend(model, max_batch_size=4), max_wait=5.0)
+    length = _length(batcher, async_=True)
+
+    async def main() -> List[int]:
+        return list(await asyncio.gather(*(length(text="x") for _ in range(4))))
+
+    assert len(set(asyncio.run(main()))) == 1
+    assert model.batches == [4]
+    batcher.close()
+
+
+def test_backend_errors_reach_every_caller_of_the_batch() -> None:
+    batcher = MicroBatcher(LocalModelBackend(lambda prompts, params: []), max_wait=0)
+    with pytest.raises(ValueError):
+        _length(batcher)(text="x")
+    assert batcher.stats.batches == 1
+    batcher.close()
@@ -0,0 +1,90 @@
+import json
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import List
+
+import pytest
+
+from ai_ghostfunctions import ghostfunction
+from ai_ghostfunctions.bulk import BulkJob
+from ai_ghostfunctions.bulk import BulkJobError
+from ai_ghostfunctions.bulk import LocalBatchClient
+from ai_ghostfunctions.testing import FakeAI
+
+
+def _last_message_length(kwargs: Dict[str, Any], index: int) -> str:
+    return repr(len(kwargs["messages"][-1]["content"]))
+
+
+@ghostfunction(ai_callable=FakeAI(_last_message_length))
+def length(text: str) -> int:  # type: ignore[empty-body]
+    """Return a number."""
+    pass
+
+
+class _Crash(Exception):
+    pass
+
+
+def _crash(seconds: float) -> None:
+    raise _Crash
+
+
+def test_bulk_job_submits_batch_files_and_yields_parsed_results(tmp_path: Path) -> None:
+    client = LocalBatchClient(FakeAI(_last_message_length), pending_polls=1)
+    polls: List[float] = []
+    job = BulkJob(length, tmp_path, client, batch_size=2, sleep=polls.append)
+    results = list(job.run(["a" * i for i in range(5)]))
+
+    assert [index for index, _ in results] == [0, 1, 2, 3, 4]
+    assert [b[1] - a[1] for a, b in zip(results, results[1:])] == [1] * 4  # noqa: B905
+    assert results[0][1] == length(text="")
+    assert client.submitted == 3
+    assert polls == [60.0] * 3
+    with open(tmp_path / "batch-000000.jsonl") as file:
+        request = json.loads(file.readline())
+    assert request["url"] == "/v1/chat/completions"
+    assert request["body"]["model"] == "gpt-3.5-turbo"
+
+
+def test_resumed_job_does_not_resubmit_batches(tmp_path: Path) -> None:
+    client = LocalBatchClient(FakeAI(_last_message_length), pending_polls=1)
+    texts = ["a", "bb", "ccc"]
+    with pytest.raises(_Crash):
+        list(BulkJob(length, tmp_path, client, batch_size=2, sleep=_crash).run(texts))
+    assert client.submitted == 2
+
+    resumed = BulkJob(length, tmp_path, client, batch_size=2, sleep=lambda s: None)
+    first = list(resumed.run(texts))
+    assert client.submitted == 2
+    assert list(BulkJob(length, tmp_path, client, batch_size=2).run(texts)) == first
+
+
+def test_failed_requests_and_unparsable_responses_are_yielded_as_errors(
+    tmp_path: Path,
+) -> None:
+    def respond(**kwargs: Any) -> Any:
+        if "'boom'" in kwargs["messages"][-1]["content"]:
+            raise RuntimeError("boom")
+        return FakeAI("'not a number'")(**kwargs)
+
+    job = BulkJob(length, tmp_path, LocalBatchClient(respond))
+    results = dict(job.run(["boom", "fine"]))
+    assert isinstance(results[0], BulkJobError)
+    assert isinstance(results[1], Exception)
+
+
+class _FailingOnce(LocalBatchClient):
+    def status(self, batch_id: str) -> str:
+        return "failed" if batch_id == "local-batch-0" else "completed"
+
+
+def test_failed_batches_raise_and_are_resubmitted(tmp_path: Path) -> None:
+    client = _FailingOnce(FakeAI(_last_message_length))
+    with pytest.raises(BulkJobError):
+        list(BulkJob(length, tmp_path, client).run(["a"]))
+    assert [r for _, r in BulkJob(length, tmp_path, client).run(["a"])] == [
+        length(text="a")
+    ]
+    assert client.submitted == 2
@@ -0,0 +1,177 @@
+import multiprocessing
+import threading
+from pathlib import Path
+from typing import List
+from typing import Optional
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import pytest
+from openai.types.chat.chat_completion import ChatCompletion
+
+from ai_ghostfunctions import ghostfunction
+from ai_ghostfunctions.cache import BaseCache
+from ai_ghostfunctions.cache import CacheStats
+from ai_ghostfunctions.cache import InMemoryCache
+from ai_ghostfunctions.cache import KeyedCache
+from ai_ghostfunctions.cache import SQLiteCache
+from ai_ghostfunctions.cache import TieredCache
+from ai_ghostfunctions.cache import make_cache_key
+from ai_ghostfunctions.types import Message
+
+
+MESSAGES = [Message(role="user", content="result = f(x=1)")]
+
+
+def test_make_cache_key_depends_on_messages_and_params() -> None:
+    key = make_cache_key(MESSAGES, {"temperature": 0})
+    assert key == make_cache_key(list(MESSAGES), {"temperature": 0})
+    assert key != make_cache_key(MESSAGES, {"temperature": 1})
+    assert key != make_cache_key([Message(role="user", content="other")], {})
+
+
+def test_in_memory_cache_hits_and_misses() -> None:
+    cache = InMemoryCache()
+    assert cache.get(MESSAGES, {}) is None
+    cache.set(MESSAGES, {}, ["'a'"])
+    assert cache.get(MESSAGES, {}) == ["'a'"]
+    assert cache.stats == CacheStats(hits=1, misses=1, evictions=0)
+
+
+def test_in_memory_cache_evicts_least_recently_used() -> None:
+    cache = InMemoryCache(maxsize=2)
+    cache.set(MESSAGES, {"n": 1}, ["1"])
+    cache.set(MESSAGES, {"n": 2}, ["2"])
+    cache.get(MESSAGES, {"n": 1})
+    cache.set(MESSAGES, {"n": 3}, ["3"])
+    assert cache.get(MESSAGES, {"n": 2}) is None
+    assert cache.get(MESSAGES, {"n": 1}) == ["1"]
+    assert len(cache) == 2
+    assert cache.stats.evictions == 1
+
+
+def test_in_memory_cache_expires_entries() -> None:
+    cache = InMemoryCache(ttl=10)
+    with patch("ai_ghostfunctions.cache.time.monotonic", return_value=100.0):
+        cache.set(MESSAGES, {}, ["1"])
+    with patch("ai_ghostfunctions.cache.time.monotonic", return_value=105.0):
+        assert cache.get(MESSAGES, {}) == ["1"]
+    with patch("ai_ghostfunctions.cache.time.monotonic", return_value=111.0):
+        assert cache.get(MESSAGES, {}) is None
+    assert cache.stats.evictions == 1
+
+
+def test_sqlite_cache_roundtrip_and_persistence(tmp_path: Path) -> None:
+    path = tmp_path / "cache.sqlite"
+    cache = SQLiteCache(path)
+    cache.set(MESSAGES, {}, ["'a'", "'b'"])
+    assert SQLiteCache(path).get(MESSAGES, {}) == ["'a'", "'b'"]
+    assert len(cache) == 1
+    cache.clear()
+    assert cache.get(MESSAGES, {}) is None
+
+
+def test_sqlite_cache_maxsize_and_ttl(tmp_path: Path) -> None:
+    cache = SQLiteCache(tmp_path / "cache.sqlite", maxsize=1)
+    cache.set(MESSAGES, {"n": 1}, ["1"])
+    cache.set(MESSAGES, {"n": 2}, ["2"])
+    assert len(cache) == 1
+    assert cache.stats.evictions == 1
+
+    cache = SQLiteCache(tmp_path / "ttl.sqlite", ttl=10)
+    with patch("ai_ghostfunctions.cache.time.time", return_value=100.0):
+        cache.set(MESSAGES, {}, ["1"])
+    with patch("ai_ghostfunctions.cache.time.time", return_value=111.0):
+        assert cache.get(MESSAGES, {}) is None
+
+
+def test_tiered_cache_fills_earlier_tiers() -> None:
+    exact, fallback = InMemoryCache(), InMemoryCache()
+    cache = TieredCache(exact, fallback)
+    fallback.set(MESSAGES, {}, ["'a'"])
+    assert cache.get(MESSAGES, {}) == ["'a'"]
+    assert exact.get(MESSAGES, {}) == ["'a'"]
+    cache.set(MESSAGES, {"n": 2}, ["'b'"])
+    assert len(exact) == len(fallback) == 2
+    assert cache.get([Message(role="user", content="other")], {}) is None
+    assert cache.stats == CacheStats(hits=1, misses=1, evictions=0)
+
+
+def _write_from_child(path: str) -> None:
+    SQLiteCache(path).set(MESSAGES, {"child": True}, ["'child'"])
+
+
+def test_cache_subclasses_missing_their_storage_cannot_be_created() -> None:
+    class _Forgetful(KeyedCache):
+        def _get(self, key: str) -> Optional[List[str]]:
+            return None
+
+    with pytest.raises(TypeError):
+        _Forgetful()  # type: ignore[abstract]
+    with pytest.raises(TypeError):
+        BaseCache()  # type: ignore[abstract]
+
+
+def test_sqlite_cache_is_shared_across_threads_and_processes(tmp_path: Path) -> None:
+    path = str(tmp_path / "cache.sqlite")
+    cache = SQLiteCache(path)
+
+    threads = [
+        threading.Thread(target=cache.set, args=(MESSAGES, {"i": i}, [str(i)]))
+        for i in range(8)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(cache) == 8
+
+    process = multiprocessing.get_context("spawn").Process(
+        target=_write_from_child, args=(path,)
+    )
+    process.start()
+    process.join()
+    assert cache.get(MESSAGES, {"child": True}) == ["'child'"]
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_ghostfunction_uses_cache(backend: str, tmp_path: Path) -> None:
+    cache: BaseCache = (
+        InMemoryCache() if backend == "memory" else SQLiteCache(tmp_path / "c.sqlite")
+    )
+    mock_callable = Mock(
+        return_value=ChatCompletion.model_construct(  # type: ignore[attr-defined]
+            **{"choices": [{"message": {"content": "['goose']"}}]}
+        )
+    )
+
+    @ghostfunction(ai_callable=mock_callable, cache=cache, temperature=0)
+    def generate_n_random_words(n: int, startswith: str) -> List[str]:  # type: ignore[empty-body]
+        """Return a list of `n` random words that start with `startswith`."""
+        pass
+
+    assert generate_n_random_words(1, "goo") == ["goose"]
+    assert generate_n_random_words(n=1, startswith="goo") == ["goose"]
+    mock_callable.assert_called_once()
+    assert cache.stats == CacheStats(hits=1, misses=1, evictions=0)
+
+    generate_n_random_words(2, "goo")
+    assert mock_callable.call_count == 2
+
+
+def test_ghostfunction_does_not_cache_unparsable_responses() -> None:
+    cache = InMemoryCache()
+    mock_callable = Mock(
+        return_value=ChatCompletion.model_construct(  # type: ignore[attr-defined]
+            **{"choices": [{"message": {"content": "not a list"}}]}
+        )
+    )
+
+    @ghostfunction(ai_callable=mock_callable, cache=cache)
+    def f(x: int) -> List[int]:  # type: ignore[empty-body]
+        """Return a list."""
+        pass
+
+    with pytest.raises(SyntaxError):
+        f(1)
+    assert len(cache) == 0
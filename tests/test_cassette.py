@@ -0,0 +1,117 @@
+import asyncio
+import os
+import threading
+from pathlib import Path
+from typing import Callable
+from typing import List
+
+import pytest
+from openai.types.chat.chat_completion import ChatCompletion
+
+from ai_ghostfunctions import ghostfunction
+from ai_ghostfunctions.cassette import Cassette
+from ai_ghostfunctions.cassette import CassetteMiss
+from ai_ghostfunctions.testing import FakeAI
+from ai_ghostfunctions.testing import cycle_response
+
+
+def _numbers(ai_callable: Callable[..., ChatCompletion]) -> object:
+    @ghostfunction(ai_callable=ai_callable)
+    def numbers(count: int) -> List[int]:  # type: ignore[empty-body]
+        """Return `count` numbers."""
+        pass
+
+    return numbers
+
+
+def test_cassette_records_then_replays_offline(tmp_path: Path) -> None:
+    path = tmp_path / "cassettes" / "numbers"
+    fake = FakeAI("[1, 2]")
+    numbers = _numbers(Cassette(path, mode="record_new", ai_callable=fake))
+    assert numbers(count=2) == [1, 2]  # type: ignore[operator]
+    assert numbers(count=2) == [1, 2]  # type: ignore[operator]
+    assert fake.calls == 1
+
+    strict = Cassette(path)
+    assert len(strict) == 1
+    assert _numbers(strict)(count=2) == [1, 2]  # type: ignore[operator]
+    assert strict.hits == 1
+    with pytest.raises(CassetteMiss):
+        _numbers(strict)(count=3)  # type: ignore[operator]
+
+
+def test_cassette_refresh_records_again_and_last_recording_wins(tmp_path: Path) -> None:
+    path = tmp_path / "numbers"
+    fake = FakeAI(cycle_response("[1]", "[2]"))
+    Cassette(path, mode="record_new", ai_callable=fake)(messages=[])
+    refresh = Cassette(path, mode="refresh", ai_callable=fake)
+    assert refresh(messages=[]).choices[0].message.content == "[2]"
+    assert fake.calls == 2
+
+    replay = Cassette(path)
+    assert len(replay) == 1
+    assert replay(messages=[]).choices[0].message.content == "[2]"
+
+
+def test_cassette_streams_and_rebuilds_a_deleted_index(tmp_path: Path) -> None:
+    path = tmp_path / "stream"
+    recorder = Cassette(
+        path, mode="record_new", ai_callable=FakeAI("abcdef", chunk_size=4)
+    )
+    chunks = list(recorder(messages=[], stream=True))
+    assert [c.choices[0].delta.content for c in chunks] == ["abcd", "ef"]
+
+    os.remove(f"{path}.idx")
+    replay = Cassette(path)
+    assert {"messages": [], "stream": True} in replay
+    chunks = list(replay(messages=[], stream=True))
+    assert [c.choices[0].delta.content for c in chunks] == ["abcd", "ef"]
+
+
+def test_cassette_acall_records_async_responses(tmp_path: Path) -> None:
+    path = tmp_path / "async"
+    fake = FakeAI("[3]")
+
+    @ghostfunction(ai_callable=Cassette(path, "record_new", fake.acall).acall)
+    async def numbers() -> List[int]:  # type: ignore[empty-body]
+        """Return numbers."""
+        pass
+
+    assert asyncio.run(numbers()) == [3]
+    assert asyncio.run(numbers()) == [3]
+    assert fake.calls == 1
+
+
+def test_cassettes_recording_into_one_file_keep_every_record(tmp_path: Path) -> None:
+    pytest.importorskip("fcntl")
+    path = tmp_path / "shared"
+    fake = FakeAI(lambda kwargs, index: repr(kwargs["messages"][0]["content"]))
+    # separate cassettes open the files separately, like separate processes
+    cassettes = [Cassette(path, mode="record_new", ai_callable=fake) for _ in range(4)]
+
+    def record(cassette: Cassette, start: int) -> None:
+        for i in range(start, start + 25):
+            cassette(messages=[{"role": "user", "content": str(i)}])
+
+    threads = [
+        threading.Thread(target=record, args=(cassette, 25 * n))
+        for n, cassette in enumerate(cassettes)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for rebuild in (False, True):
+        if rebuild:
+            os.remove(f"{path}.idx")
+        strict = Cassette(path)
+        assert len(strict) == 100
+        for i in range(100):
+            completion = strict(messages=[{"role": "user", "content": str(i)}])
+            assert completion.choices[0].message.content == repr(str(i))
+
+
+def test_cassette_rejects_unknown_mode(tmp_path: Path) -> None:
+    with pytest.raises(ValueError):
+        Cassette(tmp_path / "x", mode="replay")
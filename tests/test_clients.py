@@ -0,0 +1,53 @@
+import asyncio
+import os
+from typing import Iterator
+from unittest.mock import patch
+
+import pytest
+
+from ai_ghostfunctions import clients
+
+
+@pytest.fixture(autouse=True)
+def default_config() -> Iterator[None]:
+    config = clients.get_client_config()
+    yield
+    clients.configure_clients(**config.__dict__)
+
+
+def test_get_client_is_shared() -> None:
+    assert clients.get_client("key-a") is clients.get_client("key-a")
+    assert clients.get_client("key-a") is not clients.get_client("key-b")
+
+
+def test_get_client_defaults_to_env_api_key() -> None:
+    with patch.dict(os.environ, {"OPENAI_API_KEY": "env-key"}):
+        assert clients.get_client().api_key == "env-key"
+        assert clients.get_client() is clients.get_client("env-key")
+
+
+def test_configure_clients_applies_to_new_clients() -> None:
+    old = clients.get_client("key")
+    config = clients.configure_clients(max_connections=3, timeout=7.0, max_retries=0)
+    assert config.max_connections == 3
+    new = clients.get_client("key")
+    assert new is not old
+    assert new.max_retries == 0
+    assert new.timeout.read == 7.0  # type: ignore[union-attr]
+
+
+def test_clients_are_recreated_after_fork() -> None:
+    before = clients.get_client("key")
+    with patch("os.getpid", return_value=-1):
+        after = clients.get_client("key")
+    assert after is not before
+
+
+def test_get_async_client_is_shared_per_event_loop() -> None:
+    async def get() -> object:
+        first = clients.get_async_client("key")
+        assert first is clients.get_async_client("key")
+        return first
+
+    assert asyncio.run(get()) is not asyncio.run(get())
+    assert clients.get_async_client("key") is clients.get_async_client("key")
@@ -1,4 +1,9 @@
+import asyncio
 import inspect
+import re
+import sys
+import threading
+import time
 from typing import Any
 from typing import Dict
 from typing import List
@@ -8,6 +13,7 @@ from unittest.mock import patch
 import pytest
 from openai.types.chat.chat_completion import ChatCompletion
 
+import ai_ghostfunctions.clients
 import ai_ghostfunctions.ghostfunctions
 from ai_ghostfunctions import ghostfunction
 from ai_ghostfunctions.types import Message
@@ -19,7 +25,7 @@ def test_aicallable_function_decorator_has_same_signature() -> None:
         pass
 
     with patch.dict(
-        ai_ghostfunctions.ghostfunctions.os.environ, {"OPENAI_API_KEY": "api-key-mock"}  # type: ignore[attr-defined]
+        ai_ghostfunctions.clients.os.environ, {"OPENAI_API_KEY": "api-key-mock"}  # type: ignore[attr-defined]
     ):
         decorated_function = ghostfunction(generate_n_random_words)
         assert inspect.signature(decorated_function) == inspect.signature(
@@ -369,3 +375,333 @@ def test___parse_ai_result_non_default_agg_function() -> None:
         )
         == "c1,c2,c3"
     )
+
+
+def test_async_ghostfunction_with_async_ai_callable() -> None:
+    completion = ChatCompletion.model_construct(  # type: ignore[attr-defined]
+        **{"choices": [{"message": {"content": "['goose']"}}]}
+    )
+    calls = []
+
+    async def ai_callable(**kwargs: Any) -> ChatCompletion:
+        calls.append(kwargs)
+        await asyncio.sleep(0)
+        return completion  # type: ignore[no-any-return]
+
+    @ghostfunction(ai_callable=ai_callable, temperature=0)
+    async def generate_n_random_words(n: int, startswith: str) -> List[str]:  # type: ignore[empty-body]
+        """Return a list of `n` random words that start with `startswith`."""
+        pass
+
+    assert inspect.iscoroutinefunction(generate_n_random_words.__call__)
+    assert inspect.signature(generate_n_random_words) == inspect.signature(
+        generate_n_random_words.__wrapped__  # type: ignore[attr-defined]
+    )
+
+    async def main() -> List[Any]:
+        return await asyncio.gather(
+            *(generate_n_random_words(n=i, startswith="goo") for i in range(10))
+        )
+
+    assert asyncio.run(main()) == [["goose"]] * 10
+    assert len(calls) == 10
+    assert calls[0]["temperature"] == 0
+
+
+def test_async_option_on_sync_function_uses_default_async_callable() -> None:
+    async def ai_callable(**kwargs: Any) -> ChatCompletion:
+        return ChatCompletion.model_construct(  # type: ignore[attr-defined,no-any-return]
+            **{"choices": [{"message": {"content": "'goose'"}}]}
+        )
+
+    with patch.object(
+        ai_ghostfunctions.ghostfunctions,
+        "_default_async_ai_callable",
+        return_value=ai_callable,
+    ) as patched:
+
+        @ghostfunction(async_=True)
+        def generate_word(startswith: str) -> str:  # type: ignore[empty-body]
+            """Return a word that starts with `startswith`."""
+            pass
+
+        patched.assert_not_called()
+        assert inspect.iscoroutinefunction(generate_word.__call__)
+        assert asyncio.run(generate_word("goo")) == "goose"
+        assert asyncio.run(generate_word("goo")) == "goose"
+
+    patched.assert_called_once()
+
+
+def test_async_ghostfunction_is_detected_as_coroutine_function() -> None:
+    @ghostfunction(ai_callable=Mock())
+    async def generate_word(startswith: str) -> str:  # type: ignore[empty-body]
+        """Return a word that starts with `startswith`."""
+        pass
+
+    if sys.version_info >= (3, 12):
+        assert inspect.iscoroutinefunction(generate_word)
+    else:
+        assert asyncio.iscoroutinefunction(generate_word)
+
+
+def test_ghostfunction_decorating_a_method_binds_self() -> None:
+    completion = ChatCompletion.model_construct(  # type: ignore[attr-defined]
+        **{"choices": [{"message": {"content": "'goose'"}}]}
+    )
+    mock_callable = Mock(return_value=completion)
+
+    async def async_callable(**kwargs: Any) -> ChatCompletion:
+        return completion  # type: ignore[no-any-return]
+
+    class Words:
+        def __repr__(self) -> str:
+            return "Words()"
+
+        @ghostfunction(ai_callable=mock_callable)
+        def word(self, startswith: str) -> str:  # type: ignore[empty-body]
+            """Return a word that starts with `startswith`."""
+            pass
+
+        @ghostfunction(ai_callable=async_callable)
+        async def aword(self, startswith: str) -> str:  # type: ignore[empty-body]
+            """Return a word that starts with `startswith`."""
+            pass
+
+    words = Words()
+    assert words.word("goo") == "goose"
+    assert "Words()" in mock_callable.call_args.kwargs["messages"][-1]["content"]
+    assert asyncio.run(words.aword(startswith="goo")) == "goose"
+    assert Words.word is Words.__dict__["word"]
+    if sys.version_info >= (3, 12):
+        assert inspect.iscoroutinefunction(words.aword)
+    else:
+        assert asyncio.iscoroutinefunction(words.aword)
+
+
+def test_async_ghostfunction_accepts_sync_ai_callable() -> None:
+    mock_callable = Mock(
+        return_value=ChatCompletion.model_construct(  # type: ignore[attr-defined]
+            **{"choices": [{"message": {"content": "'goose'"}}]}
+        )
+    )
+
+    @ghostfunction(ai_callable=mock_callable)
+    async def generate_word(startswith: str) -> str:  # type: ignore[empty-body]
+        """Return a word that starts with `startswith`."""
+        pass
+
+    assert asyncio.run(generate_word("goo")) == "goose"
+
+
+def test_sync_ghostfunction_rejects_async_ai_callable() -> None:
+    async def ai_callable(**kwargs: Any) -> ChatCompletion:
+        raise AssertionError("never awaited")
+
+    @ghostfunction(ai_callable=ai_callable)
+    def generate_word(startswith: str) -> str:  # type: ignore[empty-body]
+        """Return a word that starts with `startswith`."""
+        pass
+
+    with pytest.raises(TypeError):
+        generate_word("goo")
+
+
+def _echo_completion(**kwargs: Any) -> ChatCompletion:
+    """Answer with the `x` argument rendered in the prompt, failing on 'boom'."""
+    content = kwargs["messages"][-1]["content"]
+    x = content.split("x=")[1].split(")")[0]
+    if x == "'boom'":
+        raise RuntimeError("boom")
+    time.sleep(0.01 if x == "0" else 0)
+    return ChatCompletion.model_construct(  # type: ignore[attr-defined,no-any-return]
+        **{"choices": [{"message": {"content": x}}]}
+    )
+
+
+def test_ghostfunction_map_preserves_order_and_collects_exceptions() -> None:
+    @ghostfunction(ai_callable=_echo_completion)
+    def echo(x: Any) -> Any:  # type: ignore[empty-body]
+        """Return x."""
+        pass
+
+    results = list(echo.map([0, (1,), {"x": 2}, "boom", 4], max_concurrency=2))
+    assert results[:3] == [0, 1, 2]
+    assert isinstance(results[3], RuntimeError)
+    assert results[4] == 4
+
+
+def test_ghostfunction_map_unordered_yields_as_completed() -> None:
+    @ghostfunction(ai_callable=_echo_completion)
+    def echo(x: int) -> int:  # type: ignore[empty-body]
+        """Return x."""
+        pass
+
+    results = list(echo.map(range(4), max_concurrency=4, ordered=False))
+    assert sorted(results) == [0, 1, 2, 3]
+    assert results[-1] == 0
+
+    with pytest.raises(ValueError):
+        list(echo.map(range(4), max_concurrency=0))
+
+
+def test_ghostfunction_map_bounds_concurrency() -> None:
+    lock = threading.Lock()
+    active = []
+    peak = []
+
+    def ai_callable(**kwargs: Any) -> ChatCompletion:
+        with lock:
+            active.append(1)
+            peak.append(len(active))
+        time.sleep(0.005)
+        with lock:
+            active.pop()
+        return ChatCompletion.model_construct(  # type: ignore[attr-defined,no-any-return]
+            **{"choices": [{"message": {"content": "1"}}]}
+        )
+
+    @ghostfunction(ai_callable=ai_callable)
+    def one(x: int) -> int:  # type: ignore[empty-body]
+        """Return 1."""
+        pass
+
+    assert list(one.map(range(20), max_concurrency=3)) == [1] * 20
+    assert max(peak) <= 3
+
+
+def test_async_ghostfunction_amap() -> None:
+    async def ai_callable(**kwargs: Any) -> ChatCompletion:
+        completion = _echo_completion(**kwargs)
+        await asyncio.sleep(0)
+        return completion
+
+    @ghostfunction(ai_callable=ai_callable)
+    async def echo(x: Any) -> Any:  # type: ignore[empty-body]
+        """Return x."""
+        pass
+
+    async def collect(ordered: bool) -> List[Any]:
+        return [
+            result
+            async for result in echo.amap(
+                [0, (1,), {"x": 2}, "boom", 4], max_concurrency=2, ordered=ordered
+            )
+        ]
+
+    results = asyncio.run(collect(ordered=True))
+    assert results[:3] == [0, 1, 2]
+    assert isinstance(results[3], RuntimeError)
+    assert results[4] == 4
+
+    results = asyncio.run(collect(ordered=False))
+    assert sorted(r for r in results if isinstance(r, int)) == [0, 1, 2, 4]
+
+
+def test__make_packed_chatgpt_message_from_function() -> None:
+    msg = ai_ghostfunctions.ghostfunctions._make_packed_chatgpt_message_from_function(
+        toy_function, [(("a",), {}), ((), {"x": "b"})]
+    )
+    assert msg["content"].endswith(
+        "#     \n"
+        "result_0 = toy_function(x='a')\n"
+        "result_1 = toy_function(x='b')\n"
+        "print([result_0, result_1])\n"
+    )
+
+
+def _completion(*contents: str) -> ChatCompletion:
+    return ChatCompletion.model_construct(  # type: ignore[attr-defined,no-any-return]
+        **{"choices": [{"message": {"content": c}} for c in contents]}
+    )
+
+
+def test_ghostfunction_map_packs_calls_and_reissues_failed_items() -> None:
+    mock_callable = Mock(
+        side_effect=[
+            _completion("[0, 'one', 2]", "[0, 'uno', 2]"),
+            _completion("not a list"),
+            _completion("[1]"),
+            _completion("[3, 4]"),
+        ]
+    )
+
+    @ghostfunction(ai_callable=mock_callable, n=2)
+    def echo(x: int) -> int:  # type: ignore[empty-body]
+        """Return x."""
+        pass
+
+    results = list(echo.map(range(5), pack_size=3, max_concurrency=1))
+    assert results == [0, 1, 2, 3, 4]
+    assert mock_callable.call_count == 4
+    # the retry only contains the items that failed to parse
+    retry_content = mock_callable.call_args_list[1].kwargs["messages"][-1]["content"]
+    assert retry_content.endswith("result_0 = echo(x=1)\nprint([result_0])\n")
+    assert mock_callable.call_args_list[2].kwargs["n"] == 2
+
+
+def test_ghostfunction_map_packed_gives_up_after_max_retries() -> None:
+    mock_callable = Mock(return_value=_completion("['a', 'b']"))
+
+    @ghostfunction(ai_callable=mock_callable)
+    def double(x: int) -> int:  # type: ignore[empty-body]
+        """Return 2 * x."""
+        pass
+
+    results = list(double.map([1, 2], pack_size=2, max_retries=1))
+    assert all(isinstance(r, Exception) for r in results)
+    assert mock_callable.call_count == 2
+
+
+def test_ghostfunction_map_packed_fails_items_of_empty_or_misshapen_answers() -> None:
+    mock_callable = Mock(side_effect=[_completion(), _completion("[1, 2, 3]")])
+
+    @ghostfunction(ai_callable=mock_callable)
+    def double(x: int) -> int:  # type: ignore[empty-body]
+        """Return 2 * x."""
+        pass
+
+    results = list(double.map([1, 2], pack_size=2, max_retries=0))
+    assert [type(r) for r in results] == [ValueError, ValueError]
+    assert "no choices" in str(results[0])
+    results = list(double.map([1, 2], pack_size=2, max_retries=0))
+    assert [type(r) for r in results] == [ValueError, ValueError]
+    assert "Expected a list of 2 results" in str(results[0])
+
+
+def test_async_ghostfunction_amap_packed() -> None:
+    async def ai_callable(**kwargs: Any) -> ChatCompletion:
+        content = kwargs["messages"][-1]["content"]
+        return _completion(str([int(x) for x in re.findall(r"x=(\d+)", content)]))
+
+    @ghostfunction(ai_callable=ai_callable)
+    async def echo(x: int) -> int:  # type: ignore[empty-body]
+        """Return x."""
+        pass
+
+    async def collect() -> List[Any]:
+        return [r async for r in echo.amap(range(7), pack_size=3)]
+
+    assert asyncio.run(collect()) == list(range(7))
+
+
+def test_default_ai_callable_is_resolved_on_first_call() -> None:
+    mock_callable = Mock(return_value=_completion("'goose'"))
+    with patch.object(
+        ai_ghostfunctions.ghostfunctions,
+        "_default_ai_callable",
+        return_value=mock_callable,
+    ) as patched:
+        functions = []
+        for _ in range(50):
+
+            @ghostfunction
+            def generate_word(startswith: str) -> str:  # type: ignore[empty-body]
+                """Return a word that starts with `startswith`."""
+                pass
+
+            functions.append(generate_word)
+
+        patched.assert_not_called()
+        assert functions[0]("goo") == functions[0]("goo") == "goose"
+        patched.assert_called_once()
@@ -0,0 +1,123 @@
+import asyncio
+import itertools
+import threading
+import time
+from typing import Any
+from typing import List
+
+import pytest
+from openai.types.chat.chat_completion import ChatCompletion
+
+from ai_ghostfunctions import ghostfunction
+from ai_ghostfunctions.backends import make_completion
+from ai_ghostfunctions.hedging import HedgingPolicy
+from ai_ghostfunctions.hedging import HedgingStats
+
+
+def _replies(*replies: Any) -> Any:
+    """Return an ai_callable answering `(delay, content)` pairs in call order."""
+    counter = itertools.count()
+    lock = threading.Lock()
+
+    def ai_callable(**kwargs: Any) -> ChatCompletion:
+        with lock:
+            delay, content = replies[next(counter)]
+        time.sleep(delay)
+        return make_completion([content], "fake", {"total_tokens": 10})
+
+    return ai_callable
+
+
+def test_policy_learns_delay_from_latencies() -> None:
+    assert HedgingPolicy(delay=0.5).delay() == 0.5
+    policy = HedgingPolicy(percentile=90, min_samples=10)
+    for latency in range(1, 10):
+        policy.record_latency(latency)
+    assert policy.delay() is None
+    policy.record_latency(10)
+    assert policy.delay() == 9
+    with pytest.raises(ValueError):
+        HedgingPolicy(percentile=101)
+
+
+def test_hedge_wins_over_slow_request_and_counts_extra_tokens() -> None:
+    policy = HedgingPolicy(delay=0.05)
+
+    @ghostfunction(ai_callable=_replies((0.3, "'slow'"), (0, "'fast'")), hedging=policy)
+    def toy_function() -> str:  # type: ignore[empty-body]
+        """Return a word."""
+        pass
+
+    start = time.monotonic()
+    assert toy_function() == "fast"
+    assert time.monotonic() - start < 0.25
+    time.sleep(0.4)  # the slow request finishes in the background
+    assert policy.stats == HedgingStats(
+        requests=1, hedges_fired=1, hedges_won=1, extra_tokens=10
+    )
+
+
+def test_invalid_response_triggers_hedge_immediately() -> None:
+    policy = HedgingPolicy(delay=10)
+
+    @ghostfunction(ai_callable=_replies((0, "not a number"), (0, "3")), hedging=policy)
+    def toy_function() -> int:  # type: ignore[empty-body]
+        """Return a number."""
+        pass
+
+    assert toy_function() == 3
+    assert policy.stats.hedges_fired == 1
+
+
+def test_fast_requests_are_not_hedged() -> None:
+    policy = HedgingPolicy(delay=1)
+    replies: List[Any] = [(0, "'a'")] * 5
+
+    @ghostfunction(ai_callable=_replies(*replies), hedging=policy)
+    def toy_function() -> str:  # type: ignore[empty-body]
+        """Return a word."""
+        pass
+
+    assert [toy_function() for _ in range(5)] == ["a"] * 5
+    assert policy.stats == HedgingStats(requests=5)
+
+
+def test_hedging_gives_up_after_max_hedges() -> None:
+    policy = HedgingPolicy(delay=10, max_hedges=1)
+
+    @ghostfunction(ai_callable=_replies((0, "x"), (0, "y"), (0, "3")), hedging=policy)
+    def toy_function() -> int:  # type: ignore[empty-body]
+        """Return a number."""
+        pass
+
+    with pytest.raises((ValueError, SyntaxError)):
+        toy_function()
+
+
+def test_async_hedge_cancels_the_slow_request() -> None:
+    policy = HedgingPolicy(delay=0.05)
+    cancelled = []
+    calls = itertools.count()
+
+    async def ai_callable(**kwargs: Any) -> ChatCompletion:
+        if next(calls) == 0:
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+        return make_completion(["'fast'"], "fake", {"total_tokens": 10})
+
+    @ghostfunction(ai_callable=ai_callable, hedging=policy)
+    async def toy_function() -> str:  # type: ignore[empty-body]
+        """Return a word."""
+        pass
+
+    async def run() -> str:
+        result: str = await toy_function()
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(run()) == "fast"
+    assert cancelled == [True]
+    assert policy.stats.hedges_won == 1
@@ -1,8 +1,24 @@
 """Simple test that the package can be imported."""
 
+import subprocess  # nosec
+import sys
+
 import ai_ghostfunctions
 
 
 def test_import_succeeds() -> None:
     """Assert the import succeded."""
     assert ai_ghostfunctions
+
+
+def test_import_does_not_load_heavy_dependencies() -> None:
+    """Assert openai, httpx, typeguard, asyncio and numpy are imported on first use."""
+    code = (
+        "import sys, ai_ghostfunctions;"
+        "print(','.join(m for m in ('openai', 'httpx', 'typeguard', 'asyncio', 'numpy')"
+        " if m in sys.modules))"
+    )
+    loaded = subprocess.run(  # nosec
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout.strip()
+    assert loaded == ""
@@ -0,0 +1,169 @@
+import asyncio
+import importlib.util
+from typing import Any
+from typing import Iterator
+from typing import List
+from unittest.mock import Mock
+
+import pytest
+
+from ai_ghostfunctions import ghostfunction
+from ai_ghostfunctions import instrumentation
+from ai_ghostfunctions import ratelimit
+from ai_ghostfunctions.backends import make_completion
+from ai_ghostfunctions.cache import InMemoryCache
+from ai_ghostfunctions.instrumentation import CallEvent
+from ai_ghostfunctions.instrumentation import Hook
+from ai_ghostfunctions.instrumentation import MetricsCollector
+from ai_ghostfunctions.instrumentation import OpenTelemetryHook
+
+
+@pytest.fixture(autouse=True)
+def no_hooks() -> Iterator[None]:
+    yield
+    for hook in instrumentation.get_hooks():
+        instrumentation.remove_hook(hook)
+    ratelimit.configure_rate_limits()
+
+
+USAGE = {"prompt_tokens": 30, "completion_tokens": 5}
+
+
+class Recorder(Hook):
+    """Record the name of every hook event."""
+
+    def __init__(self) -> None:
+        """Create an empty recorder."""
+        self.events: List[str] = []
+        self.last: Any = None
+
+    def before_prompt(self, event: CallEvent) -> None:
+        """Record the event."""
+        self.events.append("before_prompt")
+
+    def after_request(self, event: CallEvent) -> None:
+        """Record the event."""
+        self.events.append("after_request")
+
+    def after_parse(self, event: CallEvent) -> None:
+        """Record the event."""
+        self.events.append("after_parse")
+        self.last = event
+
+    def on_error(self, event: CallEvent) -> None:
+        """Record the event."""
+        self.events.append("on_error")
+        self.last = event
+
+
+def test_hooks_see_every_phase_of_a_call() -> None:
+    recorder = instrumentation.add_hook(Recorder())
+
+    @ghostfunction(
+        ai_callable=Mock(return_value=make_completion(["[1, 2]"], "fake", USAGE))
+    )
+    def toy_function(x: int) -> List[int]:  # type: ignore[empty-body]
+        """Return numbers."""
+        pass
+
+    assert toy_function(1) == [1, 2]
+    assert recorder.events == ["before_prompt", "after_request", "after_parse"]
+    event = recorder.last
+    assert event.function.endswith("toy_function")
+    assert event.result == [1, 2]
+    assert event.prompt[-1]["content"].endswith("print(result)\n")
+    assert (event.prompt_tokens, event.completion_tokens) == (30, 5)
+    assert set(event.timings) == {
+        "prompt",
+        "request",
+        "decode",
+        "validate",
+        "aggregate",
+    }
+    assert event.duration >= sum(event.timings.values())
+
+
+def test_hooks_see_errors() -> None:
+    recorder = instrumentation.add_hook(Recorder())
+
+    @ghostfunction(
+        ai_callable=Mock(return_value=make_completion(["'a'"], "fake", USAGE))
+    )
+    async def toy_function() -> int:  # type: ignore[empty-body]
+        """Return a number."""
+        pass
+
+    with pytest.raises(Exception):  # noqa: B017
+        asyncio.run(toy_function())
+    assert recorder.events == ["before_prompt", "after_request", "on_error"]
+    assert recorder.last.parse_failures == 1
+    assert recorder.last.error is not None
+
+
+def test_metrics_collector_counts_and_exports_prometheus_text() -> None:
+    collector = instrumentation.add_hook(MetricsCollector())
+    ratelimit.configure_rate_limits(backoff=0)
+    error = Exception("overloaded")
+    error.status_code = 503  # type: ignore[attr-defined]
+    mock_callable = Mock(
+        side_effect=[
+            error,
+            make_completion(["3"], "fake", USAGE),
+            make_completion(["x"], "fake", USAGE),
+        ]
+    )
+
+    @ghostfunction(ai_callable=mock_callable, cache=InMemoryCache())
+    def toy_function(x: int) -> int:  # type: ignore[empty-body]
+        """Return a number."""
+        pass
+
+    assert toy_function(1) == 3
+    assert toy_function(1) == 3
+    with pytest.raises(Exception):  # noqa: B017
+        toy_function(2)
+
+    (name,) = collector.metrics()
+    metrics = collector.metrics()[name]
+    assert metrics.calls == 3
+    assert metrics.errors == 1
+    assert metrics.cache_hits == 1
+    assert metrics.requests == 2
+    assert metrics.retries == 1
+    assert metrics.parse_failures == 1
+    assert metrics.prompt_tokens == 60
+    latency = collector.latency(name)
+    assert latency is not None and latency.count == 3
+    assert collector.latency(name, "cache") is not None
+
+    text = collector.prometheus_text()
+    assert "# TYPE ghostfunction_call_duration_seconds histogram" in text
+    label = '{function="' + name + '"}'
+    assert f"ghostfunction_call_duration_seconds_count{label} 3" in text
+    assert f"ghostfunction_retries_total{label} 1" in text
+    assert 'phase="request",le="+Inf"} 2' in text
+
+
+def test_opentelemetry_hook_records_spans() -> None:
+    tracer = Mock()
+    instrumentation.add_hook(OpenTelemetryHook(tracer=tracer))
+
+    @ghostfunction(ai_callable=Mock(return_value=make_completion(["3"], "fake", USAGE)))
+    def toy_function() -> int:  # type: ignore[empty-body]
+        """Return a number."""
+        pass
+
+    toy_function()
+    span = tracer.start_span.return_value
+    assert tracer.start_span.call_args.args[0].endswith("toy_function")
+    span.set_attribute.assert_any_call("ghostfunction.prompt_tokens", 30)
+    span.end.assert_called_once()
+
+
+@pytest.mark.skipif(
+    importlib.util.find_spec("opentelemetry") is not None,
+    reason="opentelemetry is installed",
+)
+def test_enable_opentelemetry_without_opentelemetry() -> None:
+    assert instrumentation.enable_opentelemetry() is None
+    assert instrumentation.get_hooks() == ()
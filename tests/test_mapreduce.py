@@ -0,0 +1,112 @@
+import asyncio
+import threading
+from typing import Any
+from typing import Iterator
+from typing import List
+
+import pytest
+from openai.types.chat.chat_completion import ChatCompletion
+
+from ai_ghostfunctions import ghostfunction
+from ai_ghostfunctions.backends import make_completion
+from ai_ghostfunctions.mapreduce import MapReduce
+from ai_ghostfunctions.mapreduce import fold
+
+
+def _echo_sum(**kwargs: Any) -> ChatCompletion:
+    """Answer `total(numbers=[...])` calls with the sum of the numbers."""
+    content = kwargs["messages"][-1]["content"]
+    call = content[content.index("numbers=") + len("numbers=") :].splitlines()[0]
+    return make_completion([repr(sum(eval(call[: call.rindex(")")])))], "fake")  # nosec
+
+
+def test_fold_reduces_in_a_tree_in_order() -> None:
+    groups: List[List[str]] = []
+
+    def reduce(group: List[str]) -> str:
+        groups.append(group)
+        return "".join(group)
+
+    assert fold("abcdefg", reduce, fanin=3) == "abcdefg"
+    assert groups == [["a", "b", "c"], ["d", "e", "f"], ["abc", "def", "g"]]
+    assert fold(["x"], reduce) == "x"
+    assert fold("abc", reduce) == "abc"
+
+
+def test_map_reduce_with_python_reduce() -> None:
+    @ghostfunction(
+        ai_callable=_echo_sum,
+        map_reduce=MapReduce("numbers", chunk_size=10, reduce=sum),
+    )
+    def total(numbers: List[int]) -> int:  # type: ignore[empty-body]
+        """Return the sum of `numbers`."""
+        pass
+
+    assert total(list(range(95))) == sum(range(95))
+    assert list(total.partials(list(range(25)))) == [45, 145, 110]
+    assert total([]) == 0
+
+
+def test_map_reduce_consumes_iterables_lazily() -> None:
+    produced: List[int] = []
+    in_flight = threading.Semaphore(3)
+
+    def numbers() -> Iterator[int]:
+        for i in range(100):
+            produced.append(i)
+            yield i
+
+    def ai_callable(**kwargs: Any) -> ChatCompletion:
+        assert in_flight.acquire(blocking=False)
+        try:
+            return _echo_sum(**kwargs)
+        finally:
+            in_flight.release()
+
+    config = MapReduce("numbers", chunk_size=5, reduce=sum, max_concurrency=2)
+
+    @ghostfunction(ai_callable=ai_callable, map_reduce=config)
+    def total(numbers: List[int]) -> int:  # type: ignore[empty-body]
+        """Return the sum of `numbers`."""
+        pass
+
+    partials = total.partials(numbers())
+    assert next(partials) == sum(range(5))
+    assert len(produced) <= 15
+    assert sum(partials) == sum(range(5, 100))
+
+
+def test_map_reduce_with_reduce_ghostfunction_async() -> None:
+    @ghostfunction(ai_callable=_echo_sum, async_=True)
+    def combine(numbers: List[int]) -> int:  # type: ignore[empty-body]
+        """Return the sum of `numbers`."""
+        pass
+
+    config = MapReduce("numbers", chunk_size=4, reduce=combine, fanin=2)
+
+    @ghostfunction(ai_callable=_echo_sum, async_=True, map_reduce=config)
+    def total(numbers: List[int]) -> int:  # type: ignore[empty-body]
+        """Return the sum of `numbers`."""
+        pass
+
+    assert asyncio.run(total(list(range(30)))) == sum(range(30))
+
+
+def test_map_reduce_validation() -> None:
+    with pytest.raises(ValueError):
+        MapReduce("x", fanin=1)
+
+    with pytest.raises(ValueError):
+
+        @ghostfunction(ai_callable=_echo_sum, map_reduce=MapReduce("missing"))
+        def total(numbers: List[int]) -> int:  # type: ignore[empty-body]
+            """Return the sum of `numbers`."""
+            pass
+
+    @ghostfunction(ai_callable=_echo_sum)
+    def plain(numbers: List[int]) -> int:  # type: ignore[empty-body]
+        """Return the sum of `numbers`."""
+        pass
+
+    with pytest.raises(ValueError):
+        plain.partials([1])
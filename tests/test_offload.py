@@ -0,0 +1,128 @@
+import asyncio
+import threading
+import warnings
+from concurrent.futures import Future
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+
+import pytest
+import typeguard
+
+from ai_ghostfunctions import ghostfunction
+from ai_ghostfunctions.backends import LocalModelBackend
+from ai_ghostfunctions.hedging import HedgingPolicy
+from ai_ghostfunctions.offload import ParseOffload
+from ai_ghostfunctions.testing import FakeAI
+from ai_ghostfunctions.testing import dict_response
+
+
+@pytest.fixture(scope="module")
+def offload() -> Iterator[ParseOffload]:
+    offload = ParseOffload(threshold=1000, max_workers=1, kind="process")
+    yield offload
+    offload.shutdown()
+
+
+def _records(ai_callable: Any, offload: ParseOffload, **kwargs: Any) -> Any:
+    @ghostfunction(ai_callable=ai_callable, offload=offload, **kwargs)
+    def records() -> Dict[str, List[Any]]:  # type: ignore[empty-body]
+        """Return records."""
+        pass
+
+    return records
+
+
+def test_large_responses_are_parsed_in_a_worker_process(offload: ParseOffload) -> None:
+    fake = FakeAI(dict_response(200))
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        assert _records(fake, offload)() == {
+            f"key_{i}": [i, str(i)] for i in range(200)
+        }
+    assert offload.wants(["x" * 1000], Dict[str, List[Any]], lambda x: x[0]) is False
+
+
+def test_small_responses_are_parsed_in_the_calling_thread() -> None:
+    offload = ParseOffload(threshold=1000, kind="process")
+    assert _records(FakeAI(dict_response(2)), offload)() == {
+        "key_0": [0, "0"],
+        "key_1": [1, "1"],
+    }
+    assert offload._executor is None
+
+
+def test_offloaded_parse_errors_are_raised(offload: ParseOffload) -> None:
+    text = repr({f"key_{i}": i for i in range(200)})
+    with pytest.raises(typeguard.TypeCheckError):
+        _records(FakeAI(text), offload)()
+
+
+def test_async_ghostfunctions_await_the_worker(offload: ParseOffload) -> None:
+    fake = FakeAI(dict_response(200))
+    records = _records(fake.acall, offload, async_=True)
+    assert len(asyncio.run(records())) == 200
+
+
+class _GatedOffload(ParseOffload):
+    """Parses only once the event loop has opened the gate, or after a timeout."""
+
+    def __init__(self) -> None:
+        super().__init__(threshold=0, max_workers=2, kind="thread")
+        self.gate = threading.Event()
+        self.opened: List[bool] = []
+
+    def submit(self, *args: Any) -> "Future[Any]":
+        parsed = super().submit(*args)
+
+        def gated() -> Any:
+            self.opened.append(self.gate.wait(timeout=2))
+            return parsed.result()
+
+        return self._pool().submit(gated)
+
+
+@pytest.mark.parametrize("path", ["hedged", "batched"])
+def test_async_hedged_and_batched_calls_do_not_block_the_loop(path: str) -> None:
+    offload = _GatedOffload()
+    text = repr({"key": [1, "1"]})
+    if path == "hedged":
+        ai_callable: Any = FakeAI(text).acall
+        kwargs: Dict[str, Any] = {"hedging": HedgingPolicy(delay=5)}
+    else:
+        ai_callable = None
+        kwargs = {
+            "backend": LocalModelBackend(lambda prompts, params: [text] * len(prompts))
+        }
+    records = _records(ai_callable, offload, async_=True, **kwargs)
+
+    async def call() -> Any:
+        if path == "hedged":
+            return await records()
+        return [result async for result in records.amap([()])][0]
+
+    async def main() -> Any:
+        task = asyncio.ensure_future(call())
+        await asyncio.sleep(0.05)
+        offload.gate.set()
+        return await task
+
+    try:
+        assert asyncio.run(main()) == {"key": [1, "1"]}
+    finally:
+        offload.shutdown()
+    assert offload.opened == [True]
+
+
+def test_thread_pool_offload() -> None:
+    offload = ParseOffload(threshold=10, kind="thread")
+    try:
+        assert len(_records(FakeAI(dict_response(20)), offload)()) == 20
+    finally:
+        offload.shutdown()
+
+
+def test_unknown_kind_is_rejected() -> None:
+    with pytest.raises(ValueError):
+        ParseOffload(kind="subinterpreter")
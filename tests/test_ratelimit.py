@@ -0,0 +1,205 @@
+import asyncio
+import time
+from email.utils import formatdate
+from typing import Any
+from typing import Iterator
+from typing import List
+from unittest.mock import Mock
+
+import httpx
+import openai
+import pytest
+
+from ai_ghostfunctions import clients
+from ai_ghostfunctions import ghostfunction
+from ai_ghostfunctions import ratelimit
+from ai_ghostfunctions.backends import make_completion
+from ai_ghostfunctions.ratelimit import Scheduler
+from ai_ghostfunctions.ratelimit import TokenBucket
+
+
+class StatusError(Exception):
+    """Mimics `openai.APIStatusError`."""
+
+    status_code: int
+    response: Any
+
+
+def _status_error(status_code: int, headers: Any = None) -> StatusError:
+    error = StatusError(f"status {status_code}")
+    error.status_code = status_code
+    error.response = Mock(headers=headers or {})
+    return error
+
+
+@pytest.fixture(autouse=True)
+def default_scheduler() -> Iterator[None]:
+    yield
+    ratelimit.configure_rate_limits()
+
+
+def test_token_bucket_refills_over_time() -> None:
+    now = [0.0]
+    bucket = TokenBucket(per_minute=60, clock=lambda: now[0])
+    bucket.take(60)
+    assert bucket.delay(2) == pytest.approx(2.0)
+    now[0] = 1.0
+    assert bucket.delay(2) == pytest.approx(1.0)
+    # oversized: waits for a full bucket
+    assert bucket.delay(1000) == pytest.approx(59.0)
+
+
+def test_scheduler_serves_by_priority_then_round_robin() -> None:
+    scheduler = Scheduler(requests_per_minute=600)
+    waiters = {
+        name: scheduler._enqueue(key, 0, priority)
+        for name, key, priority in [
+            ("a1", "a", 0),
+            ("a2", "a", 0),
+            ("a3", "a", 0),
+            ("b1", "b", 0),
+            ("b2", "b", 0),
+            ("urgent", "c", 5),
+        ]
+    }
+    names = {id(w): name for name, w in waiters.items()}
+    order = []
+    while scheduler._queue:
+        head = scheduler._head()
+        assert head is not None
+        assert scheduler._poll(head) == 0
+        order.append(names[id(head)])
+    assert order == ["urgent", "a1", "b1", "a2", "b2", "a3"]
+
+
+def test_scheduler_waits_for_the_request_budget() -> None:
+    scheduler = Scheduler(requests_per_minute=600)
+    for _ in range(600):
+        scheduler.acquire()
+    start = time.monotonic()
+    scheduler.acquire()
+    assert time.monotonic() - start >= 0.05
+
+
+def test_scheduler_async_waits_for_the_token_budget() -> None:
+    scheduler = Scheduler(tokens_per_minute=600)
+
+    async def run() -> float:
+        await scheduler.aacquire(tokens=600)
+        start = time.monotonic()
+        await scheduler.aacquire(tokens=1)
+        return time.monotonic() - start
+
+    assert asyncio.run(run()) >= 0.05
+
+
+def test_scheduler_settles_estimate_with_reported_usage() -> None:
+    scheduler = Scheduler(tokens_per_minute=1000, clock=lambda: 0.0)
+    scheduler.acquire(tokens=500)
+    scheduler._settle(500, Mock(usage=Mock(total_tokens=100)))
+    assert scheduler._tokens is not None
+    assert scheduler._tokens.level == 900
+
+
+def test_retry_after_parses_seconds_and_dates() -> None:
+    assert ratelimit.retry_after(_status_error(429, {"retry-after": "2"})) == 2.0
+    assert ratelimit.retry_after(_status_error(429, {"retry-after-ms": "1500"})) == 1.5
+    date = formatdate(time.time() + 30, usegmt=True)
+    assert 25 < ratelimit.retry_after(_status_error(429, {"retry-after": date})) <= 30  # type: ignore[operator]
+    assert ratelimit.retry_after(_status_error(429, {"retry-after": "soon"})) is None
+    assert ratelimit.retry_after(ValueError()) is None
+
+
+def test_ghostfunction_retries_rate_limited_requests() -> None:
+    ratelimit.configure_rate_limits(backoff=0.01)
+    mock_callable = Mock(
+        side_effect=[
+            _status_error(429, {"retry-after": "0"}),
+            _status_error(503),
+            make_completion(["'ok'"], "fake"),
+        ]
+    )
+
+    @ghostfunction(ai_callable=mock_callable)
+    def toy_function() -> str:  # type: ignore[empty-body]
+        """Return a word."""
+        pass
+
+    assert toy_function() == "ok"
+    assert mock_callable.call_count == 3
+
+
+def test_ghostfunction_does_not_retry_client_errors() -> None:
+    mock_callable = Mock(
+        side_effect=[
+            _status_error(400),
+            make_completion(["'ok'"], "fake"),
+        ]
+    )
+
+    @ghostfunction(ai_callable=mock_callable)
+    async def toy_function() -> str:  # type: ignore[empty-body]
+        """Return a word."""
+        pass
+
+    with pytest.raises(StatusError):
+        asyncio.run(toy_function())
+    assert mock_callable.call_count == 1
+
+
+def test_ghostfunction_gives_up_after_max_retries() -> None:
+    ratelimit.configure_rate_limits(max_retries=1, backoff=0.01)
+    errors: List[Exception] = [_status_error(500), _status_error(500)]
+    mock_callable = Mock(side_effect=errors)
+
+    @ghostfunction(ai_callable=mock_callable)
+    def toy_function() -> str:  # type: ignore[empty-body]
+        """Return a word."""
+        pass
+
+    with pytest.raises(StatusError):
+        toy_function()
+    assert mock_callable.call_count == 2
+
+
+def test_persistent_429_is_retried_by_the_scheduler_only(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    attempts: List[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        attempts.append(request)
+        error = {"error": {"message": "Rate limit reached", "type": "requests"}}
+        return httpx.Response(429, json=error, headers={"retry-after-ms": "0"})
+
+    client_kwargs = clients.ClientConfig._client_kwargs
+    monkeypatch.setattr(
+        clients.ClientConfig,
+        "_client_kwargs",
+        lambda self: {**client_kwargs(self), "transport": httpx.MockTransport(handler)},
+    )
+    config = clients.configure_clients()
+    try:
+        ratelimit.configure_rate_limits(max_retries=3, backoff=0)
+        create = clients.get_client("key").chat.completions.create
+        kwargs = {"model": "gpt-4o", "messages": [{"role": "user", "content": "hi"}]}
+        with pytest.raises(openai.RateLimitError):
+            ratelimit.get_scheduler().call(create, kwargs)
+    finally:
+        clients.configure_clients(**config.__dict__)
+    assert len(attempts) == 4
+
+
+def test_scheduler_retries_connection_errors() -> None:
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    ratelimit.configure_rate_limits(backoff=0)
+    mock_callable = Mock(
+        side_effect=[
+            openai.APITimeoutError(request),
+            _status_error(408),
+            make_completion(["'ok'"], "fake"),
+        ]
+    )
+
+    assert ratelimit.get_scheduler().call(mock_callable, {}) is not None
+    assert mock_callable.call_count == 3
@@ -0,0 +1,156 @@
+import asyncio
+from typing import Any
+from typing import Iterator
+from unittest.mock import AsyncMock
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import httpx
+import openai
+import pytest
+from openai.types.chat.chat_completion import ChatCompletion
+
+import ai_ghostfunctions.backends
+from ai_ghostfunctions import ghostfunction
+from ai_ghostfunctions import routing
+from ai_ghostfunctions.backends import make_completion
+from ai_ghostfunctions.routing import ModelRouter
+from ai_ghostfunctions.routing import RoutingRule
+
+
+@pytest.fixture(autouse=True)
+def default_router() -> Iterator[None]:
+    yield
+    routing.configure_routing()
+
+
+def _not_found() -> openai.NotFoundError:
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    return openai.NotFoundError(
+        "model not found", response=httpx.Response(404, request=request), body=None
+    )
+
+
+def _create_without(*unavailable: str) -> Mock:
+    def create(model: str, **kwargs: Any) -> ChatCompletion:
+        if model in unavailable:
+            raise _not_found()
+        return make_completion(["'ok'"], "fake")
+
+    return Mock(side_effect=create)
+
+
+def _models(create: Mock) -> Any:
+    return [c.kwargs["model"] for c in create.call_args_list]
+
+
+def test_router_remembers_unavailable_models() -> None:
+    router = ModelRouter(models=["big", "medium", "small"])
+    create = _create_without("big", "medium")
+    router.call(create, {"messages": []})
+    router.call(create, {"messages": []})
+    assert _models(create) == ["big", "medium", "small", "small"]
+    router.forget()
+    router.call(create, {"messages": []})
+    assert _models(create)[4:] == ["big", "medium", "small"]
+
+
+def test_router_rechecks_after_timeout() -> None:
+    now = [0.0]
+    router = ModelRouter(
+        models=["big", "small"], recheck_after=60, clock=lambda: now[0]
+    )
+    router.mark_unavailable("big")
+    assert router.candidates({}) == ["small"]
+    now[0] = 60.0
+    assert router.candidates({}) == ["big", "small"]
+
+
+def test_router_reports_error_of_last_model() -> None:
+    router = ModelRouter(models=["big", "small"])
+    create = _create_without("big", "small")
+    with pytest.raises(openai.NotFoundError):
+        router.call(create, {})
+    with pytest.raises(openai.NotFoundError):
+        router.call(create, {})
+    assert _models(create) == ["big", "small", "small"]
+
+
+def test_router_does_not_fall_back_on_other_errors() -> None:
+    router = ModelRouter(models=["big", "small"])
+    create = Mock(side_effect=ValueError("bad request"))
+    with pytest.raises(ValueError):
+        router.call(create, {})
+    assert _models(create) == ["big"]
+    assert router.is_available("big")
+
+
+def test_router_rules_and_per_request_models() -> None:
+    router = ModelRouter(
+        models=["big", "small"],
+        rules=[
+            RoutingRule(model="fast", max_prompt_chars=10),
+            RoutingRule(model="json", when=lambda kwargs: "response_format" in kwargs),
+        ],
+    )
+    short = {"messages": [{"role": "user", "content": "hi"}]}
+    long = {"messages": [{"role": "user", "content": "hello" * 10}]}
+    assert router.candidates(short) == ["fast", "big", "small"]
+    assert router.candidates(long) == ["big", "small"]
+    assert router.candidates({**long, "response_format": {}}) == [
+        "json",
+        "big",
+        "small",
+    ]
+    assert router.candidates({**short, "model": "chosen"}) == ["chosen"]
+    assert router.candidates({"model": ["a", "small", "a"]}) == ["a", "small"]
+
+
+def test_default_ai_callable_uses_router_and_per_function_model() -> None:
+    create = _create_without("gpt-4")
+    client = Mock()
+    client.chat.completions.create = create
+
+    with patch.object(ai_ghostfunctions.backends, "get_client", return_value=client):
+
+        @ghostfunction
+        def toy_function() -> str:  # type: ignore[empty-body]
+            """Return a word."""
+            pass
+
+        @ghostfunction(model="gpt-4o")
+        def other_function() -> str:  # type: ignore[empty-body]
+            """Return a word."""
+            pass
+
+        assert toy_function() == "ok"
+        assert toy_function() == "ok"
+        assert other_function() == "ok"
+    assert _models(create) == ["gpt-4", "gpt-3.5-turbo", "gpt-3.5-turbo", "gpt-4o"]
+
+
+def test_default_async_ai_callable_uses_router() -> None:
+    def create(model: str, **kwargs: Any) -> ChatCompletion:
+        if model == "gpt-4":
+            raise _not_found()
+        return make_completion(["'ok'"], "fake")
+
+    client = Mock()
+    client.chat.completions.create = AsyncMock(side_effect=create)
+
+    with patch.object(
+        ai_ghostfunctions.backends, "get_async_client", return_value=client
+    ):
+
+        @ghostfunction
+        async def toy_function() -> str:  # type: ignore[empty-body]
+            """Return a word."""
+            pass
+
+        assert asyncio.run(toy_function()) == "ok"
+        assert asyncio.run(toy_function()) == "ok"
+    assert _models(client.chat.completions.create) == [
+        "gpt-4",
+        "gpt-3.5-turbo",
+        "gpt-3.5-turbo",
+    ]
@@ -0,0 +1,139 @@
+import dataclasses
+import enum
+import json
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Mapping
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from typing import TypedDict
+from typing import Union
+from unittest.mock import Mock
+
+import pytest
+
+from ai_ghostfunctions import ghostfunction
+from ai_ghostfunctions.backends import make_completion
+from ai_ghostfunctions.schema import compile_structured_validator
+from ai_ghostfunctions.schema import json_schema
+from ai_ghostfunctions.schema import response_format
+from ai_ghostfunctions.testing import FakeAI
+
+
+class Color(enum.Enum):
+    """A color."""
+
+    RED = "red"
+    BLUE = "blue"
+
+
+class Movie(TypedDict):
+    """A movie."""
+
+    title: str
+    year: int
+
+
+@dataclasses.dataclass
+class Review:
+    """A review."""
+
+    movie: Movie
+    stars: Tuple[int, int]
+    tags: Set[str]
+    color: Optional[Color] = None
+
+
+def test_json_schema_of_nested_types() -> None:
+    assert json_schema(List[int]) == {"type": "array", "items": {"type": "integer"}}
+    assert json_schema(Movie) == {
+        "type": "object",
+        "properties": {"title": {"type": "string"}, "year": {"type": "integer"}},
+        "required": ["title", "year"],
+        "additionalProperties": False,
+    }
+    review = json_schema(Review)
+    assert review["required"] == ["movie", "stars", "tags"]
+    assert review["properties"]["color"] == {
+        "anyOf": [{"enum": ["red", "blue"]}, {"type": "null"}]
+    }
+    assert review["properties"]["stars"]["prefixItems"] == [{"type": "integer"}] * 2
+    assert json_schema(Dict[str, float]) == {
+        "type": "object",
+        "additionalProperties": {"type": "number"},
+    }
+    with pytest.raises(TypeError):
+        json_schema(complex)
+
+
+def test_response_format_is_strict_when_possible() -> None:
+    strict = response_format(List[Movie], "movies")["json_schema"]
+    assert strict["strict"] is True
+    assert strict["name"] == "movies"
+    assert strict["schema"]["required"] == ["result"]
+    assert response_format(Review, "review")["json_schema"]["strict"] is False
+
+
+def test_structured_validator_decodes_into_the_annotation() -> None:
+    validator = compile_structured_validator(Review)
+    text = json.dumps(
+        {
+            "result": {
+                "movie": {"title": "Up", "year": 2009},
+                "stars": [4, 5],
+                "tags": ["fun", "fun"],
+                "color": "blue",
+            }
+        }
+    )
+    assert validator.parse(text) == Review(
+        movie={"title": "Up", "year": 2009},
+        stars=(4, 5),
+        tags={"fun"},
+        color=Color.BLUE,
+    )
+    assert compile_structured_validator(Dict[int, bool]).parse(
+        '{"result": {"1": true}}'
+    ) == {1: True}
+    union = compile_structured_validator(Union[Tuple[int, int], List[str]])
+    assert union.parse('{"result": ["a"]}') == ["a"]
+    assert union.parse('{"result": [1, 2]}') == (1, 2)
+
+
+def test_ghostfunction_requests_and_parses_structured_output() -> None:
+    mock_callable = Mock(
+        return_value=make_completion(
+            ['{"result": [{"title": "Up", "year": 2009}]}'], "fake"
+        )
+    )
+
+    @ghostfunction(ai_callable=mock_callable, structured_output=True, temperature=0)
+    def movies(n: int) -> List[Movie]:  # type: ignore[empty-body]
+        """Return `n` movies."""
+        pass
+
+    assert movies(1) == [{"title": "Up", "year": 2009}]
+    kwargs: Mapping[str, Any] = mock_callable.call_args.kwargs
+    assert kwargs["temperature"] == 0
+    assert kwargs["response_format"]["json_schema"]["name"] == "movies"
+
+
+def test_structured_output_stream_and_packed_map() -> None:
+    fake = FakeAI('{"result": [true, null]}', chunk_size=5)
+
+    @ghostfunction(ai_callable=fake, structured_output=True)
+    def flags() -> List[Optional[bool]]:  # type: ignore[empty-body]
+        """Return flags."""
+        pass
+
+    assert list(flags.stream()) == [True, None]
+    assert flags() == [True, None]
+
+    mock_callable = Mock(return_value=make_completion(["[[True], [False]]"], "fake"))
+    flags = ghostfunction(ai_callable=mock_callable, structured_output=True)(
+        flags.function
+    )
+    assert list(flags.map([(), ()], pack_size=2)) == [[True], [False]]
+    assert "response_format" not in mock_callable.call_args.kwargs
@@ -0,0 +1,152 @@
+from typing import Any
+from typing import List
+from typing import Sequence
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import pytest
+from openai.types.chat.chat_completion import ChatCompletion
+
+from ai_ghostfunctions import ghostfunction
+from ai_ghostfunctions.cache import InMemoryCache
+from ai_ghostfunctions.cache import TieredCache
+from ai_ghostfunctions.ghostfunctions import _default_prompt_creation
+from ai_ghostfunctions.semantic_cache import SemanticCache
+from ai_ghostfunctions.semantic_cache import split_call
+from ai_ghostfunctions.types import Message
+
+
+pytest.importorskip("numpy")
+
+
+def sentiment(text: str) -> str:  # type: ignore[empty-body]
+    """Return "positive" or "negative"."""
+    pass
+
+
+def topic(text: str) -> str:  # type: ignore[empty-body]
+    """Return "positive" or "negative"."""
+    pass
+
+
+def _prompt(text: str, function: Any = sentiment) -> List[Message]:
+    return _default_prompt_creation(function, text)
+
+
+def test_split_call_separates_the_call_line() -> None:
+    scope, text = split_call(_prompt("hi"))
+    assert text == "\nresult = sentiment(text='hi')\nprint(result)\n"
+    assert scope[-1]["content"].endswith('Return "positive" or "negative".')
+    assert split_call([Message(role="user", content="x")]) == ([], "x")
+
+
+def test_near_duplicates_hit_within_the_same_function() -> None:
+    cache = SemanticCache()
+    cache.set(_prompt("I love this movie"), {}, ["'positive'"])
+    assert cache.get(_prompt("  I love this   movie "), {}) == ["'positive'"]
+    assert cache.get(_prompt("The weather is terrible"), {}) is None
+    assert cache.get(_prompt("I love this movie", topic), {}) is None
+    assert cache.get(_prompt("I love this movie"), {"temperature": 1}) is None
+    assert cache.stats.hits == 1
+
+    loose = cache.with_threshold(0.9)
+    assert loose.get(_prompt("I loved this movie"), {}) == ["'positive'"]
+    assert cache.get(_prompt("I loved this movie"), {}) is None
+
+
+@pytest.mark.parametrize(
+    "cached, requested",
+    [
+        ("the price is 100 dollars", "the price is 900 dollars"),
+        ("the price is 100 dollars", "The Price Is 100 Dollars"),
+        ("I loved this movie", "I hated this movie"),
+        ("The service was good", "The service was not good"),
+    ],
+)
+def test_calls_with_another_meaning_miss_by_default(
+    cached: str, requested: str
+) -> None:
+    cache = SemanticCache()
+    cache.set(_prompt(cached), {}, ["'cached'"])
+    assert cache.get(_prompt(requested), {}) is None
+    assert cache.get(_prompt(cached), {}) == ["'cached'"]
+
+
+def test_price_change_is_not_answered_from_the_cache() -> None:
+    mock_callable = Mock(
+        side_effect=[
+            ChatCompletion.model_construct(  # type: ignore[attr-defined]
+                **{"choices": [{"message": {"content": repr(content)}}]}
+            )
+            for content in ["100 dollars", "900 dollars"]
+        ]
+    )
+
+    @ghostfunction(ai_callable=mock_callable, cache=SemanticCache())
+    def translate(text: str) -> str:  # type: ignore[empty-body]
+        """Translate `text` to English."""
+        pass
+
+    assert translate("the price is 100 dollars") == "100 dollars"
+    assert translate("the price is 900 dollars") == "900 dollars"
+    assert mock_callable.call_count == 2
+
+
+def test_pluggable_embedder() -> None:
+    def embed(text: str) -> Sequence[float]:
+        return [1.0, float(len(text) % 2)]
+
+    cache = SemanticCache(threshold=0.99, embedder=embed)
+    cache.set(_prompt("ab"), {}, ["1"])
+    assert cache.get(_prompt("abcd"), {}) == ["1"]
+    assert cache.get(_prompt("abc"), {}) is None
+
+
+def test_missing_numpy_points_at_the_semantic_extra() -> None:
+    with patch.dict("sys.modules", {"numpy": None}):
+        with pytest.raises(ImportError, match=r"ai-ghostfunctions\[semantic\]"):
+            SemanticCache()
+
+
+def test_eviction_by_size_and_age() -> None:
+    now = [0.0]
+    cache = SemanticCache(maxsize=2, ttl=10, clock=lambda: now[0])
+    cache.set(_prompt("one"), {}, ["1"])
+    cache.set(_prompt("two"), {}, ["2"])
+    now[0] = 1
+    cache.get(_prompt("one"), {})
+    cache.set(_prompt("three"), {}, ["3"])
+    assert cache.get(_prompt("two"), {}) is None
+    assert cache.get(_prompt("one"), {}) == ["1"]
+    assert len(cache) == 2
+
+    now[0] = 20
+    assert cache.get(_prompt("one"), {}) is None
+    assert cache.stats.evictions >= 2
+
+    cache.set(_prompt("one"), {}, ["1"])
+    size = len(cache)
+    cache.set(_prompt("one"), {}, ["one"])
+    assert len(cache) == size
+    assert cache.get(_prompt("one"), {}) == ["one"]
+
+
+def test_ghostfunction_with_tiered_cache() -> None:
+    semantic = SemanticCache()
+    mock_callable = Mock(
+        return_value=ChatCompletion.model_construct(  # type: ignore[attr-defined]
+            **{"choices": [{"message": {"content": "'positive'"}}]}
+        )
+    )
+
+    @ghostfunction(
+        ai_callable=mock_callable, cache=TieredCache(InMemoryCache(), semantic)
+    )
+    def sentiment(text: str) -> str:  # type: ignore[empty-body]
+        """Return "positive" or "negative"."""
+        pass
+
+    assert sentiment("What a great film!") == "positive"
+    assert sentiment(" What a  great film! ") == "positive"
+    mock_callable.assert_called_once()
+    assert semantic.stats.hits == 1
@@ -0,0 +1,95 @@
+import asyncio
+import threading
+import time
+from typing import Any
+from typing import List
+
+import pytest
+from openai.types.chat.chat_completion import ChatCompletion
+
+from ai_ghostfunctions import ghostfunction
+from ai_ghostfunctions.backends import make_completion
+from ai_ghostfunctions.singleflight import SingleFlight
+
+
+def test_concurrent_threads_share_one_request() -> None:
+    calls: List[Any] = []
+
+    def ai_callable(**kwargs: Any) -> ChatCompletion:
+        calls.append(kwargs)
+        time.sleep(0.1)
+        return make_completion(["['a', 'b']"], "fake")
+
+    @ghostfunction(ai_callable=ai_callable, coalesce=True)
+    def letters(n: int) -> List[str]:  # type: ignore[empty-body]
+        """Return `n` letters."""
+        pass
+
+    results: List[Any] = []
+    threads = [
+        threading.Thread(target=lambda: results.append(letters(2))) for _ in range(8)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert results == [["a", "b"]] * 8
+    assert len({id(r) for r in results}) == 8
+
+    letters(2)
+    letters(3)
+    assert len(calls) == 3
+
+
+def test_waiters_receive_the_exception() -> None:
+    flight = SingleFlight()
+    started = threading.Event()
+    errors: List[BaseException] = []
+
+    def fail() -> None:
+        started.set()
+        time.sleep(0.1)
+        raise ValueError("boom")
+
+    def follow() -> None:
+        started.wait()
+        try:
+            flight.do("key", lambda: None)
+        except ValueError as e:
+            errors.append(e)
+
+    follower = threading.Thread(target=follow)
+    follower.start()
+    with pytest.raises(ValueError):
+        flight.do("key", fail)
+    follower.join()
+    assert len(errors) == 1
+    assert flight.do("key", lambda: 1) == (1, False)
+
+
+def test_concurrent_tasks_share_one_request() -> None:
+    calls: List[Any] = []
+
+    async def ai_callable(**kwargs: Any) -> ChatCompletion:
+        calls.append(kwargs)
+        await asyncio.sleep(0.05)
+        return make_completion(["{'a': 1}"], "fake")
+
+    @ghostfunction(ai_callable=ai_callable, coalesce=True)
+    async def table(key: str) -> dict:  # type: ignore[empty-body,type-arg]
+        """Return a table."""
+        pass
+
+    async def run() -> List[Any]:
+        first = asyncio.ensure_future(table("a"))
+        await asyncio.sleep(0)
+        first.cancel()  # the shared request goes on for the others
+        results = await asyncio.gather(*(table("a") for _ in range(5)), table("b"))
+        return list(results)
+
+    results = asyncio.run(run())
+    assert len(calls) == 2
+    assert results == [{"a": 1}] * 6
+    results[0]["b"] = 2
+    assert results[1] == {"a": 1}
@@ -0,0 +1,124 @@
+import asyncio
+from typing import Any
+from typing import AsyncIterator
+from typing import Dict
+from typing import Iterator
+from typing import List
+
+import pytest
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+
+from ai_ghostfunctions import ghostfunction
+from ai_ghostfunctions.cache import InMemoryCache
+from ai_ghostfunctions.streaming import IncrementalListParser
+from ai_ghostfunctions.streaming import element_type
+
+
+def _chunk(text: str) -> ChatCompletionChunk:
+    return ChatCompletionChunk.model_construct(  # type: ignore[no-any-return]
+        choices=[{"index": 0, "delta": {"content": text}}]  # type: ignore[list-item]
+    )
+
+
+def _feed_all(chunks: List[str]) -> List[str]:
+    parser = IncrementalListParser()
+    elements = [e for chunk in chunks for e in parser.feed(chunk)]
+    parser.close()
+    return elements
+
+
+def test_incremental_list_parser_splits_elements_across_chunks() -> None:
+    chunks = ["Sure: [ 'a, b'", ', "c\\"]"', ", [1, (2, ", "3)], {'k': ']'}", "]"]
+    assert _feed_all(chunks) == ["'a, b'", '"c\\"]"', "[1, (2, 3)]", "{'k': ']'}"]
+
+
+def test_incremental_list_parser_handles_empty_list_and_trailing_comma() -> None:
+    assert _feed_all(["[]"]) == []
+    assert _feed_all(["[1,", "2,]"]) == ["1", "2"]
+
+
+def test_incremental_list_parser_requires_closed_list() -> None:
+    parser = IncrementalListParser()
+    parser.feed("[1, 2")
+    with pytest.raises(SyntaxError):
+        parser.close()
+
+
+@pytest.mark.parametrize(
+    "return_type,expected",
+    [
+        (List[int], int),
+        (list, Any),
+        (Iterator[str], str),
+        (AsyncIterator[Dict[str, int]], Dict[str, int]),
+    ],
+)
+def test_element_type(return_type: Any, expected: Any) -> None:
+    assert element_type(return_type) == expected
+
+
+def test_element_type_rejects_non_list_types() -> None:
+    with pytest.raises(TypeError):
+        element_type(str)
+
+
+def test_ghostfunction_stream_yields_before_the_response_completes() -> None:
+    sent = []
+
+    def ai_callable(**kwargs: Any) -> Iterator[ChatCompletionChunk]:
+        assert kwargs["stream"] is True
+        for text in ["['goose',", " 'goo", "fy']"]:
+            sent.append(text)
+            yield _chunk(text)
+
+    cache = InMemoryCache()
+
+    @ghostfunction(ai_callable=ai_callable, cache=cache)
+    def generate_n_random_words(n: int, startswith: str) -> List[str]:  # type: ignore[empty-body]
+        """Return a list of `n` random words that start with `startswith`."""
+        pass
+
+    stream = generate_n_random_words.stream(2, "goo")  # type: ignore[attr-defined]
+    assert next(stream) == "goose"
+    assert len(sent) == 1
+    assert list(stream) == ["goofy"]
+
+    # the full text is cached and replayed, for streamed and regular calls alike
+    assert list(generate_n_random_words.stream(2, "goo")) == ["goose", "goofy"]  # type: ignore[attr-defined]
+    assert generate_n_random_words(2, "goo") == ["goose", "goofy"]
+    assert len(sent) == 3
+
+
+def test_ghostfunction_stream_validates_elements() -> None:
+    def ai_callable(**kwargs: Any) -> Iterator[ChatCompletionChunk]:
+        yield _chunk("[1, 'two']")
+
+    @ghostfunction(ai_callable=ai_callable)
+    def numbers(n: int) -> Iterator[int]:  # type: ignore[empty-body]
+        """Return `n` numbers."""
+        pass
+
+    stream = numbers.stream(2)  # type: ignore[attr-defined]
+    assert next(stream) == 1
+    with pytest.raises(Exception, match="str"):
+        next(stream)
+
+
+def test_async_ghostfunction_astream() -> None:
+    async def chunks() -> AsyncIterator[ChatCompletionChunk]:
+        for text in ["[1", ", 2", ", 3]"]:
+            await asyncio.sleep(0)
+            yield _chunk(text)
+
+    async def ai_callable(**kwargs: Any) -> AsyncIterator[ChatCompletionChunk]:
+        return chunks()
+
+    @ghostfunction(ai_callable=ai_callable)
+    async def numbers(n: int) -> List[int]:  # type: ignore[empty-body]
+        """Return `n` numbers."""
+        pass
+
+    async def collect() -> List[int]:
+        return [x async for x in numbers.astream(3)]  # type: ignore[attr-defined]
+
+    assert asyncio.run(collect()) == [1, 2, 3]
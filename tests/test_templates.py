@@ -0,0 +1,66 @@
+from typing import List
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import pytest
+
+from ai_ghostfunctions import ghostfunction
+from ai_ghostfunctions.templates import FunctionTemplate
+from ai_ghostfunctions.templates import compile_template
+
+
+def generate_n_random_words(n: int, startswith: str) -> List[str]:  # type: ignore[empty-body]
+    """Return a list of `n` random words that start with `startswith`."""
+
+
+def test_compile_template_is_cached_per_function() -> None:
+    template = compile_template(generate_n_random_words)
+    assert compile_template(generate_n_random_words) is template
+    assert template.parameters == ("n", "startswith")
+    assert template.name == "generate_n_random_words"
+
+
+def test_render_call_maps_positional_arguments_to_parameters() -> None:
+    template = compile_template(generate_n_random_words)
+    expected = "generate_n_random_words(n=2,startswith='goo')"
+    assert template.render_call(2, "goo") == expected
+    assert template.render_call(2, startswith="goo") == expected
+    assert template.render_call(startswith="goo", n=2) == expected
+
+
+def test_render_and_render_packed() -> None:
+    template = compile_template(generate_n_random_words)
+    assert template.render(2, "goo") == (
+        template.header
+        + "result = generate_n_random_words(n=2,startswith='goo')\nprint(result)\n"
+    )
+    assert template.render_packed(
+        [((1, "a"), {}), ((), {"n": 2, "startswith": "b"})]
+    ) == (
+        template.header
+        + "result_0 = generate_n_random_words(n=1,startswith='a')\n"
+        + "result_1 = generate_n_random_words(n=2,startswith='b')\n"
+        + "print([result_0, result_1])\n"
+    )
+    assert template.header.startswith("from mymodule import generate_n_random_words\n")
+
+
+def test_template_requires_docstring() -> None:
+    def f(x: int) -> int:
+        return x
+
+    with pytest.raises(ValueError):
+        FunctionTemplate(f)
+
+
+def test_signature_is_inspected_once_per_function() -> None:
+    @ghostfunction(ai_callable=Mock())
+    def echo(x: int) -> int:  # type: ignore[empty-body]
+        """Return x."""
+        pass
+
+    assert echo.template is compile_template(echo.function)  # type: ignore[attr-defined]
+    with patch("ai_ghostfunctions.templates.inspect.signature") as signature:
+        for i in range(10):
+            echo.prompt_function(echo.function, i)  # type: ignore[attr-defined]
+    signature.assert_not_called()
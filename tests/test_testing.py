@@ -0,0 +1,44 @@
+import asyncio
+from typing import List
+
+from ai_ghostfunctions import ghostfunction
+from ai_ghostfunctions.testing import FakeAI
+from ai_ghostfunctions.testing import cycle_response
+from ai_ghostfunctions.testing import list_response
+
+
+def test_fake_ai_answers_ghostfunctions() -> None:
+    fake = FakeAI(list_response(3))
+
+    @ghostfunction(ai_callable=fake)
+    def numbers() -> List[int]:  # type: ignore[empty-body]
+        """Return numbers."""
+        pass
+
+    assert numbers() == [0, 1, 2]
+    assert fake.calls == 1
+
+
+def test_fake_ai_answers_n_choices_and_reports_usage() -> None:
+    fake = FakeAI(cycle_response("'a'", "'bb'"))
+    completion = fake(messages=[{"role": "user", "content": "x" * 40}], n=3)
+    assert [c.message.content for c in completion.choices] == ["'a'", "'bb'", "'a'"]
+    assert completion.usage.prompt_tokens == 10
+
+
+def test_fake_ai_streams_chunks() -> None:
+    fake = FakeAI("abcdefgh", chunk_size=3)
+    chunks = list(fake(messages=[], stream=True))
+    assert [c.choices[0].delta.content for c in chunks] == ["abc", "def", "gh"]
+    assert [c.choices[0].finish_reason for c in chunks] == [None, None, "stop"]
+
+
+def test_fake_ai_acall() -> None:
+    fake = FakeAI("[1]", latency=0.01)
+
+    @ghostfunction(ai_callable=fake.acall)
+    async def numbers() -> List[int]:  # type: ignore[empty-body]
+        """Return numbers."""
+        pass
+
+    assert asyncio.run(numbers()) == [1]
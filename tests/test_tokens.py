@@ -0,0 +1,149 @@
+import asyncio
+import threading
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from unittest.mock import Mock
+
+import pytest
+from openai.types.chat.chat_completion import ChatCompletion
+
+from ai_ghostfunctions import ghostfunction
+from ai_ghostfunctions.backends import make_completion
+from ai_ghostfunctions.tokens import HeuristicTokenizer
+from ai_ghostfunctions.tokens import TokenBudget
+from ai_ghostfunctions.tokens import TokenBudgetExceeded
+from ai_ghostfunctions.tokens import concatenate
+from ai_ghostfunctions.tokens import count_tokens
+from ai_ghostfunctions.tokens import get_tokenizer
+from ai_ghostfunctions.tokens import model_name
+from ai_ghostfunctions.tokens import split
+from ai_ghostfunctions.types import Message
+
+
+def _user_content(mock_callable: Mock) -> str:
+    content: str = mock_callable.call_args.kwargs["messages"][-1]["content"]
+    return content
+
+
+def test_heuristic_tokenizer_and_message_overhead() -> None:
+    assert HeuristicTokenizer().count("print(result)") == 6
+    assert HeuristicTokenizer().count("") == 0
+    assert get_tokenizer("some-model") is get_tokenizer("some-model")
+    messages = [Message(role="user", content="hello")]
+    assert count_tokens(messages) == 3 + 3 + get_tokenizer().count("hello")
+    assert model_name({"model": ["a", "b"]}) == "a"
+    assert model_name({}) is None
+
+
+def test_split_and_concatenate() -> None:
+    assert split(list(range(5)), 2) == [[0, 1], [2, 3, 4]]
+    assert split("abc", 5) == ["a", "b", "c"]
+    assert split({"a": 1, "b": 2}, 2) == [{"a": 1}, {"b": 2}]
+    with pytest.raises(TypeError):
+        split(3, 2)
+    assert concatenate([[1], [2, 3]]) == [1, 2, 3]
+    assert concatenate([{"a": 1}, {"b": 2}]) == {"a": 1, "b": 2}
+    assert concatenate(["a", "b"]) == "a\nb"
+    with pytest.raises(TypeError):
+        concatenate([1, 2])
+
+
+@pytest.mark.parametrize("strategy", ["truncate", "sample"])
+def test_budget_shrinks_the_largest_argument(strategy: str) -> None:
+    mock_callable = Mock(return_value=make_completion(["'positive'"], "fake"))
+    budget = TokenBudget(450, strategy=strategy)
+
+    @ghostfunction(ai_callable=mock_callable, token_budget=budget)
+    def classify(reviews: List[str], label: str) -> str:  # type: ignore[empty-body]
+        """Return the overall sentiment of `reviews`."""
+        pass
+
+    reviews = [f"review number {i}" for i in range(200)]
+    assert classify.count_tokens(reviews, "x") > 450
+    assert classify(reviews, label="x") == "positive"
+    content = _user_content(mock_callable)
+    assert count_tokens(mock_callable.call_args.kwargs["messages"]) <= 450
+    assert "label='x'" in content
+    assert "review number 0'" in content
+    assert ("review number 199'" in content) == (strategy == "sample")
+
+
+def test_budget_truncates_long_strings_and_small_prompts_pass() -> None:
+    mock_callable = Mock(return_value=make_completion(["'short'"], "fake"))
+
+    @ghostfunction(ai_callable=mock_callable, token_budget=TokenBudget(400))
+    def summarize(text: str) -> str:  # type: ignore[empty-body]
+        """Summarize `text`."""
+        pass
+
+    summarize("word " * 1000)
+    assert "word word...'" in _user_content(mock_callable)
+    summarize("tiny")
+    assert "text='tiny'" in _user_content(mock_callable)
+
+
+def test_error_strategy_raises() -> None:
+    mock_callable = Mock(return_value=make_completion(["1"], "fake"))
+
+    @ghostfunction(ai_callable=mock_callable, token_budget=TokenBudget(50, "error"))
+    def count(items: List[int]) -> int:  # type: ignore[empty-body]
+        """Return the number of items."""
+        pass
+
+    with pytest.raises(TokenBudgetExceeded):
+        count(list(range(1000)))
+    mock_callable.assert_not_called()
+
+
+def test_chunk_strategy_maps_and_reduces() -> None:
+    def ai_callable(**kwargs: Any) -> ChatCompletion:
+        content = kwargs["messages"][-1]["content"]
+        call = content[content.index("items=") :].splitlines()[0]
+        return make_completion([repr({"count": call.count(",") + 1})], "fake")
+
+    budget = TokenBudget(
+        400, strategy="chunk", reduce=lambda ps: sum(p["count"] for p in ps)
+    )
+
+    @ghostfunction(ai_callable=ai_callable, token_budget=budget)
+    def count(items: List[int]) -> Dict[str, int]:  # type: ignore[empty-body]
+        """Return the number of items."""
+        pass
+
+    assert count(list(range(300))) == 300
+
+    @ghostfunction(ai_callable=ai_callable, token_budget=budget, async_=True)
+    def acount(items: List[int]) -> Dict[str, int]:  # type: ignore[empty-body]
+        """Return the number of items."""
+        pass
+
+    assert asyncio.run(acount(list(range(300)))) == 300
+
+
+def test_chunk_strategy_limits_concurrent_chunks() -> None:
+    lock = threading.Lock()
+    in_flight = [0]
+    peak = [0]
+
+    def ai_callable(**kwargs: Any) -> ChatCompletion:
+        with lock:
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+        time.sleep(0.01)
+        with lock:
+            in_flight[0] -= 1
+        return make_completion(["1"], "fake")
+
+    budget = TokenBudget(400, strategy="chunk", reduce=sum, max_concurrency=2)
+
+    @ghostfunction(ai_callable=ai_callable, token_budget=budget)
+    def count(items: List[int]) -> int:  # type: ignore[empty-body]
+        """Return the number of items."""
+        pass
+
+    assert count(list(range(300))) > 2
+    assert peak[0] == 2
+    with pytest.raises(ValueError):
+        TokenBudget(400, max_concurrency=0)
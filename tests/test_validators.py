@@ -0,0 +1,102 @@
+import sys
+from dataclasses import dataclass
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Literal
+from typing import Optional
+from typing import Tuple
+from typing import TypedDict
+from unittest.mock import patch
+
+import pytest
+import typeguard
+
+from ai_ghostfunctions.validators import compile_validator
+
+
+class Person(TypedDict):
+    """A person."""
+
+    name: str
+    age: int
+
+
+@dataclass
+class Point:
+    """A point."""
+
+    x: int
+    y: float = 0.0
+
+
+@pytest.mark.parametrize(
+    "string,expected_type,expected",
+    [
+        ("a bare string", str, "a bare string"),
+        ("'quoted'", str, "quoted"),
+        ("12", int, 12),
+        ("1.5", float, 1.5),
+        ("2", float, 2),
+        ("True", bool, True),
+        ("None", None, None),
+        ("b'x'", bytes, b"x"),
+        ('["a", "b"]', List[str], ["a", "b"]),
+        ("['a', 'b']", List[str], ["a", "b"]),
+        ("[1, 'a']", list, [1, "a"]),
+        ("{'a': 1}", Dict[str, int], {"a": 1}),
+        ('{"a": [1, 2]}', Dict[str, List[int]], {"a": [1, 2]}),
+        ("{1: 2}", Dict[int, Any], {1: 2}),
+        ("(1, 'a')", Tuple[int, str], (1, "a")),
+        ("(1, 2, 3)", Tuple[int, ...], (1, 2, 3)),
+        ("None", Optional[int], None),
+        ("3", Optional[int], 3),
+        ("{'name': 'Al', 'age': 3}", Person, {"name": "Al", "age": 3}),
+        ('[{"name": "Al", "age": 3}]', List[Person], [{"name": "Al", "age": 3}]),
+        ("{'x': 1, 'y': 2.5}", Point, Point(1, 2.5)),
+        ("{'x': 1}", Point, Point(1)),
+        ("{1, 2}", set, {1, 2}),
+        ("'a'", Literal["a", "b"], "a"),
+    ],
+)
+def test_validator_parses_and_checks(
+    string: str, expected_type: Any, expected: Any
+) -> None:
+    assert compile_validator(expected_type).parse(string) == expected
+
+
+@pytest.mark.parametrize(
+    "string,expected_type",
+    [
+        ("'a'", int),
+        ("[1]", List[str]),
+        ("['a', 1]", List[str]),
+        ("{'a': 'b'}", Dict[str, int]),
+        ("(1, 2)", Tuple[int, str]),
+        ("'a'", Optional[int]),
+        ("{'name': 'Al'}", Person),
+        ("{'name': 'Al', 'age': 3, 'extra': 1}", Person),
+        ("{'y': 1.0}", Point),
+        ("{'x': 'a'}", Point),
+        ("'c'", Literal["a", "b"]),
+    ],
+)
+def test_validator_rejects_mismatches(string: str, expected_type: Any) -> None:
+    with pytest.raises(typeguard.TypeCheckError):
+        compile_validator(expected_type).parse(string)
+
+
+def test_compile_validator_is_cached_per_type() -> None:
+    assert compile_validator(List[int]) is compile_validator(List[int])
+
+
+def test_fast_paths_do_not_use_typeguard() -> None:
+    validator = compile_validator(Dict[str, List[Optional[int]]])
+    with patch.object(typeguard, "check_type") as check_type:
+        assert validator.parse('{"a": [1, null]}') == {"a": [1, None]}
+    check_type.assert_not_called()
+
+
+@pytest.mark.skipif(sys.version_info < (3, 10), reason="requires PEP 604 unions")
+def test_pep_604_unions() -> None:
+    assert compile_validator(eval("int | None")).parse("None") is None  # nosec